@@ -10,12 +10,13 @@ from utils import mdsetup as Set
 import utils as utils
 
 
-def MD_TI(runRecord, args):
+def MD_TI(runRecord, args, job_id=None):
     """
     MAIN ROUTINE to run MD and TI trajectories
     :param runRecord: record/line from the runFile with jobnm, lignm, phase and etc
     :param args: arguments of gmxfe command
-    :return:
+    :param job_id: job ID preallocated for the record (default: next ID of the OutDir counter)
+    :return: list of scheduler.Submission of the record's job scripts
     """
 
     tokens = runRecord.split()
@@ -23,12 +24,11 @@ def MD_TI(runRecord, args):
     if len(tokens) < 3:
         logging.error(f'Record {runRecord} is empty or has wrong format. '
                           f'It must have 4 tokens, see gmxFE manual.')
-        return
+        return []
     # Parse input record:
     jobnm  = tokens[0]
     sLigNm = tokens[1]
     sPhase = tokens[2]
-    utils.env.TaskNm = jobnm
     # read XML config template names for jobs in the same order as lines order
     #utils.env.Template = compare_lists(utils.env.Templates, list_lines, idx)
 
@@ -38,11 +38,8 @@ def MD_TI(runRecord, args):
     cfgType = utils.env.cfgType
     #cfgType = args.gmxconfig.get('cfgType')
     if cfgType == 'byPhase':
-        JobArgs        = Set.job_init(jobnm, sLigNm, sPhase, args)
-        
-        job_dir = JobArgs['job_dir']
-        os.chdir(job_dir)  # Change dir to the job dir
-    
+        JobArgs        = Set.job_init(jobnm, sLigNm, sPhase, args, job_id)
+        job_dir = JobArgs['job_dir']   # All job files are written by full path, the process cwd is never changed
         JobArgs        = Set.top_coor(sLigNm, sPhase, JobArgs, args)
         #sys.exit(0)
 
@@ -64,11 +61,7 @@ def MD_TI(runRecord, args):
         JobArgs        = Set.TI_grid(JobArgs, args)
 
     jobscripts = Set.submit_scripts(workflow, JobArgs, args)
-    Set.schedule_job(jobscripts, JobArgs, args)
-
-    os.chdir(utils.env.InitPath)
-    #sys.exit(0)
-    return()
+    return Set.schedule_job(jobscripts, JobArgs, args)
 
 def RunTI(jobnm, sLigNm, sPhase, args):
     """
@@ -80,9 +73,7 @@ def RunTI(jobnm, sLigNm, sPhase, args):
     :return:
     """
     JobArgs        = Set.job_init(jobnm, sLigNm, sPhase, args)
-    
     job_dir = JobArgs['job_dir']
-    os.chdir(job_dir)  # Change dir to the job dir
 
     JobArgs        = Set.top_coor(sLigNm, sPhase, JobArgs, args)
     #sys.exit(0)
@@ -99,10 +90,39 @@ def RunTI(jobnm, sLigNm, sPhase, args):
     jobscript = Set.gen_submit_scripts(workflow, JobArgs, args)
     Set.submit_job(jobscript, JobArgs, args)
 
-    os.chdir(utils.env.InitPath)
     #sys.exit(0)
     return()
 
+def init_worker(env):
+    """
+    Initializer of the worker processes of the "--jobs N" pool: install the
+    parent's configuration as the worker's "utils.env"
+
+    :param env: configured "utils.configure" instance of the parent process
+    :return:
+    """
+    utils.env = env
+
+def prepare_record(idx, runRecord, args, job_id=None):
+    """
+    Prepare a single runFile record, catching its failure so that
+    the other records of the batch are still processed.
+
+    :param idx: index of the record in the list of selected runFile records
+    :param runRecord: record/line from the runFile with jobnm, lignm, phase and etc
+    :param args: arguments of gmxfe command
+    :param job_id: job ID preallocated for the record
+    :return: (idx, runRecord, error, submissions) where error is None on success
+    """
+    try:
+        submissions = MD_TI(runRecord, args, job_id)
+    except SystemExit as e:   # Setup routines report errors by logging and sys.exit()
+        return idx, runRecord, f'setup stopped (exit code {e.code}), see the log above', []
+    except Exception as e:
+        logging.exception(f'Record {idx} "{runRecord.strip()}" failed')
+        return idx, runRecord, f'{type(e).__name__}: {e}', []
+    return idx, runRecord, None, submissions
+
 
 def RunMD(args):
     """
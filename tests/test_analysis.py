@@ -0,0 +1,138 @@
+"""
+TI, BAR and MBAR estimators on harmonic oscillators with a known free energy difference:
+the state at lambda has the force constant (1 + a*lambda) kT, so dG = kT/2 ln(1 + a)
+"""
+import math
+import os
+import subprocess
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import analysis
+
+T = 300.0
+A = 3.0
+kT = analysis.R_KJ * T
+EXACT = 0.5 * math.log(1 + A) * kT
+
+
+def oscillator_rows(lams, i, nsamples, rng):
+    """
+    Rows "time dH/dl dH(to each lambda)" of the window i, kJ/mol
+    """
+    x = rng.normal(0, 1 / math.sqrt(1 + A * lams[i]), nsamples)
+    u = 0.5 * x ** 2 * kT
+    return np.column_stack([np.arange(nsamples, dtype=float), A * u] + [A * (m - lams[i]) * u for m in lams])
+
+
+def write_xvg(path, lams, i, rows):
+    lines = ['# This file was created by gmx mdrun\n',
+             '@    title "dH/d\\xl\\f{} and \\xD\\f{}H"\n',
+             f'@ subtitle "T = {T:g} (K) \\xl\\f{{}} state {i}: fep-lambda = {lams[i]:.4f}"\n',
+             '@ s0 legend "dH/d\\xl\\f{} fep-lambda = %.4f"\n' % lams[i]]
+    lines += ['@ s%d legend "\\xD\\f{}H \\xl\\f{} to %.4f"\n' % (k + 1, m) for k, m in enumerate(lams)]
+    lines += [' '.join(f'{v:.6f}' for v in row) + '\n' for row in rows]
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+@pytest.fixture(scope='module')
+def windows():
+    rng = np.random.default_rng(0)
+    lams = np.linspace(0, 1, 11)
+    ws = []
+    for i, lam in enumerate(lams):
+        meta = {'T': T, 'state': i, 'vector': (lam,), 'components': ['fep-lambda'], 'dhdl_cols': [1],
+                'dhdl_lambdas': [lam], 'foreign_cols': list(range(2, 2 + len(lams))),
+                'foreign': [(m,) for m in lams], 'pv_col': None}
+        ws.append(analysis.Window(meta, oscillator_rows(lams, i, 20000, rng), '', i))
+    return ws
+
+
+def test_integration_weights():
+    x = np.array([0.0, 0.1, 0.3, 0.6, 1.0])
+    assert np.sum(analysis.trapezoid_weights(x) * (2 * x + 1)) == pytest.approx(2.0)
+    x = np.linspace(0, math.pi, 9)
+    assert np.sum(analysis.cubic_weights(x) * np.sin(x)) == pytest.approx(2.0, abs=2e-3)
+    assert abs(np.sum(analysis.trapezoid_weights(x) * np.sin(x)) - 2.0) > 2e-2
+
+
+def test_estimators(windows):
+    dG, err = analysis.ti(windows)
+    assert 0 < err < 0.02 and dG == pytest.approx(EXACT, abs=0.03)     # trapezoid bias is ~0.02 kJ/mol
+    dG, err = analysis.ti(windows, method='cubic')
+    assert dG == pytest.approx(EXACT, abs=5 * err)
+    samples = [analysis.subsample(w) for w in windows]
+    df, err, steps = analysis.bar(windows, samples)
+    assert len(steps) == 10 and df * kT == pytest.approx(EXACT, abs=5 * err * kT)
+    df, err = analysis.mbar(windows, samples, np.concatenate([[0.0], np.cumsum(steps)]))
+    assert df * kT == pytest.approx(EXACT, abs=5 * err * kT)
+
+
+def test_bar_needs_neighbour_energies(windows):
+    ws = [w.after(0) for w in windows]
+    for w in ws:
+        w.meta = dict(w.meta, foreign=[w.vector])       # energies of the own state only
+        w.dH = w.dH[:, :1]
+    assert analysis.bar(ws, [w.dH for w in ws]) is None
+    assert analysis.mbar(ws, [w.dH for w in ws]) is None
+
+
+def test_parse_header():
+    header = ['@ subtitle "T = 298.15 (K) \\xl\\f{} state 2: (coul-lambda, vdw-lambda) = (1.0000, 0.2000)"\n',
+              '@ s0 legend "Energy (kJ/mol)"\n',
+              '@ s1 legend "dH/d\\xl\\f{} coul-lambda = 1.0000"\n',
+              '@ s2 legend "dH/d\\xl\\f{} vdw-lambda = 0.2000"\n',
+              '@ s3 legend "\\xD\\f{}H \\xl\\f{} to (1.0000, 0.1000)"\n',
+              '@ s4 legend "\\xD\\f{}H \\xl\\f{} to (1.0000, 0.4000)"\n',
+              '@ s5 legend "pV (kJ/mol)"\n']
+    meta = analysis.parse_header(header)
+    assert meta['T'] == 298.15 and meta['state'] == 2 and meta['vector'] == (1.0, 0.2)
+    assert meta['components'] == ['coul-lambda', 'vdw-lambda'] and meta['dhdl_cols'] == [2, 3]
+    assert meta['foreign_cols'] == [4, 5] and meta['foreign'] == [(1.0, 0.1), (1.0, 0.4)]
+    assert meta['pv_col'] == 6
+
+
+def test_analyze_job(tmp_path):
+    # Job dir as written by run_ti: the TI point scripts locate the dhdl.xvg of the last Task
+    job_dir = tmp_path / '1.W_job1'
+    job_dir.mkdir()
+    rng = np.random.default_rng(1)
+    lams = np.linspace(0, 1, 6)
+    for i in range(len(lams)):
+        (job_dir / f'runjob{i}.qsh').write_text(f'subdir=LAMBDA_{i}\nlambda={i}\n'
+                                                '############## Task: PROD #################\n'
+                                                'gmx grompp  -f wat_prod.mdp -o ti.tpr\n')
+        os.makedirs(job_dir / 'PROD' / f'LAMBDA_{i}')
+        write_xvg(str(job_dir / 'PROD' / f'LAMBDA_{i}' / 'dhdl.xvg'), lams, i, oscillator_rows(lams, i, 4000, rng))
+    assert analysis.find_job_dirs(str(tmp_path)) == [str(job_dir)]
+    result = analysis.analyze_job(str(job_dir), cache=False)
+    assert result['windows'] == 6 and result['T'] == T
+    for estimator in ('TI', 'TI-cubic', 'BAR', 'MBAR'):
+        dG, err = result[estimator]
+        assert dG == pytest.approx(EXACT, abs=5 * err + 0.05), estimator
+    # The results are the same through the binary cache of the parsed xvg
+    cached = analysis.analyze_job(str(job_dir))
+    assert os.path.isfile(job_dir / 'PROD' / 'LAMBDA_0' / 'dhdl.bin')
+    for estimator in ('TI', 'TI-cubic', 'BAR', 'MBAR'):
+        assert cached[estimator] == pytest.approx(result[estimator])
+
+
+def test_analyze_exit_status(tmp_path):
+    # Scripts and array jobs running "gmxfe analyze" tell failures by the exit status
+    gmxfe = os.path.join(ROOT, 'gmxfe')
+    p = subprocess.run([sys.executable, gmxfe, 'analyze', '-od', str(tmp_path)], capture_output=True, text=True)
+    assert p.returncode == 1 and 'No TI job dirs to analyze' in p.stderr
+    job_dir = tmp_path / '1.W_job1'
+    job_dir.mkdir()
+    (job_dir / 'runjob0.qsh').write_text('subdir=LAMBDA_0\nlambda=0\n############## Task: PROD #################\n')
+    (job_dir / 'PROD' / 'LAMBDA_0').mkdir(parents=True)
+    (job_dir / 'PROD' / 'LAMBDA_0' / 'dhdl.xvg').write_text('@ s0 legend "dH/d\\xl\\f{} fep-lambda = 0.0000"\n0 1\n1 2\n')
+    p = subprocess.run([sys.executable, gmxfe, 'analyze', str(job_dir)], capture_output=True, text=True)
+    assert p.returncode == 1 and 'Temperature is not found' in p.stderr
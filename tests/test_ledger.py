@@ -0,0 +1,55 @@
+"""
+ResFile ledger: records appended by the job scripts and read back with the last record winning
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import ledger
+
+JobArgs = {'sJobNm': 'job1', 'sLigNm': 'lig1', 'sPhase': 'Water', 'jobid': '7'}
+
+
+def test_parse_line():
+    assert ledger.parse_line('') is None
+    assert ledger.parse_line('{"job": "job1", "status": "do') is None      # partially written line
+    assert ledger.parse_line('{"job": "job1", "lambda": 2}') == {'job': 'job1', 'lambda': 2}
+    assert ledger.parse_line('job1\t2024-01-01\t/out/7.W_job1/PROD/2\n') == \
+        {'job': 'job1', 'time': '2024-01-01', 'outdir': '/out/7.W_job1/PROD/2', 'status': 'done'}
+    assert ledger.parse_line('job1 only two\tfields') is None
+
+
+def test_last_record_wins(tmp_path):
+    path = tmp_path / 'ResFile.txt'
+    path.write_text('job0\t2023-12-31\t/out/6.W_job0/PROD/0\n'
+                    '{"job": "job1", "ligand": "lig1", "lambda": 0, "status": "failed", "outdir": "/out/7/PROD/0"}\n'
+                    '{"job": "job1", "ligand": "lig1", "lambda": 1, "status": "done", "outdir": "/out/7/PROD/1"}\n'
+                    '{"job": "job1", "ligand": "lig1", "lambda": 0, "status": "done", "outdir": "/out/7/PROD/0"}\n'
+                    '{"job": "job1", "lig')
+    records = ledger.read_ledger(str(path))
+    assert [r['outdir'] for r in records] == ['/out/6.W_job0/PROD/0', '/out/7/PROD/1', '/out/7/PROD/0']
+    assert all(r['status'] == 'done' for r in records)
+    assert [r['outdir'] for r in ledger.select(records, ligand='lig1', lambdas=['0'])] == ['/out/7/PROD/0']
+    assert ledger.select(records, status='failed') == []
+
+
+@pytest.mark.parametrize('final, rc, status', [(True, 0, 'done'), (True, 3, 'failed'),
+                                               (False, 0, None), (False, 1, 'failed')])
+def test_shell_record(tmp_path, final, rc, status):
+    ResFile = tmp_path / 'ResFile.txt'
+    script = tmp_path / 'runjob2.qsh'
+    script.write_text('subdir=lam2\nlambda=2\n' + ledger.shell_record(str(ResFile), 'PROD', JobArgs, final)
+                      + f'exit {rc}\n')
+    assert subprocess.run(['sh', str(script)], cwd=str(tmp_path)).returncode == rc
+    records = ledger.read_ledger(str(ResFile)) if ResFile.exists() else []
+    if status is None:
+        assert records == []
+        return
+    rec, = records
+    assert {k: rec[k] for k in ('job', 'ligand', 'phase', 'jobid', 'lambda', 'status', 'exit')} == \
+        {'job': 'job1', 'ligand': 'lig1', 'phase': 'Water', 'jobid': '7', 'lambda': 2, 'status': status, 'exit': rc}
+    assert rec['outdir'] == f'{tmp_path}/PROD/lam2'
@@ -0,0 +1,57 @@
+"""
+Local executor of --queue none: failures of the scripts (including the ones which can't be started)
+are reported by wait() and never leave the futures of the dependent scripts unresolved
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import localrun
+
+
+def wait(executor, timeout=30):
+    """
+    executor.wait() in a thread, so that a future which is never resolved fails the test instead of hanging it
+    """
+    result = []
+    t = threading.Thread(target=lambda: result.append(executor.wait()), daemon=True)
+    t.start()
+    t.join(timeout)
+    assert result, 'wait() did not return'
+    return result[0]
+
+
+def test_dependencies(tmp_path):
+    (tmp_path / 'ok.qsh').write_text('exit 0\n')
+    (tmp_path / 'bad.qsh').write_text('exit 3\n')
+    executor = localrun.LocalExecutor(ncpu=1, cores=2)
+    ok, bad = executor.submit(str(tmp_path), ['ok.qsh', 'bad.qsh'])
+    after = executor.submit(str(tmp_path), ['ok.qsh', 'ok.qsh'], after=[ok, bad])
+    combined = localrun.LocalExecutor.all_of(after)
+    assert sorted(wait(executor)) == [(str(tmp_path), 'bad.qsh', 3), (str(tmp_path), 'ok.qsh', 3)]
+    assert after[0].result() == 0 and after[1].result() == 3 and combined.result(5) == 3
+
+
+def test_log_not_writable(tmp_path):
+    missing = str(tmp_path / 'removed')
+    (tmp_path / 'ok.qsh').write_text('exit 0\n')
+    executor = localrun.LocalExecutor(ncpu=1, cores=1)
+    first, = executor.submit(missing, ['runjob0.qsh'])
+    second, = executor.submit(str(tmp_path), ['ok.qsh'], after=[first])
+    assert wait(executor) == [(missing, 'runjob0.qsh', 127), (str(tmp_path), 'ok.qsh', 127)]
+    assert first.result() == 127 and second.result() == 127
+
+
+def test_relay_exception(tmp_path):
+    (tmp_path / 'ok.qsh').write_text('exit 0\n')
+    executor = localrun.LocalExecutor(ncpu=1, cores=1)
+    def broken(workdir, script):
+        raise RuntimeError('broken')
+    executor._run = broken
+    dep = localrun.Future()
+    future, = executor.submit(str(tmp_path), ['ok.qsh'], after=[dep])
+    combined = localrun.LocalExecutor.all_of([future])
+    dep.set_result(0)
+    assert isinstance(combined.exception(5), RuntimeError) and isinstance(future.exception(5), RuntimeError)
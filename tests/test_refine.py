@@ -0,0 +1,100 @@
+"""
+Refinement of the lambda grid of a pilot TI job: the new states are inserted at the midpoints
+of the intervals with the largest error and set up as new windows of the same job dir
+"""
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import analysis, refine
+from utils.mdp import MdpTemplate
+
+SCRIPT = """\
+#!/bin/sh
+subdir=LAMBDA_{lam}
+lambda={lam}
+############## Task: MIN #################
+gmx grompp  -f wat_min.mdp -o ti.tpr
+############## Task: PROD #################
+gmx grompp  -f wat_prod.mdp -o ti.tpr
+"""
+
+
+def pilot_job(job_dir, lams, dhdl_means, rng):
+    """
+    Pilot run: windows 0..n-1 with <dH/dl> = dhdl_means, MDPs of both Tasks per window
+    """
+    grid = ' '.join(f'{l:g}' for l in lams)
+    for k, (lam, mean) in enumerate(zip(lams, dhdl_means)):
+        (job_dir / f'runjob{k}.qsh').write_text(SCRIPT.format(lam=k))
+        for Task in ('MIN', 'PROD'):
+            subdir = job_dir / Task / f'LAMBDA_{k}'
+            subdir.mkdir(parents=True)
+            (subdir / f'wat_{Task.lower()}.mdp').write_text(
+                f'integrator = {"steep" if Task == "MIN" else "sd"}\n'
+                f'init-lambda-state = {k}\nfep-lambdas = {grid}\n')
+        values = mean + rng.normal(0, 0.1, 500)
+        (job_dir / 'PROD' / f'LAMBDA_{k}' / 'dhdl.xvg').write_text(
+            f'@ subtitle "T = 300 (K) \\xl\\f{{}} state {k}: fep-lambda = {lam:.4f}"\n'
+            f'@ s0 legend "dH/d\\xl\\f{{}} fep-lambda = {lam:.4f}"\n'
+            + ''.join(f'{t} {v:.5f}\n' for t, v in enumerate(values)))
+
+
+@pytest.fixture
+def job_dir(tmp_path):
+    job_dir = tmp_path / '1.W_job1'
+    job_dir.mkdir()
+    # <dH/dl> is curved in [0, 0.5] and linear in [0.5, 1]
+    pilot_job(job_dir, [0.0, 0.25, 0.5, 0.75, 1.0], [40.0, 5.0, 0.0, -1.0, -2.0], np.random.default_rng(0))
+    return job_dir
+
+
+def test_refine_inserts_midpoints(job_dir):
+    new = refine.refine_job(str(job_dir), nnew=2)
+    assert new == ['runjob5.qsh', 'runjob6.qsh']
+    text = (job_dir / 'runjob5.qsh').read_text()
+    assert 'subdir=LAMBDA_5\nlambda=5\n' in text and 'Task: MIN' in text and 'Task: PROD' in text
+    # Both intervals of the curved part are split, the states are indexed in the refined grid
+    expected = {5: ('0.125', 1), 6: ('0.375', 3)}
+    for lam, (value, state) in expected.items():
+        for Task in ('MIN', 'PROD'):
+            mdp = MdpTemplate.from_file(str(job_dir / Task / f'LAMBDA_{lam}' / f'wat_{Task.lower()}.mdp'))
+            assert mdp.get('fep-lambdas').split() == ['0', '0.125', '0.25', '0.375', '0.5', '0.75', '1']
+            assert int(mdp.get('init-lambda-state')) == state
+    # The windows of the pilot run are kept as they are
+    mdp = MdpTemplate.from_file(str(job_dir / 'PROD' / 'LAMBDA_2' / 'wat_prod.mdp'))
+    assert mdp.get('fep-lambdas') == '0 0.25 0.5 0.75 1' and mdp.get('init-lambda-state') == '2'
+    assert [lam for lam, _ in analysis.find_windows(str(job_dir))] == [0, 1, 2, 3, 4, 5, 6]
+
+
+def test_refine_again_uses_finest_grid(job_dir):
+    assert refine.refine_job(str(job_dir), nnew=1) == ['runjob5.qsh']
+    # Pilot run of the new window at lambda 0.125
+    rng = np.random.default_rng(1)
+    (job_dir / 'PROD' / 'LAMBDA_5' / 'dhdl.xvg').write_text(
+        '@ subtitle "T = 300 (K) \\xl\\f{} state 1: fep-lambda = 0.1250"\n'
+        '@ s0 legend "dH/d\\xl\\f{} fep-lambda = 0.1250"\n'
+        + ''.join(f'{t} {v:.5f}\n' for t, v in enumerate(15.0 + rng.normal(0, 0.1, 500))))
+    new = refine.refine_job(str(job_dir), nnew=1)
+    assert new == ['runjob6.qsh']
+    mdp = MdpTemplate.from_file(str(job_dir / 'PROD' / 'LAMBDA_6' / 'wat_prod.mdp'))
+    assert len(mdp.get('fep-lambdas').split()) == 7
+
+
+def test_min_width(job_dir):
+    assert refine.refine_job(str(job_dir), nnew=2, min_width=0.2) == []
+    assert not (job_dir / 'runjob5.qsh').exists()
+
+
+def test_after_interrupted_refine(job_dir):
+    # Subdir and MDP of a new window left by a refine which failed before its job script was written
+    (job_dir / 'MIN' / 'LAMBDA_5').mkdir()
+    (job_dir / 'MIN' / 'LAMBDA_5' / 'wat_min.mdp').write_text('stale\n')
+    assert refine.refine_job(str(job_dir), nnew=1) == ['runjob5.qsh']
+    mdp = MdpTemplate.from_file(str(job_dir / 'MIN' / 'LAMBDA_5' / 'wat_min.mdp'))
+    assert mdp.get('init-lambda-state') == '1' and mdp.get('integrator') == 'steep'
@@ -0,0 +1,235 @@
+"""
+gmxfe run_ti driven through the "fake" queue: the records are prepared by DoByList with a stand-in
+gmx binary and the submissions (arrays, dependencies) are read back from OUTDIR/.fakequeue/queue.jsonl
+"""
+import json
+import os
+import stat
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import scheduler
+
+GMX_VERSION = """\
+GROMACS version:    2023.3
+Precision:          mixed
+MPI library:        thread_mpi
+GPU support:        disabled
+SIMD instructions:  AVX2_256
+"""
+
+CONFIG = """\
+cfgType = "byPhase"
+
+[paths]
+gmx = "{gmx}"
+outnm = "ti"
+TIdir = "lam"
+BoxCache = "none"
+
+[Phase.Water]
+FileLabel = "wat"
+DirPrefix = "W"
+TopTemplate = "system.top"
+MdpTemplate = "ti.mdp"
+SetupType = "none"
+workflow = ["MIN", "PROD"]
+Molecule = [{{name = "LIG", type = "ligand", include_files = ["ligand.itp"]}}]
+
+[Task.DEFAULT.mdp]
+fep-lambdas = "0.0 0.5 1.0"
+
+[Task.MIN]
+type = "minimization"
+[Task.MIN.mdp]
+integrator = "steep"
+
+[Task.PROD]
+type = "production"
+[Task.PROD.mdp]
+integrator = "sd"
+"""
+
+
+def write(path, text, mode=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+    if mode: os.chmod(path, mode)
+
+
+@pytest.fixture
+def campaign(tmp_path):
+    """
+    Config, TopDir, MdpDir and runFile of two ligands in the Water phase, gmx is a script printing its version
+    """
+    gmx = tmp_path / 'bin' / 'gmx'
+    write(str(gmx), '#!/bin/sh\ncat <<EOF\n' + GMX_VERSION + 'EOF\n', stat.S_IRWXU)
+    write(str(tmp_path / 'config.toml'), CONFIG.format(gmx=gmx))
+    write(str(tmp_path / 'TOP' / 'system.top'), '#include "{ligand}.itp"\n[ molecules ]\n{ligand} 1\n')
+    for lig in ('lig1', 'lig2'):
+        write(str(tmp_path / 'TOP' / f'{lig}.itp'), f'; {lig}\n')
+        write(str(tmp_path / 'TOP' / f'{lig}.pdb'),
+              'HETATM    1  C1  LIG     1       0.000   0.000   0.000  1.00  0.00           C\nEND\n')
+    write(str(tmp_path / 'MDP' / 'ti.mdp'), 'integrator = md\ninit-lambda-state = 0\nfep-lambdas =\n')
+    write(str(tmp_path / 'runlist.txt'), 'job1 lig1 Water\njob2 lig2 Water\n')
+    return tmp_path
+
+
+def run_ti(campaign, *options, returncode=0):
+    env = dict(os.environ, XDG_CACHE_HOME=str(campaign / 'cache'))
+    cmd = [sys.executable, os.path.join(ROOT, 'gmxfe'), 'run_ti', '-c', 'config.toml', '-f', 'runlist.txt',
+           '--topdir', 'TOP', '--mdpdir', 'MDP', '-od', 'OUT', '--lines', '1', '2', '--queue', 'fake', *options]
+    p = subprocess.run(cmd, cwd=str(campaign), env=env, capture_output=True, text=True)
+    assert p.returncode == returncode, p.stdout + p.stderr
+    if returncode: return p.stdout + p.stderr
+    return scheduler.FakeQueue(str(campaign / 'OUT' / '.fakequeue')).jobs()
+
+
+def test_array_per_record(campaign):
+    jobs = run_ti(campaign)
+    assert len(jobs) == 2
+    assert len({job['workdir'] for job in jobs}) == 2
+    for job in jobs:
+        assert job['scripts'] == ['runjob0.qsh', 'runjob1.qsh', 'runjob2.qsh']
+        assert 'after' not in job
+        wrapper = os.path.join(job['workdir'], job['array'])
+        with open(wrapper) as f:
+            text = f.read()
+        assert f'cd {job["workdir"]}' in text
+        assert '${FAKE_ARRAY_TASK_ID}' in text and '3) exec sh ./runjob2.qsh' in text
+        for lam in range(3):
+            with open(os.path.join(job['workdir'], 'PROD', f'lam{lam}', 'wat_prod.mdp')) as f:
+                assert f'init-lambda-state = {lam}' in f.read()
+
+
+def test_dag_dependencies(campaign):
+    jobs = run_ti(campaign, '--dag')
+    assert len(jobs) == 4
+    for workdir in {job['workdir'] for job in jobs}:
+        mins, prods = [job for job in jobs if job['workdir'] == workdir]
+        assert mins['jobname'].endswith('.MIN') and prods['jobname'].endswith('.PROD')
+        assert mins['scripts'] == ['dag_MIN_0.qsh', 'dag_MIN_1.qsh', 'dag_MIN_2.qsh']
+        assert prods['scripts'] == ['dag_PROD_0.qsh', 'dag_PROD_1.qsh', 'dag_PROD_2.qsh']
+        assert 'after' not in mins
+        assert prods['after'] == mins['job_id'] and prods['task_wise']
+
+
+def test_pbs_single_script_runs_in_job_dir(tmp_path, monkeypatch):
+    # Stand-in qsub records its arguments and prints a job ID
+    qsub = tmp_path / 'bin' / 'qsub'
+    write(str(qsub), '#!/bin/sh\necho "$@" > "$(dirname "$0")/qsub.args"\necho 42.pbs\n', stat.S_IRWXU)
+    monkeypatch.setenv('PATH', str(qsub.parent) + os.pathsep + os.environ['PATH'])
+    job_dir = tmp_path / 'job'
+    job_dir.mkdir()
+    sub = scheduler.Submission(str(job_dir), ['runjob3.qsh'], 'gmxTIp.1')
+    assert scheduler.submit_pbs(sub) == '42'
+    args = (qsub.parent / 'qsub.args').read_text().split()
+    assert '-J' not in args and args[-1] == 'array_gmxTIp.1.qsh'
+    assert (job_dir / args[-1]).read_text() == textwrap.dedent(f"""\
+        #!/bin/sh
+        cd {job_dir}
+        exec sh ./runjob3.qsh
+        """)
+
+
+def ledger_record(campaign, job_dir, lam, status):
+    # Record appended by the job script of the window at exit
+    rec = {'job': os.path.basename(job_dir).split('_', 1)[1], 'jobid': os.path.basename(job_dir).split('.')[0],
+           'lambda': lam, 'status': status, 'outdir': os.path.join(job_dir, 'PROD', f'lam{lam}')}
+    with open(campaign / 'OUTPUT' / 'ResFile.txt', 'a') as f:
+        f.write(json.dumps(rec) + '\n')
+
+
+def test_resume_keeps_setup(campaign):
+    first = run_ti(campaign)
+    job_dirs = [job['workdir'] for job in first]
+    job_dir, other = job_dirs
+    os.makedirs(campaign / 'OUTPUT')
+    # Window 0 is finished, window 1 failed, window 2 has no record: it may be still queued or running
+    for name, text in (('ti_prod.gro', 'done\n'), ('dhdl.xvg', 'done\n'), ('ti.log', 'Finished mdrun on rank 0\n')):
+        write(os.path.join(job_dir, 'PROD', 'lam0', name), text)
+    ledger_record(campaign, job_dir, 0, 'done')
+    ledger_record(campaign, job_dir, 1, 'failed')
+    # The other job: window 0 is recorded as done but its output is incomplete (the log is cut),
+    # the job script of window 1 is removed to resubmit it
+    for name, text in (('ti_prod.gro', 'done\n'), ('dhdl.xvg', 'done\n'), ('ti.log', 'Step 1000\n')):
+        write(os.path.join(other, 'PROD', 'lam0', name), text)
+    ledger_record(campaign, other, 0, 'done')
+    os.remove(os.path.join(other, 'runjob1.qsh'))
+    kept = [os.path.join(job_dir, 'lig1_wat.top'), os.path.join(job_dir, 'lig1_wat.pdb'),
+            os.path.join(job_dir, 'MIN', 'wat_min.mdp'), os.path.join(job_dir, 'PROD', 'lam1', 'wat_prod.mdp'),
+            os.path.join(job_dir, 'runjob1.qsh')]
+    for path in kept:
+        with open(path, 'a') as f:
+            f.write('; kept\n')
+    os.remove(os.path.join(job_dir, 'PROD', 'lam2', 'wat_prod.mdp'))
+    jobs = run_ti(campaign, '--resume', *job_dirs)[len(first):]
+    assert [job['workdir'] for job in jobs] == job_dirs
+    assert jobs[0]['scripts'] == ['runjob1.qsh']
+    assert jobs[1]['scripts'] == ['runjob0.qsh', 'runjob1.qsh']
+    for path in kept:
+        with open(path) as f:
+            assert f.read().endswith('; kept\n'), path
+    with open(os.path.join(job_dir, 'PROD', 'lam2', 'wat_prod.mdp')) as f:
+        assert 'init-lambda-state = 2' in f.read()
+
+
+def test_pack(campaign):
+    jobs = run_ti(campaign, '--pack', '2', '--ncpu', '2')
+    assert [job['scripts'] for job in jobs] == [['packjob0.qsh', 'packjob2.qsh']] * 2
+    assert all(job['ncpu'] == 4 for job in jobs)
+    with open(os.path.join(jobs[0]['workdir'], 'packjob0.qsh')) as f:
+        text = f.read()
+    assert '#PBS -N ' in text and 'TODO' not in text
+    # Pinning only in the slots of the local executor, which sets GMXFE_PINOFFSET
+    assert 'GMXFE_MDRUN_LOCAL="${GMXFE_PINOFFSET:+-pin on -pinoffset $(( GMXFE_PINOFFSET + 2 )) -pinstride 1}' in text
+    assert 'sh ./runjob0.qsh' in text and 'sh ./runjob1.qsh' in text
+
+
+def test_config_snapshot(campaign):
+    first = run_ti(campaign)
+    snapshot = campaign / '.config.toml.snapshot'
+    with open(snapshot) as f:
+        state = json.load(f)['state']
+    assert state['MdpLayers'] == {'Water': {'MIN': {'fep-lambdas': '0.0 0.5 1.0', 'integrator': 'steep'},
+                                            'PROD': {'fep-lambdas': '0.0 0.5 1.0', 'integrator': 'sd'}}}
+    # The second run is set up from the snapshot
+    jobs = run_ti(campaign)[len(first):]
+    for old, new in zip(first, jobs):
+        for path in ('MIN/wat_min.mdp', 'PROD/lam1/wat_prod.mdp'):
+            with open(os.path.join(old['workdir'], path)) as f, open(os.path.join(new['workdir'], path)) as g:
+                assert f.read() == g.read()
+    # A snapshot which is not JSON is ignored
+    snapshot.write_bytes(b'\x80\x04\x95')
+    run_ti(campaign)
+    with open(snapshot) as f:
+        assert json.load(f)['state']['MdpLayers'] == state['MdpLayers']
+
+
+def test_mdp_links(campaign):
+    jobs = run_ti(campaign, '--mdp-links')
+    # The TI point MDPs of both ligands are links to one file per (Task, lambda) in OUTDIR/.mdp
+    inodes = [os.stat(os.path.join(job['workdir'], 'PROD', 'lam1', 'wat_prod.mdp')).st_ino for job in jobs]
+    assert inodes[0] == inodes[1]
+    # The Task MDPs are the same as the ones of lambda 0 (init-lambda-state = 0 in the template)
+    assert len(os.listdir(campaign / 'OUT' / '.mdp')) == 2 * 3
+
+
+def test_unresolved_topology_placeholder(campaign):
+    write(str(campaign / 'TOP' / 'system.top'), '#include "{ligand}.itp"\n[ molecules ]\n{ligand} 1\nSOL {nwater}\n')
+    log = run_ti(campaign, returncode=1)
+    assert "placeholders ['nwater'] of the topology template" in log and '2 of 2 runFile records failed' in log
+    assert not os.path.exists(campaign / 'OUT' / '.fakequeue' / 'queue.jsonl')
+
+
+def test_only_malformed_records(campaign):
+    write(str(campaign / 'runlist.txt'), 'job1 lig1\njob2\n')
+    log = run_ti(campaign, returncode=1)
+    assert '2 of 2 runFile records failed' in log and 'wrong record format' in log
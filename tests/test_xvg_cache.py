@@ -0,0 +1,77 @@
+"""
+Binary cache of parsed dhdl.xvg: full conversion, incremental update of growing files
+(incomplete last line of a running mdrun), rewritten sources and the begin cutoff
+"""
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import analysis
+
+HEADER = ('# gmx mdrun\n'
+          '@ subtitle "T = 300 (K) \\xl\\f{} state 1: fep-lambda = 0.5000"\n'
+          '@ s0 legend "dH/d\\xl\\f{} fep-lambda = 0.5000"\n'
+          '@ s1 legend "\\xD\\f{}H \\xl\\f{} to 0.0000"\n')
+
+
+def rows(first, last):
+    return ''.join(f'{t:.1f} {t * 2:.3f} {-t:.3f}\n' for t in range(first, last))
+
+
+def test_incremental_update(tmp_path):
+    xvg = tmp_path / 'dhdl.xvg'
+    xvg.write_text(HEADER + rows(0, 10) + '10.0 2')         # mdrun is writing the line of t = 10
+    meta, data = analysis.read_dhdl(str(xvg))
+    assert meta['T'] == 300.0 and meta['state'] == 1 and meta['dhdl_cols'] == [1]
+    assert data.shape == (10, 3) and data[-1, 0] == 9.0
+    cmeta = analysis.update_cache(str(xvg))
+    assert cmeta['nrows'] == 10 and cmeta['offset'] == len((HEADER + rows(0, 10)).encode())
+    # The incomplete line is completed and new rows are appended: only the new part is parsed
+    with open(xvg, 'a') as f:
+        f.write('0.000 -10.000\n' + rows(11, 15))
+    meta, data = analysis.read_dhdl(str(xvg))
+    assert data.shape == (15, 3)
+    assert np.array_equal(data, analysis.read_xvg(str(xvg))[1])
+    assert analysis.update_cache(str(xvg))['nrows'] == 15
+    # begin cutoff by the time column of the memory-mapped rows
+    assert analysis.read_dhdl(str(xvg), begin=12.0)[1][:, 0].tolist() == [12.0, 13.0, 14.0]
+
+
+def test_rewritten_source(tmp_path):
+    xvg = tmp_path / 'dhdl.xvg'
+    xvg.write_text(HEADER + rows(0, 20))
+    assert analysis.read_dhdl(str(xvg))[1].shape == (20, 3)
+    # A rerun of the window rewrites the file: shorter and with another header
+    xvg.write_text(HEADER.replace('state 1', 'state 2') + rows(0, 5))
+    meta, data = analysis.read_dhdl(str(xvg))
+    assert meta['state'] == 2 and data.shape == (5, 3)
+    bin_path, _ = analysis.cache_paths(str(xvg))
+    assert os.path.getsize(bin_path) == 5 * 3 * 8
+
+
+def test_interrupted_update(tmp_path):
+    xvg = tmp_path / 'dhdl.xvg'
+    xvg.write_text(HEADER + rows(0, 8))
+    analysis.update_cache(str(xvg))
+    bin_path, _ = analysis.cache_paths(str(xvg))
+    with open(bin_path, 'ab') as f:                        # rows appended without the meta update
+        f.write(b'\0' * 24)
+    with open(xvg, 'a') as f:
+        f.write(rows(8, 10))
+    meta, data = analysis.read_dhdl(str(xvg))
+    assert np.array_equal(data, analysis.read_xvg(str(xvg))[1])
+
+
+def test_empty_and_uncached(tmp_path):
+    xvg = tmp_path / 'dhdl.xvg'
+    xvg.write_text(HEADER)
+    meta, data = analysis.read_dhdl(str(xvg))
+    assert data.shape[0] == 0 and meta['foreign'] == [(0.0,)]
+    xvg.write_text(HEADER + rows(0, 4))
+    assert analysis.read_dhdl(str(xvg))[1].shape == (4, 3)
+    assert analysis.read_dhdl(str(xvg), begin=2.0, cache=False)[1][:, 0].tolist() == [2.0, 3.0]
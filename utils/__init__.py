@@ -1,43 +1,87 @@
 # main file
 # Created 2024
 
-__all__ = ['main', 'mdsetup',  'env']
+__all__ = ['main', 'mdsetup', 'mdp', 'env']
 
 
 import os
-import configparser
-import tempfile
 import sys
 import logging
+import time
+
+# Importing the package has no side effects besides the cheap "env" below: the config is read,
+# the gmx binaries are probed and the heavy modules (mdsetup, toml, munch) are imported on first use
 
 ROOT_DIR = os.path.dirname( os.path.dirname(__file__) )
-print('ROOT_DIR: ', ROOT_DIR)
 #print('package =',__package__)
 #print('__name__ =',__name__)
 sys.path.append(ROOT_DIR)   # Add Parent dir of the file to PYTHONPATH (Note, the package dir must be "OmiX")
 
-from .mdsetup import check_gmx
-# read config values
-config = configparser.ConfigParser()
-
-tmpdir_conf = config.get('gmx', 'TMPDIR')
 tmpdir_env = os.getenv('TMPDIR')
 gmxdir = os.environ.get('CONDA_PREFIX')
 
-################## gmxFE ####################
-gmxBin      = config.get('gmx', 'gmx')
-gmxBin_d    = config.get('gmx', 'gmx_d')
-gmxBinDir   = config.get('gmx', 'GMXBINDIR')
+##
+##  Startup profile (gmxfe --profile-startup): time marks of the startup phases
+##
+startup_marks = [('start', time.perf_counter())]
+def startup_mark(phase: str):
+    startup_marks.append((phase, time.perf_counter()))
+def startup_report():
+    lines = ['Startup profile (ms):']
+    for (_, t0), (phase, t1) in zip(startup_marks, startup_marks[1:]):
+        lines.append(f'  {phase:<32s} {1000*(t1 - t0):9.1f}')
+    lines.append(f'  {"total":<32s} {1000*(startup_marks[-1][1] - startup_marks[0][1]):9.1f}')
+    return '\n'.join(lines)
 
-import toml
 # Read/Write TOML config  https://towardsdatascience.com/managing-deep-learning-models-easily-with-toml-configurations-fb680b9deabe#:~:text=The%20concept%20of%20a%20TOML,there%20are%20multiple%20nested%20levels.
 # YAML format verificator: https://yaml-online-parser.appspot.com/
 def load_global_config( filepath : str = 'config_gmxpy.toml' ):
+    import toml
     import munch
     return munch.munchify( toml.load( filepath ) )
 def save_global_config( new_config , filepath : str = 'project_config.toml' ):
+    import toml
     with open( filepath , 'w' ) as file:
         toml.dump( new_config , file )
+
+##
+##  Snapshot of the processed config: the state set by configure.ProcessConfig saved as JSON next to the TOML
+##  (".<config name>.snapshot"), valid while the TOML content, the working dir and $CONDA_PREFIX are the same
+##
+SNAPSHOT_FORMAT = 2
+def config_snapshot_path(cfgPath: str):
+    return os.path.join(os.path.dirname(cfgPath), '.' + os.path.basename(cfgPath) + '.snapshot')
+def config_snapshot_key(cfgPath: str):
+    import hashlib
+    h = hashlib.sha256()
+    with open(cfgPath, 'rb') as f:
+        h.update(f.read())
+    h.update(f'\0{os.getcwd()}\0{gmxdir}\0{SNAPSHOT_FORMAT}'.encode('utf-8'))
+    return h.hexdigest()
+def load_config_snapshot(path: str, key: str):
+    import json
+    try:
+        with open(path, 'r') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:       # truncated or written by an incompatible version
+        logging.debug(f'Config snapshot {path} is not readable: {e}')
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('key') != key or not isinstance(snapshot.get('state'), dict):
+        return None
+    import munch
+    return munch.munchify(snapshot['state'])     # the config tables are Munch as returned by load_global_config
+def save_config_snapshot(path: str, key: str, state: dict):
+    import json
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'state': state}, f)
+        os.replace(tmp, path)
+    except (OSError, TypeError, ValueError) as e:
+        logging.debug(f'Config snapshot {path} is not written: {e}')
+        if os.path.exists(tmp): os.remove(tmp)
 #############################################
 
 ##
@@ -51,14 +95,11 @@ class configure:
     def __init__(self):
         #self.sPhase = 'Example'
 
-        if tmpdir_env:
-            self.sTmpDir = tmpdir_env
-        elif tmpdir_conf and os.path.exists(tmpdir_conf):
-            self.sTmpDir = tmpdir_conf
-        else:
-            self.sTmpDir = tempfile.gettempdir()
+        self.sTmpDir = tmpdir_env or ''       # default: tempfile.gettempdir() resolved in Init
 
         self.TaskNm = 'Test'
+        self.sGmx   = ''                       # gmx command: --gmx or paths.gmx of the config
+        self.sGmx_d = ''                       # double precision gmx command, default: sGmx
         self.TopDir  = os.path.abspath('INPUT/TOP')
         self.MdpDir  = os.path.abspath('INPUT/MDP')
         self.runFile = os.path.abspath('INPUT/runList.txt')
@@ -78,6 +119,13 @@ class configure:
         self.SolvCoor = ''
         self.BoxSize = ''
         self.Lines = []
+        self.bSingleMdp = False
+        self.bMdpLinks = False                 # hard-link identical MDPs of the jobs to <OutDir>/.mdp
+        self.sStage = 'copy'                   # staging of the TopDir inputs into job dirs, see utils.stage
+        self._sGmxVersion = None               # probed on first use, see sGmxVersion
+        self.BoxCacheDir = None                 # default_cache_dir(), '' disables the cache of prepared system boxes
+        self.BoxCacheSize = 2048                # MB
+        self.MdpLayers = {}                     # Phase -> Task -> merged mdp parameters, set by ProcessConfig
 
             
     ##
@@ -94,6 +142,9 @@ class configure:
         if args.lines and (args.beginline or args.endline):
             logging.error(f'--lines and --beginline|--endline are mutually exclusive options')
             sys.exit()
+        if getattr(args, 'dag', False) and (getattr(args, 'replex', 0) or getattr(args, 'pack', 1) > 1):
+            logging.error(f'--dag is not used with --replex and --pack. Exit!')
+            sys.exit(0)
         if args.queue == 'none' and hasattr(args, 'partition'):
             logging.error(f'The option --partition is used only with --queue (slurm|pbs|sge) but ignored with --queue=none')
             logging.error(f'Ignore the option --partition')
@@ -107,13 +158,26 @@ class configure:
         if not os.path.isfile(cfgPath):
             logging.error(f'The config {cfgPath} is not found. Exit!')
             sys.exit(0)
-        logging.info(f'Loading config: {cfgPath}')
-        cfg = load_global_config(cfgPath)
-        print('type(config): ', type(cfg))
-        # print( toml.load( "config_gmxpy.toml" ) )
-        #print( cfg.molsys1.LigTitle )
-        #args.gmxconfig = cfg
-        self.ProcessConfig(cfg, cfgPath)
+        snapshotPath, snapshotKey = config_snapshot_path(cfgPath), config_snapshot_key(cfgPath)
+        state = load_config_snapshot(snapshotPath, snapshotKey)
+        if state is not None:
+            logging.info(f'Loading config: {cfgPath} (snapshot {snapshotPath})')
+            self.__dict__.update(state)
+            startup_mark('config snapshot load')
+        else:
+            logging.info(f'Loading config: {cfgPath}')
+            cfg = load_global_config(cfgPath)
+            startup_mark('config load')
+            # print( toml.load( "config_gmxpy.toml" ) )
+            #print( cfg.molsys1.LigTitle )
+            #args.gmxconfig = cfg
+            defaults = dict(vars(self))
+            self.ProcessConfig(cfg, cfgPath)
+            # Attributes assigned by ProcessConfig are the snapshot
+            _unset = object()
+            save_config_snapshot(snapshotPath, snapshotKey,
+                                 {k: v for k, v in vars(self).items() if defaults.get(k, _unset) is not v})
+            startup_mark('config validation')
         #logging.info(f'Config: {cfg}')
     ##
     ## 1. SETUP config parameters
@@ -129,7 +193,6 @@ class configure:
            logging.error('The mandatotory parameter - gmx executable command is not definded. Exit!')
            sys.exit(0)
         logging.info(f'gmx executable command: \"{self.sGmx}\"')
-        check_gmx(self.sGmx  , logging)
 
         if hasattr(args, 'gmx_d') and args.gmx_d:
             if os.path.isfile(args.gmx_d):
@@ -142,7 +205,7 @@ class configure:
             logging.warning('The double precision gmx executable command is not defined. Will use the single precision executable for minimization (not recommended)')
             self.sGmx_d = self.sGmx
         logging.info(f'gmx double precision executable command: \"{self.sGmx_d}\"')
-        check_gmx(self.sGmx_d, logging)
+        # The binaries are probed on first use of sGmxVersion (see check_binaries)
 
         if hasattr(args, 'queue') and args.queue:
             self.queue = args.queue
@@ -186,7 +249,38 @@ class configure:
             logging.info(f'SolvCoor = {self.SolvCoor}')
         if hasattr(args, 'boxsize') and args.boxsize: self.BoxSize = args.boxsize
         if hasattr(args, 'lines') and args.lines: self.Lines = args.lines
+        if hasattr(args, 'single_mdp') and args.single_mdp: self.bSingleMdp = True
+        if hasattr(args, 'mdp_links') and args.mdp_links: self.bMdpLinks = True
+        if hasattr(args, 'stage') and args.stage: self.sStage = args.stage
+        if hasattr(args, 'boxcache') and args.boxcache:
+            self.BoxCacheDir = '' if args.boxcache == 'none' else os.path.abspath(args.boxcache)
+        if hasattr(args, 'boxcache_size') and args.boxcache_size: self.BoxCacheSize = args.boxcache_size
         if hasattr(args, 'verbose') and args.verbose: self.bVerbose = True
+        if not self.sTmpDir:
+            import tempfile
+            self.sTmpDir = tempfile.gettempdir()
+        if self.BoxCacheDir is None:
+            from .boxcache import default_cache_dir
+            self.BoxCacheDir = default_cache_dir()
+        startup_mark('config init')
+
+    def check_binaries(self):
+        """
+        Probe the gmx and gmx_d binaries (cached across invocations, see utils.gmxrun)
+
+        :return: gmx version
+        """
+        from .mdsetup import check_gmx
+        self._sGmxVersion = check_gmx(self.sGmx, logging)
+        if self.sGmx_d != self.sGmx: check_gmx(self.sGmx_d, logging)
+        startup_mark('gmx probe')
+        return self._sGmxVersion
+
+    @property
+    def sGmxVersion(self):
+        if self._sGmxVersion is None:
+            self.check_binaries()
+        return self._sGmxVersion
 
 
     ##
@@ -233,8 +327,8 @@ class configure:
             workflow = val.get('workflow')
             if workflow and len(workflow)>0:
                 usedTasks.update(workflow)
-            print(f'Phase.{key}.workflow = {workflow}')
-        print(f'all Tasks: {usedTasks}') # Print list of Tasks found in workflows in all phase definitions
+            logging.debug(f'Phase.{key}.workflow = {workflow}')
+        logging.debug(f'all Tasks: {usedTasks}') # Print list of Tasks found in workflows in all phase definitions
 
         ##
         ## 2) Read mandotory section Task
@@ -263,6 +357,19 @@ class configure:
                     sys.exit(0)
         self.Task = Task
 
+        ##
+        ## Merged mdp parameters of the (Phase, Task) pairs: common, Phase, Task and Phase+Task specific layers,
+        ## later layers override earlier ones. They depend only on the config and are a part of the snapshot
+        ##
+        from utils.mdp import merge_layers
+        mdp_common = Task['DEFAULT'].get('mdp','')
+        self.MdpLayers = {}
+        for key, val in Phase.items():
+            if key in {'workflow','mdp'} or not val: continue
+            mdp_phase = val.get('mdp','')
+            self.MdpLayers[key] = {task: dict(merge_layers(mdp_common, mdp_phase, Task.get(task,'').get('mdp',''),
+                                                            mdp_phase.get(task,'') if mdp_phase else '').values())
+                                   for task in val.get('workflow','')}
 
         # ##
         # ## 2) Read and Diagnostics of mdp.Task definitions -> re-defined in the Task-section
@@ -309,6 +416,8 @@ class configure:
         if 'SysList' in paths and paths['SysList']: self.sSysList = os.path.abspath(paths['SysList'])
         if 'TIdir'   in paths and paths['TIdir']  : self.sTIdir   = paths['TIdir']
         if 'outnm'   in paths and paths['outnm']  : self.sOutnm   = paths['outnm']
+        if 'BoxCache' in paths:
+            self.BoxCacheDir = os.path.abspath(paths['BoxCache']) if paths['BoxCache'] and paths['BoxCache'] != 'none' else ''
 
         if 'lambdas' in cfg and cfg['lambdas']: self.RunTIstates = cfg['lambdas']
         if 'solvcoor' in cfg and cfg['solvcoor']: self.SolvCoor = cfg['solvcoor']
@@ -0,0 +1,663 @@
+# Created 2024
+"""
+Free energy analysis of TI simulations: dhdl.xvg files of the lambda windows
+of a job dir are parsed in a single pass into NumPy arrays and the free energy
+difference is estimated by TI (trapezoid and natural cubic spline), BAR and MBAR.
+The module requires NumPy and is imported only by the "analyze" command.
+"""
+import bisect
+import fcntl
+import glob
+import json
+import logging
+import math
+import os
+import re
+
+import numpy as np
+
+R_KJ = 0.0083144626     # gas constant, kJ/(mol K)
+KCAL = 4.184            # kJ per kcal
+
+_re_legend   = re.compile(r'^@\s*s([0-9]+)\s+legend\s+"(.*)"')
+_re_subtitle = re.compile(r'^@\s*subtitle\s+"(.*)"')
+_re_temp     = re.compile(r'T\s*=\s*([0-9.eE+-]+)\s*\(K\)')
+_re_state    = re.compile(r'state\s+([0-9]+)')
+_re_dhdl     = re.compile(r'dH/d\\xl\\f\{\}\s*(\S+)\s*=\s*(\S+)')
+_re_foreign  = re.compile(r'\\xD\\f\{\}H\s*\\xl\\f\{\}\s*to\s*\(?([^)]*)\)?')
+_re_task     = re.compile(r'Task:\s*(\S+)\s*#')
+_re_mdp      = re.compile(r'\s-f\s+(\S+)')
+
+
+##
+##  Parsing of dhdl.xvg
+##
+def _floats(text):
+    return tuple(float(v) for v in text.replace(',', ' ').split())
+
+
+def parse_header(lines):
+    """
+    Parse xvg header lines of gmx mdrun -dhdl output
+
+    :param lines: "#" and "@" lines of the xvg file
+    :return: dict with temperature "T", lambda "state" index, "vector" of the state and
+             column indices (0 - time): "dhdl_cols" with "components" names and "dhdl_lambdas",
+             "foreign_cols" with their target lambda vectors "foreign", "pv_col"
+    """
+    meta = {'T': None, 'state': None, 'vector': None, 'components': [], 'dhdl_cols': [],
+            'dhdl_lambdas': [], 'foreign_cols': [], 'foreign': [], 'pv_col': None}
+    for line in lines:
+        m = _re_subtitle.match(line)
+        if m:
+            sub = m.group(1)
+            t = _re_temp.search(sub)
+            if t: meta['T'] = float(t.group(1))
+            s = _re_state.search(sub)
+            if s: meta['state'] = int(s.group(1))
+            if '=' in sub.split(')', 1)[-1]:
+                meta['vector'] = _floats(sub.rsplit('=', 1)[1].strip(' ()'))
+            continue
+        m = _re_legend.match(line)
+        if not m: continue
+        col, legend = int(m.group(1)) + 1, m.group(2)
+        d = _re_dhdl.search(legend)
+        f = _re_foreign.search(legend)
+        if d:
+            meta['dhdl_cols'].append(col)
+            meta['components'].append(d.group(1))
+            meta['dhdl_lambdas'].append(float(d.group(2)))
+        elif f:
+            meta['foreign_cols'].append(col)
+            meta['foreign'].append(_floats(f.group(1)))
+        elif legend.startswith('pV'):
+            meta['pv_col'] = col
+    if meta['vector'] is None and meta['dhdl_lambdas']:
+        meta['vector'] = tuple(meta['dhdl_lambdas'])
+    return meta
+
+
+def _data_lines(f, header):
+    # Single pass over the file: header lines are collected, complete data lines are yielded
+    for line in f:
+        if line[0] in '#@':
+            header.append(line)
+        elif line.endswith('\n'):     # the last line of a running simulation may be incomplete
+            yield line
+
+
+def read_xvg(path):
+    """
+    Stream-parse xvg file
+
+    :param path: xvg file
+    :return: (meta, data) - header dict of parse_header and 2D float array of the data rows
+    """
+    header = []
+    with open(path, 'r') as f:
+        data = np.loadtxt(_data_lines(f, header), ndmin=2)
+    return parse_header(header), data
+
+
+##
+##  Binary cache of the parsed data: <stem>.bin with raw float64 rows next to the xvg and
+##  <stem>.meta.json with the parsed header, the number of columns and the source file state
+##  (size, mtime and the byte offset of the parsed part). Growing xvg files of running
+##  simulations are parsed incrementally from the offset and the new rows are appended.
+##
+CACHE_VERSION = 1
+_HEAD_BYTES = 256       # prefix of the source kept to detect a rewritten xvg
+_CHUNK = 64 << 20       # bytes of the source parsed at once
+
+
+def cache_paths(path):
+    stem = os.path.splitext(path)[0]
+    return stem + '.bin', stem + '.meta.json'
+
+
+def _read_cache_meta(meta_path):
+    try:
+        with open(meta_path, 'r') as f:
+            cmeta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return cmeta if cmeta.get('version') == CACHE_VERSION else None
+
+
+def _convert(f, start, stop, fbin, header, ncols=None):
+    """
+    Parse the complete lines of the source bytes [start, stop) in chunks and append the rows to fbin
+
+    :return: (offset after the last parsed line, number of rows, number of columns)
+    """
+    f.seek(start)
+    offset, rest, nrows = start, b'', 0
+    remaining = stop - start
+    while remaining > 0:
+        data = f.read(min(_CHUNK, remaining))
+        if not data: break
+        remaining -= len(data)
+        buf = rest + data
+        end = buf.rfind(b'\n') + 1
+        rest = buf[end:]
+        if not end: continue
+        offset += end
+        lines = []
+        for line in buf[:end].decode('utf-8').splitlines():
+            if not line.strip(): continue
+            if line[0] in '#@': header.append(line)
+            else:                lines.append(line)
+        if not lines: continue
+        rows = np.loadtxt(lines, ndmin=2)
+        if ncols is None: ncols = rows.shape[1]
+        if rows.shape[1] != ncols:
+            raise ValueError(f'Inconsistent number of columns in {f.name}')
+        rows.astype('<f8').tofile(fbin)
+        nrows += len(rows)
+    return offset, nrows, ncols
+
+
+def update_cache(path):
+    """
+    Convert the xvg to the binary cache or append the rows written since the last update
+
+    :param path: xvg file
+    :return: cache meta dict
+    """
+    bin_path, meta_path = cache_paths(path)
+    with open(bin_path, 'ab') as fbin:
+        fcntl.flock(fbin, fcntl.LOCK_EX)        # one updater at a time, readers don't lock
+        st = os.stat(path)
+        cmeta = _read_cache_meta(meta_path)
+        if cmeta and cmeta['size'] == st.st_size and cmeta['mtime_ns'] == st.st_mtime_ns:
+            return cmeta
+        with open(path, 'rb') as f:
+            head = f.read(_HEAD_BYTES)
+            if (cmeta is None or not cmeta['nrows'] or st.st_size < cmeta['offset']
+                    or head[:len(cmeta['head'])] != cmeta['head'].encode('latin-1')
+                    or os.fstat(fbin.fileno()).st_size != 8 * cmeta['ncols'] * cmeta['nrows']):
+                # new, rewritten or still empty source (or interrupted update): full conversion
+                fbin.truncate(0)
+                header = []
+                offset, nrows, ncols = _convert(f, 0, st.st_size, fbin, header)
+                cmeta = {'version': CACHE_VERSION, 'header': parse_header(header), 'ncols': ncols or 0,
+                         'nrows': nrows, 'offset': offset, 'head': head.decode('latin-1')}
+            else:
+                offset, nrows, _ = _convert(f, cmeta['offset'], st.st_size, fbin, [], cmeta['ncols'])
+                cmeta['offset'] = offset
+                cmeta['nrows'] += nrows
+        cmeta['size'], cmeta['mtime_ns'] = st.st_size, st.st_mtime_ns
+        tmp = f'{meta_path}.tmp.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(cmeta, f)
+        os.replace(tmp, meta_path)
+    return cmeta
+
+
+class _TimeColumn:
+    # time column of the memory-mapped rows for bisect: only the probed rows are read from the disk
+    def __init__(self, rows): self.rows = rows
+    def __len__(self): return len(self.rows)
+    def __getitem__(self, i): return self.rows[i, 0]
+
+
+def read_dhdl(path, begin=0.0, cache=True):
+    """
+    Read dhdl.xvg data from the time begin, via the binary cache if it's possible
+
+    :param  path: xvg file
+    :param begin: time (ps) of the first sample
+    :param cache: use the binary cache
+    :return: (meta, data) as read_xvg, data is a memory-mapped slice with the cache
+    """
+    if cache:
+        try:
+            cmeta = update_cache(path)
+        except OSError as e:     # e.g. read-only job dir
+            logging.debug(f'Binary cache of {path} is not used: {e}')
+        else:
+            meta = cmeta['header']
+            if not cmeta['nrows']: return meta, np.zeros((0, cmeta['ncols']))
+            rows = np.memmap(cache_paths(path)[0], dtype='<f8', mode='r', shape=(cmeta['nrows'], cmeta['ncols']))
+            return meta, rows[bisect.bisect_left(_TimeColumn(rows), begin):] if begin else rows
+    meta, data = read_xvg(path)
+    if begin: data = data[int(np.searchsorted(data[:, 0], begin)):]
+    return meta, data
+
+
+class Window:
+    """
+    Samples of one lambda window
+    """
+
+    def __init__(self, meta, data, path='', lam=None):
+        self.path = path
+        self.lam  = lam
+        self.meta = meta
+        self.T      = meta['T']
+        self.state  = meta['state'] if meta['state'] is not None else lam
+        self.vector = tuple(meta['vector'] or ())
+        self.time   = data[:, 0] if len(data) else np.zeros(0)
+        self.dhdl   = data[:, meta['dhdl_cols']] if len(data) else np.zeros((0, len(meta['dhdl_cols'])))
+        self.dH     = data[:, meta['foreign_cols']] if len(data) else np.zeros((0, len(meta['foreign_cols'])))
+
+    def after(self, begin):
+        """
+        :param begin: time (ps) of the first sample to keep (equilibration cutoff)
+        :return: Window with the samples from time >= begin
+        """
+        i = int(np.searchsorted(self.time, begin)) if begin else 0
+        w = Window.__new__(Window)
+        w.__dict__.update(self.__dict__)
+        w.time, w.dhdl, w.dH = self.time[i:], self.dhdl[i:], self.dH[i:]
+        return w
+
+    def __len__(self):
+        return len(self.time)
+
+
+##
+##  Location of the lambda windows of a job dir
+##
+def job_scripts(job_dir):
+    """
+    Parse the TI point scripts of the job dir
+
+    :param job_dir: job directory
+    :return: list of dicts with the "script" name, "subdir", "lambda" number and
+             "tasks": list of (Task, MDP file name) in the workflow order
+    """
+    scripts = []
+    for path in glob.glob(os.path.join(job_dir, 'runjob*.qsh')):
+        info = {'script': os.path.basename(path), 'subdir': None, 'lambda': None, 'tasks': []}
+        with open(path, 'r') as f:
+            for line in f:
+                if line.startswith('subdir='):   info['subdir'] = line.split('=', 1)[1].strip()
+                elif line.startswith('lambda='): info['lambda'] = int(line.split('=', 1)[1])
+                elif ' grompp ' in line and info['tasks']:
+                    m = _re_mdp.search(line)
+                    if m: info['tasks'][-1] = (info['tasks'][-1][0], m.group(1))
+                else:
+                    m = _re_task.search(line)
+                    if m: info['tasks'].append((m.group(1), None))
+        if info['subdir'] is not None and info['lambda'] is not None and info['tasks']:
+            scripts.append(info)
+    return sorted(scripts, key=lambda i: i['lambda'])
+
+
+def find_windows(job_dir, task=None):
+    """
+    Find dhdl.xvg of the lambda windows from the TI point scripts of the job dir:
+    the "subdir=" and "lambda=" lines and the last "Task:" header (the production run)
+
+    :param job_dir: job directory
+    :param    task: Task dir to analyze (default: the last Task of the workflow)
+    :return: list of (lambda number, dhdl.xvg path) ordered by lambda
+    """
+    windows = [(i['lambda'], os.path.join(job_dir, task or i['tasks'][-1][0], i['subdir'], 'dhdl.xvg'))
+               for i in job_scripts(job_dir)]
+    if not windows:
+        logging.warning(f'No TI point scripts (runjob*.qsh) are found in {job_dir}')
+    return windows
+
+
+def find_job_dirs(outdir):
+    """
+    :param outdir: output directory
+    :return: job dirs with TI point scripts
+    """
+    return sorted({os.path.dirname(p) for p in glob.glob(os.path.join(outdir, '*', 'runjob*.qsh'))})
+
+
+##
+##  Statistics
+##
+def block_sem(x, nblocks=5):
+    """
+    Standard error of the mean by block averaging
+
+    :param       x: samples along the first axis
+    :param nblocks: number of blocks
+    :return: SEM (array for 2D x)
+    """
+    n = len(x) // nblocks
+    if nblocks < 2 or n < 1:
+        return np.full(x.shape[1:], np.nan)
+    means = x[:n * nblocks].reshape((nblocks, n) + x.shape[1:]).mean(axis=1)
+    return means.std(axis=0, ddof=1) / math.sqrt(nblocks)
+
+
+def statistical_inefficiency(x):
+    """
+    :param x: time series
+    :return: g = 1 + 2 * integrated autocorrelation time (in samples)
+    """
+    n = len(x)
+    x = np.asarray(x, dtype=float) - np.mean(x)
+    var = x.var()
+    if n < 3 or var == 0: return 1.0
+    f = np.fft.rfft(x, 2 * n)
+    acf = np.fft.irfft(f * np.conj(f))[:n] / (var * np.arange(n, 0, -1))
+    neg = np.nonzero(acf[1:] <= 0)[0]
+    cut = neg[0] + 1 if len(neg) else n
+    t = np.arange(1, cut)
+    return max(1.0, 1.0 + 2.0 * np.sum((1.0 - t / n) * acf[1:cut]))
+
+
+def subsample(w: Window):
+    """
+    Keep uncorrelated samples of the window for BAR/MBAR, the stride is the statistical inefficiency of dH/dl
+    """
+    series = w.dhdl.sum(axis=1) if w.dhdl.shape[1] else (w.dH[:, 0] if w.dH.shape[1] else w.time)
+    stride = int(math.ceil(statistical_inefficiency(series)))
+    return w.dH[::stride]
+
+
+def _logsumexp(a, axis):
+    m = np.max(a, axis=axis, keepdims=True)
+    return np.squeeze(m, axis=axis) + np.log(np.sum(np.exp(a - m), axis=axis))
+
+
+def _fermi(x):
+    return 0.5 * (1.0 - np.tanh(0.5 * x))     # 1/(1+exp(x)) without overflow
+
+
+##
+##  Estimators. TI works in kJ/mol, BAR and MBAR in kT.
+##
+def trapezoid_weights(x):
+    h = np.diff(x)
+    w = np.zeros(len(x))
+    w[:-1] += h / 2
+    w[1:]  += h / 2
+    return w
+
+
+def spline_second_derivatives(x):
+    """
+    Second derivatives of the natural cubic spline through the points x
+
+    :return: matrix M, the second derivatives at x are M @ y
+    """
+    n = len(x)
+    h = np.diff(x)
+    A = np.zeros((n - 2, n - 2))
+    D = np.zeros((n - 2, n))
+    for i in range(1, n - 1):
+        r = i - 1
+        A[r, r] = 2 * (h[i - 1] + h[i])
+        if r > 0:     A[r, r - 1] = h[i - 1]
+        if r < n - 3: A[r, r + 1] = h[i]
+        D[r, i - 1] = 6 / h[i - 1]
+        D[r, i]     = -6 / h[i - 1] - 6 / h[i]
+        D[r, i + 1] = 6 / h[i]
+    M = np.zeros((n, n))
+    if n > 2: M[1:-1] = np.linalg.solve(A, D)
+    return M
+
+
+def cubic_weights(x):
+    """
+    Integration weights of the natural cubic spline through the points x: integral = sum(w * y)
+    """
+    if len(x) < 3: return trapezoid_weights(x)
+    h = np.diff(x)
+    c = np.zeros(len(x))
+    c[:-1] += h ** 3 / 24
+    c[1:]  += h ** 3 / 24
+    return trapezoid_weights(x) - c @ spline_second_derivatives(x)
+
+
+def ti_integrate(lams, means, sems, method='trapezoid', components=None):
+    """
+    Integrate <dH/dl> over each lambda component along the windows
+
+    :param       lams: lambda values of the dH/dl components, windows x components
+    :param      means: <dH/dl>, windows x components
+    :param       sems: errors of <dH/dl>, windows x components
+    :param     method: "trapezoid" or "cubic"
+    :param components: component names for diagnostics
+    :return: (dG, error) in kJ/mol
+    """
+    lams, means, sems = np.asarray(lams), np.asarray(means), np.asarray(sems)
+    dG, var = 0.0, 0.0
+    for c in range(lams.shape[1]):
+        x = lams[:, c]
+        changes = np.nonzero(np.diff(x))[0]
+        if not len(changes): continue
+        a, b = changes[0], changes[-1] + 2       # the component changes within windows [a, b)
+        weights = np.zeros(len(x))
+        if method == 'cubic' and np.all(np.diff(x[a:b]) != 0):
+            weights[a:b] = cubic_weights(x[a:b])
+        else:
+            if method == 'cubic':
+                logging.warning(f'Lambda component {components[c] if components else c} is not monotonic, '
+                                f'trapezoid rule is used instead of cubic spline')
+            weights = trapezoid_weights(x)
+        dG  += np.sum(weights * means[:, c])
+        var += np.sum(weights ** 2 * sems[:, c] ** 2)
+    return dG, math.sqrt(var)
+
+
+def ti(windows, nblocks=5, method='trapezoid'):
+    """
+    Thermodynamic integration of <dH/dl> over each lambda component
+
+    :return: (dG, error) in kJ/mol
+    """
+    return ti_integrate([w.meta['dhdl_lambdas'] for w in windows],
+                        [w.dhdl.mean(axis=0) for w in windows],
+                        [block_sem(w.dhdl, nblocks) for w in windows],
+                        method, windows[0].meta['components'])
+
+
+def _state_index(windows):
+    # lambda vector (as printed by gmx) -> index of the sampled state
+    return {tuple(round(v, 4) for v in w.vector): k for k, w in enumerate(windows)}
+
+
+def _foreign_index(w: Window, index):
+    # column of dH for each sampled state, -1 if the state is not computed in the window
+    cols = np.full(len(index), -1)
+    for col, vec in enumerate(w.meta['foreign']):
+        k = index.get(tuple(round(v, 4) for v in vec))
+        if k is not None: cols[k] = col
+    return cols
+
+
+def bar_pair(w_F, w_R, tol=1e-10):
+    """
+    Bennett acceptance ratio between two states
+
+    :param w_F: reduced work forward (samples of state 0: u1 - u0)
+    :param w_R: reduced work backward (samples of state 1: u0 - u1)
+    :return: (df, variance) in kT
+    """
+    M = math.log(len(w_F) / len(w_R))
+    def balance(df):
+        return np.sum(_fermi(M + w_F - df)) - np.sum(_fermi(-M + w_R + df))
+    guess = 0.5 * (np.mean(w_F) - np.mean(w_R))
+    lo, hi, step = guess - 1.0, guess + 1.0, 1.0
+    while balance(lo) > 0: step *= 2; lo -= step
+    while balance(hi) < 0: step *= 2; hi += step
+    while hi - lo > tol:
+        mid = 0.5 * (lo + hi)
+        if balance(mid) < 0: lo = mid
+        else:                hi = mid
+    df = 0.5 * (lo + hi)
+    C = M - df
+    fF, fR = _fermi(w_F + C), _fermi(w_R - C)
+    var = np.var(fF) / len(w_F) / np.mean(fF) ** 2 + np.var(fR) / len(w_R) / np.mean(fR) ** 2
+    return df, var
+
+
+def bar(windows, samples):
+    """
+    BAR between adjacent windows
+
+    :param samples: dH arrays (kJ/mol) of uncorrelated samples of each window
+    :return: (df, error, df of each pair of windows) in kT, None if the neighbour energies are not in the dhdl files
+    """
+    index = _state_index(windows)
+    steps, var = [], 0.0
+    for i in range(len(windows) - 1):
+        beta0, beta1 = 1 / (R_KJ * windows[i].T), 1 / (R_KJ * windows[i + 1].T)
+        fwd = _foreign_index(windows[i], index)[i + 1]
+        rev = _foreign_index(windows[i + 1], index)[i]
+        if fwd < 0 or rev < 0: return None
+        d, v = bar_pair(beta0 * samples[i][:, fwd], beta1 * samples[i + 1][:, rev])
+        steps.append(d)
+        var += v
+    return sum(steps), math.sqrt(var), steps
+
+
+def mbar(windows, samples, f_init=None, tol=1e-8, maxiter=10000):
+    """
+    MBAR by self-consistent iteration, the covariance of the free energies by the SVD of the weight matrix
+
+    :param samples: dH arrays (kJ/mol) of uncorrelated samples of each window
+    :param  f_init: initial reduced free energies (e.g. cumulative BAR)
+    :return: (df, error) between the end states in kT, None if energies of all states are not in the dhdl files
+    """
+    index = _state_index(windows)
+    K = len(windows)
+    N_k = np.array([len(s) for s in samples], dtype=float)
+    u = []
+    for w, s in zip(windows, samples):
+        cols = _foreign_index(w, index)
+        if np.any(cols < 0): return None       # calc-lambda-neighbors = -1 is needed
+        u.append(s[:, cols].T / (R_KJ * w.T))
+    u = np.concatenate(u, axis=1)               # u[k, n]: reduced energy of sample n in state k
+    log_N = np.log(N_k)
+    f = np.array(f_init, dtype=float) if f_init is not None else np.zeros(K)
+    for _ in range(maxiter):
+        log_den = _logsumexp(log_N[:, None] + f[:, None] - u, axis=0)
+        f_new = -_logsumexp(-u - log_den, axis=1)
+        f_new -= f_new[0]
+        converged = np.max(np.abs(f_new - f)) < tol
+        f = f_new
+        if converged: break
+    else:
+        logging.warning(f'MBAR did not converge in {maxiter} iterations')
+    log_den = _logsumexp(log_N[:, None] + f[:, None] - u, axis=0)
+    W = np.exp(f[:, None] - u - log_den).T      # N x K
+    _, S, Vt = np.linalg.svd(W, full_matrices=False)
+    V, S = Vt.T, np.diag(S)
+    inner = np.eye(K) - S @ V.T @ np.diag(N_k) @ V @ S
+    Theta = V @ S @ np.linalg.pinv(inner) @ S @ V.T
+    var = Theta[0, 0] + Theta[-1, -1] - 2 * Theta[0, -1]
+    return f[-1] - f[0], math.sqrt(max(var, 0.0))
+
+
+##
+##  Analysis of a job dir
+##
+def path_order(w: Window):
+    # Order of the windows along the alchemical path. Lambda state indices of the windows are
+    # not comparable after the grid refinement, lambda components grow monotonically along the path
+    return sum(w.vector), w.vector
+
+
+def load_windows(job_dir, task=None, begin=0.0, temperature=None, cache=True):
+    """
+    :return: list of Window ordered by lambda state
+    """
+    windows = []
+    for lam, path in find_windows(job_dir, task):
+        if not os.path.isfile(path):
+            logging.warning(f'{path} does not exist, the lambda window {lam} is skipped')
+            continue
+        meta, data = read_dhdl(path, begin, cache)
+        w = Window(meta, data, path, lam)
+        if temperature: w.T = temperature
+        if not w.T: raise ValueError(f'Temperature is not found in {path}, use --temperature')
+        if len(w) < 2: raise ValueError(f'{path} has less than 2 samples after {begin} ps')
+        windows.append(w)
+    windows.sort(key=path_order)
+    return windows
+
+
+def analyze_job(job_dir, task=None, begin=0.0, nblocks=5, temperature=None, estimators=('TI', 'TI-cubic', 'BAR', 'MBAR'),
+                cache=True):
+    """
+    Estimate the free energy difference between the end states of the job's lambda windows
+
+    :param     job_dir: job directory
+    :param        task: Task dir to analyze (default: the last Task of the workflow)
+    :param       begin: equilibration cutoff, ps
+    :param     nblocks: number of blocks for the block-average errors of TI
+    :param temperature: temperature, K (default: from the dhdl.xvg)
+    :param  estimators: estimators to compute
+    :param       cache: read dhdl.xvg via the binary cache
+    :return: dict with "job_dir", "T", "windows" and estimator -> (dG, error) in kJ/mol
+    """
+    windows = load_windows(job_dir, task, begin, temperature, cache)
+    result = {'job_dir': job_dir, 'windows': len(windows), 'T': windows[0].T if windows else None}
+    if len(windows) < 2:
+        logging.warning(f'Less than 2 lambda windows are found in {job_dir}')
+        return result
+    RT = R_KJ * windows[0].T
+    if 'TI' in estimators:       result['TI'] = ti(windows, nblocks, 'trapezoid')
+    if 'TI-cubic' in estimators: result['TI-cubic'] = ti(windows, nblocks, 'cubic')
+    if 'BAR' in estimators or 'MBAR' in estimators:
+        samples = [subsample(w) for w in windows]
+        res_bar = bar(windows, samples)
+        if res_bar is None:
+            logging.warning(f'{job_dir}: dhdl files have no energies of the neighbour lambda states, BAR/MBAR are skipped')
+        else:
+            if 'BAR' in estimators: result['BAR'] = (res_bar[0] * RT, res_bar[1] * RT)
+            if 'MBAR' in estimators:
+                res_mbar = mbar(windows, samples, np.concatenate([[0.0], np.cumsum(res_bar[2])]))
+                if res_mbar is None:
+                    logging.warning(f'{job_dir}: dhdl files have no energies of all lambda states '
+                                    f'(calc-lambda-neighbors = -1), MBAR is skipped')
+                else:
+                    result['MBAR'] = (res_mbar[0] * RT, res_mbar[1] * RT)
+    return result
+
+
+def _analyze_job(kwargs):
+    try:
+        return analyze_job(**kwargs)
+    except (OSError, ValueError) as e:
+        logging.error(f'Analysis of {kwargs["job_dir"]} failed: {e}')
+        return {'job_dir': kwargs['job_dir'], 'error': str(e)}
+
+
+def analyze_jobs(job_dirs, nworkers=1, **kwargs):
+    """
+    Analyze job dirs (e.g. ligands) in parallel worker processes
+
+    :return: list of analyze_job results in the order of job_dirs
+    """
+    tasks = [dict(kwargs, job_dir=d) for d in job_dirs]
+    if nworkers > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(nworkers, len(tasks))) as pool:
+            return list(pool.map(_analyze_job, tasks))
+    return [_analyze_job(t) for t in tasks]
+
+
+def convert(value, T, units):
+    # kJ/mol -> units
+    if units == 'kcal': return value / KCAL
+    if units == 'kT':   return value / (R_KJ * T)
+    return value
+
+
+def format_results(results, units='kJ', estimators=('TI', 'TI-cubic', 'BAR', 'MBAR')):
+    unit = {'kJ': 'kJ/mol', 'kcal': 'kcal/mol', 'kT': 'kT'}[units]
+    lines = [f'{"JOB":<40s}' + ''.join(f'{e:>24s}' for e in estimators) + f'   ({unit})']
+    for r in results:
+        row = f'{os.path.basename(r["job_dir"].rstrip(os.sep)):<40s}'
+        if 'error' in r:
+            lines.append(row + '  ERROR: ' + r['error'])
+            continue
+        for e in estimators:
+            if e in r:
+                dG, err = (convert(v, r['T'], units) for v in r[e])
+                row += f'{dG:>14.3f} +- {err:<6.3f}'
+            else:
+                row += f'{"-":>24s}'
+        lines.append(row)
+    return '\n'.join(lines)
@@ -0,0 +1,136 @@
+# Created 2024
+"""
+Persistent content-addressed cache of prepared system boxes: results of
+"gmx editconf", "gmx solvate", "gmx make_ndx" and template parsing.
+Entries are keyed by a hash of all inputs of the box setup and evicted
+in LRU order when the cache grows over its size cap.
+"""
+import hashlib
+import logging
+import os
+import shutil
+
+from utils import stage
+
+CACHE_FORMAT = 2        # 1: entries hard-linked with the job files (may be edited by the jobs), not reused
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'gmxfe', 'boxes')
+
+
+def file_digest(path):
+    """
+    :param path: file path
+    :return: sha256 hex digest of the file content ('' if the path is not defined)
+    """
+    if not path: return ''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def box_key(inputs: dict):
+    """
+    Cache key of the box setup
+
+    :param inputs: dict of the setup inputs: strings or file contents digests
+    :return: sha256 hex digest
+    """
+    h = hashlib.sha256(f'format\0{CACHE_FORMAT}\0'.encode('utf-8'))
+    for name in sorted(inputs):
+        h.update(f'{name}\0{inputs[name]}\0'.encode('utf-8'))
+    return h.hexdigest()
+
+
+def clone_or_copy(src, dst):
+    """
+    Reflink (copy-on-write clone) src to dst, copy if the file system does not support it.
+    The files are never hard-linked: job files are edited in place (e.g. [ molecules ] of the
+    topology), so a shared inode would rewrite the cache entry as well.
+    """
+    stage.stage_file(src, dst, 'reflink')
+
+
+class BoxCache:
+    """
+    On-disk cache of the box setup outputs: <root>/<key>/<file>
+    """
+
+    def __init__(self, root, max_mb=2048, log=logging):
+        """
+        :param   root: cache directory
+        :param max_mb: size cap of the cache in MB
+        """
+        self.root = os.path.abspath(root)
+        self.max_bytes = int(float(max_mb) * 1024 * 1024)
+        self.log = log
+        os.makedirs(self.root, exist_ok=True)
+
+    def fetch(self, key, files, dest_dir):
+        """
+        Put cached files of the entry into dest_dir
+
+        :param      key: cache key
+        :param    files: names of the files of the entry
+        :param dest_dir: destination directory
+        :return: True on a cache hit
+        """
+        entry = os.path.join(self.root, key)
+        if not all(os.path.isfile(os.path.join(entry, f)) for f in files):
+            return False
+        try:
+            for f in files:
+                clone_or_copy(os.path.join(entry, f), os.path.join(dest_dir, f))
+            os.utime(entry)     # LRU stamp
+        except OSError as e:    # the entry was evicted by a concurrent process
+            self.log.debug(f'Box cache entry {key} is not usable: {e}')
+            return False
+        return True
+
+    def store(self, key, files, src_dir):
+        """
+        Save files of src_dir as a cache entry. The entry is published atomically,
+        so concurrent gmxfe processes never see a partial one.
+
+        :param     key: cache key
+        :param   files: names of the files to be saved
+        :param src_dir: directory with the files
+        """
+        entry = os.path.join(self.root, key)
+        if os.path.isdir(entry): return
+        tmp = f'{entry}.tmp.{os.getpid()}'
+        try:
+            os.makedirs(tmp)
+            for f in files:
+                clone_or_copy(os.path.join(src_dir, f), os.path.join(tmp, f))
+            os.rename(tmp, entry)
+        except OSError as e:
+            self.log.debug(f'Box setup is not cached: {e}')
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its size cap
+        """
+        entries = []
+        total = 0
+        for d in os.scandir(self.root):
+            if not d.is_dir() or '.tmp.' in d.name: continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(d.path))
+                entries.append((d.stat().st_mtime, size, d.path))
+            except OSError:
+                continue
+            total += size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            self.log.debug(f'Evicted box cache entry {os.path.basename(path)} ({size} bytes)')
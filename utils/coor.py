@@ -0,0 +1,255 @@
+# Created 2024
+"""
+Fixed-column readers of system structure templates used for splicing ligand coordinates
+"""
+import os
+from collections import Counter
+
+PDB_ATOM_RECORDS = ('ATOM', 'HETATM')
+
+
+def is_pdb_atom(line):
+    # Coordinate record with at least the residue name columns (18-20)
+    return line.startswith(PDB_ATOM_RECORDS) and len(line) > 21
+
+
+def pdb_atom_lines(lines):
+    """
+    :param lines: PDB lines
+    :return: list of ATOM/HETATM records (with "\\n" at the end)
+    """
+    return [l if l.endswith('\n') else l + '\n' for l in lines if is_pdb_atom(l)]
+
+
+class PdbTemplate:
+    """
+    PDB structure loaded once into columns of the coordinate records:
+    line index, residue name and residue number of each ATOM/HETATM record.
+    """
+
+    def __init__(self, lines, path=''):
+        """
+        :param lines: PDB lines (with "\\n" at the end, as returned by read_file)
+        :param  path: template path used in diagnostics
+        """
+        self.path  = path
+        self.lines = lines
+        self.atom_idx   = [i for i, l in enumerate(lines) if is_pdb_atom(l)]      # line index of each atom
+        self.atom_resnm = [lines[i][17:20].strip() for i in self.atom_idx]       # PDB: resnm columns 18-20
+        self.atom_resid = [lines[i][22:26].strip() for i in self.atom_idx]       # PDB: resid columns 23-26
+        self._blocks = {}
+        self._segments = {}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as f:
+            return cls(f.readlines(), path)
+
+    def ligand_block(self, lignm):
+        """
+        Find the single ligand entry of the template
+
+        :param lignm: residue name of the ligand
+        :return: (first line, end line, first atom after the ligand) of the ligand block;
+                 the block includes non-coordinate records (e.g. TER) that follow the ligand atoms.
+                 None if there is no ligand entry.
+        :raise ValueError: the ligand is found again after other residues
+        """
+        if lignm in self._blocks: return self._blocks[lignm]
+        try:
+            first = self.atom_resnm.index(lignm)
+        except ValueError:
+            self._blocks[lignm] = None
+            return None
+        end = first
+        nat = len(self.atom_resnm)
+        while end < nat and self.atom_resnm[end] == lignm: end += 1
+        if lignm in self.atom_resnm[end:]:
+            i = self.atom_idx[end + self.atom_resnm[end:].index(lignm)]
+            raise ValueError(f'Found the second ligand entry in the template structure:\n{self.lines[i]}'
+                             f'There should be only single ligand entry.')
+        start_line = self.atom_idx[first]
+        end_line   = self.atom_idx[end] if end < nat else len(self.lines)
+        self._blocks[lignm] = (start_line, end_line, end)
+        return self._blocks[lignm]
+
+    def res_after_lig(self, lignm):
+        """
+        :param lignm: residue name of the ligand
+        :return: dict resnm:number of atoms of the residues after the ligand entry
+        """
+        block = self.ligand_block(lignm)
+        if block is None: return {}
+        return dict(Counter(self.atom_resnm[block[2]:]))
+
+    def segments(self, lignm):
+        """
+        :param lignm: residue name of the ligand
+        :return: (text before the ligand entry, text after the ligand entry), joined once per template
+        """
+        if lignm not in self._segments:
+            start, end, _ = self.ligand_block(lignm)
+            self._segments[lignm] = (''.join(self.lines[:start]), ''.join(self.lines[end:]))
+        return self._segments[lignm]
+
+    def splice(self, lignm, ligand_lines):
+        """
+        Substitute the ligand entry of the template by the ligand coordinate records
+
+        :param        lignm: residue name of the ligand
+        :param ligand_lines: PDB lines of the ligand structure
+        :return: list of text buffers of the system structure (to be written by a single writelines)
+        """
+        head, tail = self.segments(lignm)
+        return [head, ''.join(pdb_atom_lines(ligand_lines)), tail]
+
+
+class TemplateStore:
+    """
+    Memo of parsed structure templates keyed by path and mtime, shared by all records of a runFile
+    """
+
+    def __init__(self, loader=PdbTemplate.from_file):
+        """
+        :param loader: function path -> parsed template
+        """
+        self.loader = loader
+        self._templates = {}
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        cached = self._templates.get(path)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, self.loader(path))
+            self._templates[path] = cached
+        return cached[1]
+
+
+##
+##  GRO format: "%5d%-5s%5s%5d%8.3f%8.3f%8.3f[%8.4f%8.4f%8.4f]" atom records between
+##  the title + atom count lines and the box line
+##
+def gro_atom_line(atomnr, resid, resnm, atomnm, xyz, vel=None):
+    line = f'{resid % 100000:5d}{resnm:<5.5s}{atomnm:>5.5s}{atomnr % 100000:5d}{xyz[0]:8.3f}{xyz[1]:8.3f}{xyz[2]:8.3f}'
+    if vel is not None: line += f'{vel[0]:8.4f}{vel[1]:8.4f}{vel[2]:8.4f}'
+    return line + '\n'
+
+
+def read_ligand_atoms(path):
+    """
+    Read ligand atoms from PDB or GRO file
+
+    :param path: ligand structure file
+    :return: list of (resnm, atomnm, (x, y, z) in nm)
+    """
+    atoms = []
+    with open(path, 'r') as f:
+        if os.path.splitext(path)[1] == '.gro':
+            f.readline()
+            natoms = int(f.readline())
+            for _ in range(natoms):
+                l = f.readline()
+                atoms.append((l[5:10].strip(), l[10:15].strip(), (float(l[20:28]), float(l[28:36]), float(l[36:44]))))
+        else:
+            for l in f:
+                if not is_pdb_atom(l): continue
+                atoms.append((l[17:20].strip(), l[12:16].strip(),              # PDB coordinates are in Angstrom
+                              (float(l[30:38]) / 10, float(l[38:46]) / 10, float(l[46:54]) / 10)))
+    return atoms
+
+
+class GroTemplate:
+    """
+    GRO structure template which is streamed from the disk: only the summary of the ligand entry is kept in memory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r') as f:
+            self.title = f.readline()
+            self.natoms = int(f.readline().split()[0])
+        self._blocks = {}
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(path)
+
+    def ligand_block(self, lignm):
+        """
+        Scan the template for the single ligand entry
+
+        :param lignm: residue name of the ligand
+        :return: dict with the ligand atoms range "first"/"end", its "resid", "res_after" histogram
+                 and the "velocities" flag of the template; None if there is no ligand entry
+        :raise ValueError: the ligand is found again after other residues
+        """
+        if lignm in self._blocks: return self._blocks[lignm]
+        block = None
+        res_after = Counter()
+        with open(self.path, 'r') as f:
+            f.readline(); f.readline()
+            for i in range(self.natoms):
+                l = f.readline()
+                resnm = l[5:10].strip()
+                if block is None:
+                    if resnm == lignm:
+                        block = {'first': i, 'end': i + 1, 'resid': int(l[0:5]),
+                                 'velocities': len(l.rstrip('\n')) > 44 + 3 * 4}
+                elif resnm == lignm:
+                    if res_after:
+                        raise ValueError(f'Found the second ligand entry in the template structure:\n{l}'
+                                         f'There should be only single ligand entry.')
+                    block['end'] = i + 1
+                else:
+                    res_after[resnm] += 1
+        if block is not None: block['res_after'] = dict(res_after)
+        self._blocks[lignm] = block
+        return block
+
+    def res_after_lig(self, lignm):
+        block = self.ligand_block(lignm)
+        return block['res_after'] if block else {}
+
+    def write_spliced(self, lignm, ligand_atoms, outPath):
+        """
+        Stream the template to outPath substituting its ligand entry by ligand_atoms.
+        Atoms are renumbered, the atom count is updated and the box line is kept.
+
+        :param        lignm: residue name of the ligand
+        :param ligand_atoms: list of (resnm, atomnm, xyz) as returned by read_ligand_atoms
+        :param      outPath: output GRO file
+        """
+        block = self.ligand_block(lignm)
+        first, end = block['first'], block['end']
+        vel = (0.0, 0.0, 0.0) if block['velocities'] else None
+        with open(self.path, 'r') as f, open(outPath, 'w') as out:
+            f.readline(); f.readline()
+            out.write(self.title)
+            out.write(f'{self.natoms - (end - first) + len(ligand_atoms):5d}\n')
+            atomnr = 0
+            for i in range(self.natoms):
+                l = f.readline()
+                if first <= i < end:
+                    if i == first:
+                        for resnm, atomnm, xyz in ligand_atoms:
+                            atomnr += 1
+                            out.write(gro_atom_line(atomnr, block['resid'], resnm, atomnm, xyz, vel))
+                    continue
+                atomnr += 1
+                out.write(l[:15] + f'{atomnr % 100000:5d}' + l[20:])
+            for l in f:     # box line
+                out.write(l)
+
+
+def load_template(path):
+    """
+    Parse structure template by its format
+
+    :param path: PDB or GRO file
+    :return: PdbTemplate or GroTemplate
+    """
+    if os.path.splitext(path)[1] == '.gro':
+        return GroTemplate.from_file(path)
+    return PdbTemplate.from_file(path)
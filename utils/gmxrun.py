@@ -0,0 +1,239 @@
+# Created 2024
+"""
+Runner of gmx commands: argv lists are executed directly (no /bin/sh), the version and
+capability probe of each binary ("gmx -version": precision, GPU support, MPI, SIMD) is cached
+in ~/.cache/gmxfe/gmxprobe.json per resolved path, size and mtime, and every call is recorded
+with its wall time and exit status. The setup steps of different ligands overlap in the
+worker processes of "gmxfe run_ti --jobs N".
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+
+PROBE_VERSION = 1          # format of the probe cache entries
+
+# "gmx -version" lines of the probe fields
+_re_probe = {'version'  : re.compile(r'^GROMACS version:[ \t]*(\S[^\n]*)$', re.MULTILINE),
+             'precision': re.compile(r'^Precision:[ \t]*(\S[^\n]*)$', re.MULTILINE),
+             'mpi'      : re.compile(r'^MPI library:[ \t]*(\S[^\n]*)$', re.MULTILINE),
+             'gpu'      : re.compile(r'^GPU support:[ \t]*(\S[^\n]*)$', re.MULTILINE),
+             'simd'     : re.compile(r'^SIMD instructions:[ \t]*(\S[^\n]*)$', re.MULTILINE)}
+
+_probe_cache = {}          # (resolved binary path, size, mtime) -> probe
+_probe_lock = threading.Lock()
+
+
+def default_probe_cache():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'gmxfe', 'gmxprobe.json')
+
+
+def parse_probe(text):
+    """
+    :param text: output of "gmx -version"
+    :return: dict of the probe fields (missing fields are '')
+    """
+    probe = {field: (m.group(1).strip() if m else '') for field, m in
+             ((field, r.search(text)) for field, r in _re_probe.items())}
+    probe['double']     = probe['precision'].startswith('double')
+    probe['gpu_build']  = bool(probe['gpu']) and probe['gpu'].lower() not in {'disabled', 'none'}
+    probe['thread_mpi'] = probe['mpi'].lower().startswith('thread_mpi')
+    probe['real_mpi']   = bool(probe['mpi']) and not probe['thread_mpi'] and probe['mpi'].lower() != 'none'
+    return probe
+
+
+def load_probe_cache(path):
+    try:
+        with open(path, 'r') as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def store_probe(path, binary, entry):
+    """
+    Add the probe of the binary to the cache file (read-modify-write under flock, atomic replace)
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = load_probe_cache(path)
+            cache[binary] = entry
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+            os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f'The gmx probe cache {path} is not written: {e}')
+
+
+class GmxCall:
+    """
+    Record of one gmx call
+    """
+
+    def __init__(self, argv, cwd, returncode, stdout, stderr, wall):
+        self.argv       = argv
+        self.cwd        = cwd
+        self.returncode = returncode
+        self.stdout     = stdout
+        self.stderr     = stderr
+        self.wall       = wall           # wall time, s
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    @property
+    def cmd(self):
+        return ' '.join(shlex.quote(a) for a in self.argv)
+
+    def __repr__(self):
+        return f'GmxCall({self.cmd}: exit code {self.returncode}, {self.wall:.2f} s)'
+
+
+class GmxRunner:
+    """
+    gmx binary (a command, e.g. "gmx", "/opt/gromacs/bin/gmx_d" or "mpirun -np 1 gmx_mpi")
+    """
+
+    def __init__(self, bingmx: str, log=logging, cache_path=None):
+        """
+        :param     bingmx: gmx command
+        :param cache_path: probe cache file (default: ~/.cache/gmxfe/gmxprobe.json, '' - no cache file)
+        """
+        self.bingmx = bingmx
+        self.argv0  = shlex.split(bingmx)
+        self.log    = log
+        self.cache_path = default_probe_cache() if cache_path is None else cache_path
+        self.calls  = []         # GmxCall of all calls in the order of completion
+        self._lock  = threading.Lock()
+
+    def binary_path(self):
+        """
+        :return: resolved path of the gmx executable or None if it is not found
+        """
+        exe = self.argv0[-1] if self.argv0 else ''
+        # The gmx executable is the last word of launcher commands like "mpirun -np 1 gmx_mpi"
+        path = shutil.which(exe)
+        return os.path.realpath(path) if path else None
+
+    def _record(self, argv, cwd, returncode, stdout, stderr, start):
+        call = GmxCall(argv, cwd, returncode, stdout, stderr, time.monotonic() - start)
+        with self._lock:
+            self.calls.append(call)
+        self.log.debug(f'{call}')
+        return call
+
+    def run(self, args, input: str = None, cwd: str = None):
+        """
+        Run "gmx <args>" and wait for it
+
+        :param  args: gmx arguments, list or a command line string
+        :param input: stdin text (e.g. make_ndx commands)
+        :param   cwd: working directory (default: current dir)
+        :return: GmxCall
+        """
+        argv = self.argv0 + (shlex.split(args) if isinstance(args, str) else list(args))
+        start = time.monotonic()
+        try:
+            p = subprocess.run(argv, input=input, capture_output=True, text=True, cwd=cwd,
+                               errors='replace')
+        except OSError as e:
+            return self._record(argv, cwd, 127, '', f'{e}\n', start)
+        return self._record(argv, cwd, p.returncode, p.stdout, p.stderr, start)
+
+    def probe(self):
+        """
+        Version and capabilities of the binary from "gmx -version", probed once per resolved path,
+        size and mtime across gmxfe invocations
+
+        :return: (probe dict or None if gmx failed, GmxCall of the probe or None if the cached probe is used)
+        """
+        path = self.binary_path()
+        st = os.stat(path) if path else None
+        key = (path, st.st_size, st.st_mtime_ns) if st else (self.bingmx, None, None)
+        with _probe_lock:
+            if key in _probe_cache:
+                return _probe_cache[key], None
+        if st and self.cache_path:
+            entry = load_probe_cache(self.cache_path).get(path)
+            if entry and entry.get('format') == PROBE_VERSION and \
+                    entry.get('size') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns:
+                with _probe_lock:
+                    _probe_cache[key] = entry['probe']
+                self.log.debug(f'Cached gmx probe of {path}: {entry["probe"]}')
+                return entry['probe'], None
+        call = self.run(['-version'])
+        probe = parse_probe(call.stdout) if call.ok else None
+        if not probe or not probe['version']:
+            return None, call
+        with _probe_lock:
+            _probe_cache[key] = probe
+        if st and self.cache_path:
+            store_probe(self.cache_path, path, {'format': PROBE_VERSION, 'size': st.st_size,
+                                                'mtime_ns': st.st_mtime_ns, 'probe': probe})
+        return probe, call
+
+    def version(self):
+        """
+        :return: (version or '' if gmx failed, GmxCall of the probe or None if the cached probe is used)
+        """
+        probe, call = self.probe()
+        return (f'GROMACS version: {probe["version"]}' if probe else ''), call
+
+    def mdrun_flags(self, ncpu, gpu=False, flags=''):
+        """
+        Thread and GPU flags of mdrun chosen from the probe of the binary, options already
+        set in the user flags (mdrun_flags of the Phase) are kept
+
+        :param  ncpu: number of cores of the mdrun
+        :param   gpu: the job has a GPU
+        :param flags: user mdrun flags
+        :return: flags to append to the mdrun command
+        """
+        probe, _ = self.probe()
+        user = set(flags.split())
+        if probe is None:
+            return f' -nt {ncpu}'
+        if probe['real_mpi']:
+            # MPI build: ranks come from mpirun, -nt is not supported
+            out = '' if '-ntomp' in user else f' -ntomp {ncpu}'
+        else:
+            out = f' -nt {ncpu}'
+            if probe['thread_mpi'] and '-ntmpi' not in user: out += ' -ntmpi 1'
+        if gpu and '-nb' not in user:
+            if probe['gpu_build'] and not probe['double']:
+                out += ' -nb gpu'
+            else:
+                self.log.warning(f'{self.bingmx} ({probe["precision"]} precision, GPU support: {probe["gpu"]}) '
+                                 f'cannot run on GPU, the mdrun runs on CPU')
+        return out
+
+    def wall_time(self):
+        """
+        :return: total wall time of the recorded calls, s
+        """
+        return sum(c.wall for c in self.calls)
+
+
+_runners = {}
+
+
+def runner(bingmx: str):
+    """
+    :return: the shared GmxRunner of the gmx command
+    """
+    if bingmx not in _runners:
+        _runners[bingmx] = GmxRunner(bingmx)
+    return _runners[bingmx]
+
@@ -0,0 +1,47 @@
+# Created 2024
+"""
+Job ID allocator: a monotonically increasing counter stored in OutDir and
+protected by a file lock, so concurrent gmxfe invocations never get the same
+job ID and the scheduler is not queried during setup.
+"""
+import fcntl
+import os
+import re
+
+COUNTER_FILE = '.gmxfe_jobid'
+
+
+def last_dir_id(outdir):
+    """
+    :param outdir: output directory with job dirs "<ID>.<DirPrefix>_<jobnm>"
+    :return: largest job ID used by the job dirs (0 if none)
+    """
+    last = 0
+    for name in os.listdir(outdir):
+        m = re.match(r'^([0-9]+)\.', name)
+        if m: last = max(last, int(m.group(1)))
+    return last
+
+
+def reserve(outdir, count=1):
+    """
+    Reserve a range of job IDs. The counter is seeded from the job dirs of outdir,
+    so IDs keep growing after the counter file is removed or job dirs are copied in.
+
+    :param outdir: output directory where the job dirs are created
+    :param  count: number of IDs to reserve (e.g. all records of a runFile)
+    :return: first reserved ID; the range is [first, first + count)
+    """
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, COUNTER_FILE), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        text = f.read().strip()
+        last = int(text) if text.isdigit() else 0
+        first = 1 + max(last, last_dir_id(outdir))
+        f.seek(0)
+        f.truncate()
+        f.write(f'{first + count - 1}\n')
+        f.flush()
+        os.fsync(f.fileno())
+    return first
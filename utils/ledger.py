@@ -0,0 +1,104 @@
+# Created 2024
+"""
+ResFile results ledger: job scripts append one JSON record per line at exit
+(under flock when available) and never rewrite the file. Duplicates, e.g. records
+of a rerun lambda window, are resolved when the ledger is read: the last record wins.
+Lines of the former tab-separated format "jobnm<TAB>date<TAB>outdir" are read as "done" records.
+"""
+import json
+import logging
+import os
+
+
+def shell_record(ResFile, LastTaskDir, JobArgs, final=True):
+    """
+    Shell code of the job script which appends the record of the TI point to the ledger at exit.
+    The exit status of the script sets the status "done" or "failed".
+
+    :param      ResFile: ledger path
+    :param  LastTaskDir: Task dir with the final output
+    :param      JobArgs: dictionary of the job script parameters
+    :param        final: the script runs the last Task, otherwise only a failure is recorded
+    :return: shell code
+    """
+    static = {'job': JobArgs['sJobNm'], 'ligand': JobArgs['sLigNm'],
+              'phase': JobArgs['sPhase'], 'jobid': JobArgs['jobid']}
+    head = json.dumps(static)[1:-1].replace('\\', '\\\\').replace('"', '\\"')
+    return ('############# WRITE JOB RECORD #############\n'
+            '######## appended to ledger at exit ########\n'
+            '############################################\n'
+            f'ResFile=\'{ResFile}\'\n'
+            'jobdir=$(pwd)\n'
+            'ledger_record() {\n'
+            '    rc=$?\n'
+            + ('' if final else '    if [ ${rc} -eq 0 ]; then return; fi\n') +
+            '    if [ ${rc} -eq 0 ]; then status=done; else status=failed; fi\n'
+            f'    rec="{{{head}, \\"lambda\\": ${{lambda}}, \\"status\\": \\"${{status}}\\", \\"exit\\": ${{rc}}, '
+            f'\\"outdir\\": \\"${{jobdir}}/{LastTaskDir}/${{subdir}}\\", \\"time\\": \\"$(date +%Y-%m-%dT%H:%M:%S)\\"}}"\n'
+            '    if command -v flock >/dev/null 2>&1; then\n'
+            '        flock "${ResFile}.lock" sh -c \'printf "%s\\n" "$1" >> "$2"\' sh "${rec}" "${ResFile}"\n'
+            '    else\n'
+            '        printf \'%s\\n\' "${rec}" >> "${ResFile}"\n'
+            '    fi\n'
+            '}\n'
+            'trap ledger_record EXIT\n'
+            'trap \'exit 143\' TERM INT\n')
+
+
+def parse_line(line):
+    """
+    :param line: ledger line, JSON record or legacy "jobnm<TAB>date<TAB>outdir"
+    :return: record dict or None for empty and malformed lines
+    """
+    line = line.strip()
+    if not line: return None
+    if line.startswith('{'):
+        try:
+            return json.loads(line)
+        except ValueError:      # partially written line
+            return None
+    tokens = line.split('\t')
+    if len(tokens) < 3: return None
+    return {'job': tokens[0], 'time': tokens[1], 'outdir': tokens[2], 'status': 'done'}
+
+
+def read_ledger(path):
+    """
+    Read the ledger without locking, the last record of each output dir wins
+
+    :param path: ResFile path
+    :return: list of records in the order of their last appearance
+    """
+    records = {}
+    if not os.path.isfile(path):
+        logging.warning(f'ResFile {path} does not exist')
+        return []
+    with open(path, 'r') as f:
+        for line in f:
+            rec = parse_line(line)
+            if rec is None: continue
+            key = rec.get('outdir') or (rec.get('jobid'), rec.get('lambda'))
+            records.pop(key, None)
+            records[key] = rec
+    return list(records.values())
+
+
+def select(records, status=None, ligand=None, phase=None, lambdas=None):
+    """
+    :return: records matching all given filters
+    """
+    lambdas = {str(l) for l in lambdas} if lambdas else None
+    return [r for r in records
+            if (status  is None or r.get('status') == status)
+            and (ligand is None or r.get('ligand') == ligand)
+            and (phase  is None or r.get('phase')  == phase)
+            and (lambdas is None or str(r.get('lambda')) in lambdas)]
+
+
+def format_table(records):
+    cols = ('status', 'job', 'ligand', 'phase', 'lambda', 'time', 'outdir')
+    rows = [[str(r.get(c, '')) for c in cols] for r in records]
+    widths = [max([len(c)] + [len(row[i]) for row in rows]) for i, c in enumerate(cols)]
+    lines = ['  '.join(c.upper().ljust(w) for c, w in zip(cols, widths)).rstrip()]
+    lines += ['  '.join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows]
+    return '\n'.join(lines)
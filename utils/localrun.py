@@ -0,0 +1,190 @@
+# Created 2024
+"""
+Local executor of job scripts for --queue none: runs the scripts of all records
+concurrently on the local node in a bounded pool of core slots.
+Each slot owns a disjoint core set (and a GPU, round-robin, when --gpu is set),
+passed to mdrun via the GMXFE_MDRUN_LOCAL environment variable (and GMXFE_PINOFFSET,
+GMXFE_GPU_ID for the pack scripts of gmxfe run_ti --pack).
+A script may wait for another one (gmxfe run_ti --dag): it is queued for a slot only when
+its dependency has finished and is skipped when the dependency failed.
+"""
+import logging
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+MDRUN_ENV = 'GMXFE_MDRUN_LOCAL'   # extra mdrun flags of the slot, referenced by the job scripts
+
+
+def count_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def detect_gpus():
+    """
+    :return: list of GPU IDs visible to the job (CUDA_VISIBLE_DEVICES or "nvidia-smi -L")
+    """
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is not None:
+        ## mdrun -gpu_id refers to the devices visible to the process, i.e. renumbered from 0
+        return [str(i) for i, dev in enumerate(visible.split(',')) if dev.strip()]
+    try:
+        p = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True)
+    except OSError:
+        return []
+    return re.findall(r'^GPU ([0-9]+):', p.stdout, re.MULTILINE)
+
+
+class LocalExecutor:
+    """
+    Bounded pool of core slots running job scripts on the local node
+    """
+
+    def __init__(self, ncpu=1, gpu=False, cores=None, log=logging):
+        """
+        :param  ncpu: number of cores per script (mdrun -nt)
+        :param   gpu: assign a GPU to each script
+        :param cores: number of cores to use (default: all cores available to the process)
+        """
+        self.ncpu  = max(1, int(ncpu))
+        self.cores = cores or count_cores()
+        self.nslots = max(1, self.cores // self.ncpu)
+        self.gpus  = detect_gpus() if gpu else []
+        if gpu and not self.gpus:
+            log.warning('No GPU is found on the local node, the jobs run without GPU assignment')
+        if self.cores < self.ncpu:
+            log.warning(f'The job requires {self.ncpu} cores but only {self.cores} are available')
+        self.log = log
+        self._slots = queue.Queue()
+        for slot in range(self.nslots): self._slots.put(slot)
+        self._pool = ThreadPoolExecutor(max_workers=self.nslots)
+        self._lock = threading.Lock()
+        self._futures = []
+        self.results = []       # (workdir, script, exit code, wall time in s)
+        log.info(f'Local executor: {self.nslots} concurrent scripts x {self.ncpu} cores'
+                 + (f', GPUs {self.gpus}' if self.gpus else ''))
+
+    def slot_flags(self, slot):
+        flags = f'-pin on -pinoffset {slot * self.ncpu} -pinstride 1'
+        if self.gpus: flags += f' -gpu_id {self.gpus[slot % len(self.gpus)]}'
+        return flags
+
+    def submit(self, workdir, scripts, after=None):
+        """
+        Queue scripts to run in workdir, returns without waiting
+
+        :param workdir: directory the scripts run in
+        :param scripts: script names relative to workdir
+        :param   after: futures of the dependencies, one per script (None - no dependency)
+        :return: list of futures of the exit codes of the scripts
+        """
+        futures = []
+        for i, script in enumerate(scripts):
+            if after is None or after[i] is None:
+                future = self._pool.submit(self._run, workdir, script)
+            else:
+                future = Future()
+                after[i].add_done_callback(lambda dep, w=workdir, s=script, f=future: self._start_after(dep, w, s, f))
+            self._futures.append(future)
+            futures.append(future)
+        return futures
+
+    def _start_after(self, dep, workdir, script, future):
+        try:
+            rc = dep.result()
+        except Exception:
+            rc = 1
+        if rc != 0:
+            self._finish(workdir, script, rc, 0.0, 'skipped: its dependency failed with exit code')
+            future.set_result(rc)
+            return
+        try:
+            inner = self._pool.submit(self._run, workdir, script)
+        except RuntimeError as e:     # the pool is shut down
+            future.set_exception(e)
+            return
+        inner.add_done_callback(lambda f: self._relay(f, future))
+
+    @staticmethod
+    def _relay(src, dst):
+        """
+        Resolve the future dst by the result or the exception of the finished future src
+        (an exception raised in a done-callback is only logged and dst would never be resolved)
+        """
+        exc = src.exception()
+        if exc is not None: dst.set_exception(exc)
+        else:               dst.set_result(src.result())
+
+    @staticmethod
+    def all_of(futures):
+        """
+        :return: future of the max exit code of the futures (the first exception if any of them failed)
+        """
+        combined, pending = Future(), [len(futures)]
+        lock = threading.Lock()
+        def done(_):
+            with lock:
+                pending[0] -= 1
+                if pending[0]: return
+            for f in futures:
+                if f.exception() is not None:
+                    combined.set_exception(f.exception())
+                    return
+            combined.set_result(max(f.result() for f in futures))
+        if not futures: combined.set_result(0)
+        for f in futures: f.add_done_callback(done)
+        return combined
+
+    def _run(self, workdir, script):
+        slot = self._slots.get()
+        try:
+            env = dict(os.environ)
+            env[MDRUN_ENV] = self.slot_flags(slot)
+            env['GMXFE_PINOFFSET'] = str(slot * self.ncpu)       # for the scripts which pin several mdruns
+            if self.gpus: env['GMXFE_GPU_ID'] = self.gpus[slot % len(self.gpus)]
+            self.log.info(f'Started {script} in {workdir} on slot {slot} ({env[MDRUN_ENV]})')
+            start = time.monotonic()
+            try:
+                log = open(os.path.join(workdir, script + '.log'), 'w')
+            except OSError as e:          # job dir removed or read-only
+                self.log.error(f'Cannot open the log of {script} in {workdir}: {e}')
+                self._finish(workdir, script, 127, 0.0, 'not started, exit code')
+                return 127
+            with log:
+                try:
+                    rc = subprocess.run(['sh', script], cwd=workdir, env=env,
+                                        stdout=log, stderr=subprocess.STDOUT).returncode
+                except OSError as e:
+                    log.write(f'{e}\n')
+                    rc = 127
+            elapsed = time.monotonic() - start
+        finally:
+            self._slots.put(slot)
+        self._finish(workdir, script, rc, elapsed, 'finished with exit code')
+        return rc
+
+    def _finish(self, workdir, script, rc, elapsed, status):
+        with self._lock:
+            self.results.append((workdir, script, rc, elapsed))
+            done = len(self.results)
+        msg = f'[{done}/{len(self._futures)}] {script} in {workdir} {status} {rc} in {elapsed:.0f} s'
+        if rc == 0: self.log.info(msg)
+        else:       self.log.error(msg)
+
+    def wait(self):
+        """
+        Wait for all queued scripts
+
+        :return: list of (workdir, script, exit code) of the failed scripts
+        """
+        for future in self._futures:
+            future.result()
+        self._pool.shutdown()
+        return [(w, s, rc) for w, s, rc, _ in self.results if rc != 0]
@@ -0,0 +1,147 @@
+# Created 2024
+"""
+MDP template engine: the template is parsed once into a key -> line index map,
+then any number of MDP files are rendered from layered parameter overrides.
+"""
+import logging
+import re
+from collections.abc import Mapping
+
+# "key = value ; comment": value runs up to the comment or the end of the line (as in the former setMdpParams)
+_re_param = re.compile(r'^([ \t]*([^ \t=;\n]+)[ \t]*=[ \t]*)([^;\n]*)(.*)$', re.DOTALL)
+
+
+_SLOT = '\x00'    # placeholder of a slot value, never present in MDP text
+
+
+def mdp_key(key):
+    """
+    Normalize MDP parameter name: gromacs treats "-" and "_" in parameter names as equal
+
+    :param key: MDP parameter name
+    :return: normalized name
+    """
+    return str(key).strip().replace('_', '-').lower()
+
+
+def merge_layers(*layers):
+    """
+    Merge MDP parameter layers into one dict, later layers override earlier ones.
+    Nested tables (e.g. the per-Task sub-sections "Phase.mdp.<Task>") are not parameters and are skipped.
+
+    :param layers: dicts of mdp parameters (None and '' are allowed for missing layers)
+    :return: dict normalized_key -> (key, str value)
+    """
+    params = {}
+    for layer in layers:
+        if not layer: continue
+        for key, value in layer.items():
+            if isinstance(value, Mapping): continue
+            params[mdp_key(key)] = (key, str(value))
+    return params
+
+
+class MdpTemplate:
+    """
+    MDP template parsed once into line slots of its parameters
+    """
+
+    def __init__(self, lines, path=''):
+        """
+        :param lines: template lines (with "\\n" at the end, as returned by read_file)
+        :param  path: template path used in diagnostics
+        """
+        self.path  = path
+        self.lines = list(lines)
+        self.slots = {}      # normalized key -> list of (line index, prefix, suffix)
+        for idx, line in enumerate(self.lines):
+            m = _re_param.match(line)
+            if not m: continue
+            prefix, key, value, suffix = m.groups()
+            self.slots.setdefault(mdp_key(key), []).append((idx, prefix, suffix))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as f:
+            return cls(f.readlines(), path)
+
+    def keys(self):
+        return self.slots.keys()
+
+    def get(self, key, default=None):
+        """
+        :param key: parameter name
+        :return: value of the parameter in the template (default if it's not defined)
+        """
+        for idx, _, _ in self.slots.get(mdp_key(key), ()):
+            return _re_param.match(self.lines[idx]).group(3).strip()
+        return default
+
+    def missing(self, *layers):
+        """
+        Parameters of the layers which are not present in the template (they are ignored at rendering)
+
+        :param layers: dicts of mdp parameters
+        :return: list of parameter names as given in the layers
+        """
+        return [key for nkey, (key, _) in merge_layers(*layers).items() if nkey not in self.slots]
+
+    def render_lines(self, *layers):
+        """
+        Apply layered overrides to the template in a single pass over the parameter slots
+
+        :param layers: dicts of mdp parameters, later layers override earlier ones
+        :return: list of MDP lines
+        """
+        lines = list(self.lines)
+        for nkey, (_, sVal) in merge_layers(*layers).items():
+            for idx, prefix, suffix in self.slots.get(nkey, ()):
+                lines[idx] = prefix + sVal + (' ' if suffix.startswith(';') else '') + suffix
+        return lines
+
+    def render(self, *layers):
+        """
+        :param layers: dicts of mdp parameters, later layers override earlier ones
+        :return: MDP file content as a single string
+        """
+        return ''.join(self.render_lines(*layers))
+
+    def slotted(self, key, *layers, log=logging):
+        """
+        Render the template with a precomputed slot for the value of one parameter,
+        e.g. "init-lambda-state" which differs between otherwise identical TI point MDPs.
+        The parameter line is appended if the template doesn't define it.
+
+        :param    key: parameter name of the slot
+        :param layers: dicts of mdp parameters, later layers override earlier ones
+        :return: MdpSlot
+        """
+        lines = self.render_lines(*layers, {key: _SLOT})
+        if mdp_key(key) not in self.slots:
+            log.warning(f'MDP parameter "{key}" is not found in the template {self.path}. It is appended to the MDP')
+            if lines and not lines[-1].endswith('\n'): lines[-1] += '\n'
+            lines.append(f'{key:<24s} = {_SLOT}\n')
+        return MdpSlot(''.join(lines).split(_SLOT))
+
+    def report_missing(self, *layers, log=logging, context=''):
+        """
+        Log config parameters that don't exist in the template
+
+        :return: list of the missing parameter names
+        """
+        missing = self.missing(*layers)
+        if missing:
+            log.warning(f'MDP parameters {missing}{context} are not found in the template {self.path} and are ignored')
+        return missing
+
+
+class MdpSlot:
+    """
+    Rendered MDP text split around the value of one parameter
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def fill(self, value):
+        return str(value).join(self.parts)
@@ -1,13 +1,20 @@
 # Created 2024
+import hashlib
 import logging
 import os
 import re
 import sys
-import time
 import xml.etree.ElementTree as ET
 from utils import scheduler
+from utils import boxcache
+from utils import jobid
+from utils import ledger
+from utils import gmxrun
+from utils import stage
+from utils.mdp import MdpTemplate
+from utils.top import TopTemplate
+from utils.coor import PdbTemplate, GroTemplate, TemplateStore, read_ligand_atoms
 import utils as utils
-import subprocess
 
 def read_file(path):                        # Read file to list of lines
     try:
@@ -20,17 +27,28 @@ def read_file(path):                        # Read file to list of lines
     #     lines = f.read().splitlines()      # Read lines without "\n" at the end
     f.close()
     return lines
-def write_file(lines, path):                        # Save lines to file
+def write_file(lines, path):                        # Save lines (or a whole text) to file
     try:
         f = open(path, 'w')
     except OSError:
         logging.error(f"Error: cannot open file for writing {path}\nExit")
         sys.exit()
-    f.writelines(lines)                    # Read lines with "\n" at the end
+    if isinstance(lines, str): f.write(lines)
+    else:                      f.writelines(lines)    # Read lines with "\n" at the end
     # with open(MdpTemplatePath, 'r') as f:
     #     lines = f.read().splitlines()      # Read lines without "\n" at the end
     f.close()
 
+def write_files(batch):                     # Save a batch of (bytes, path) outputs
+    for data, path in batch:
+        try:
+            f = open(path, 'wb')
+        except OSError:
+            logging.error(f"Error: cannot open file for writing {path}\nExit")
+            sys.exit()
+        f.write(data)
+        f.close()
+
 def copy_file_loc_2dist(file, location, destination):
     """
     Copy file from location to destination and returns the new path.
@@ -40,52 +58,31 @@ def copy_file_loc_2dist(file, location, destination):
     :param destination: full destination path of the file to be copied
     :return: full destination path of the copied file
     """
-    fnm = os.path.basename(file)
     if not os.path.exists(file) and location: # it is a relative path
         file = os.path.join(location, file)
     try:
-        import shutil
-        shutil.copy2(file, destination)
+        return stager().stage(file, destination)   # copy, or link with --stage
     except FileNotFoundError:
         logging.error(f'The file {file} is not found.')
         sys.exit(0)
-    except:
-        logging.error(f'The file {file} cannot be copied.')
+    except OSError as e:
+        logging.error(f'The file {file} cannot be copied: {e}')
         sys.exit(0)
-    return os.path.join(destination, fnm)
+
+_stager = None
+
+def stager():
+    """
+    :return: stage.Stager of the inputs of the campaign jobs (mode of --stage)
+    """
+    global _stager
+    if _stager is None:
+        _stager = stage.Stager(utils.env.sStage, os.path.join(utils.env.OutDir, '.stage'))
+    return _stager
 ##
 ## USE --qargs to set all extra options and flags
 ##
 
-def key2re(key):
-    return re.sub(r'([^a-zAZ0-9 ])', r'\1', key)
-def setMdpParams(parDict, lines):
-    if len(parDict) == 0: return lines
-    for key, value in parDict.items():
-        sVal = str(value)
-        new_lines =[]
-        for l in lines:
-            new_l = re.sub(r'^([ \t]*' + re.escape(key) + '[ \t]*\=[ \t]*)[^;\n]+', '\g<1>' + sVal + ' ', l)
-            new_lines.append(new_l)
-            #if (re.match(r'^([ \t]*' + re.escape(key) + '[ \t]*\=[ \t]*)[^;\n]+', l)) :
-            #    print(f'\'{key}\': {value} : {l}')
-            #    print(f'\'{key}\': {value} : {new_l}')
-        lines = new_lines
-    return new_lines
-def setMdpParam(key, value, lines):
-    sVal = str(value)
-    new_lines =[]
-    # print('^([ \t]*' + re.escape(key) + '[ \t]*\=[ \t]*)[^ \t;]+', '\\1' + re.escape(sVal))
-    for l in lines:
-        new_l = re.sub(r'^([ \t]*' + re.escape(key) + '[ \t]*\=[ \t]*)[^;\n]+', '\g<1>' + sVal, l)
-        new_lines.append(new_l)
-    #     matchline = re.match(r'^([ \t]*' + re.escape(key) + '[ \t]*\=[ \t]*)[^; \t]+', l)
-    #     if matchline:
-    #         print ('MATCH: ', matchline )
-    #         print('SUBSTITUTED: ', re.sub(r'^([ \t]*' + re.escape(key) + '[ \t]*\=[ \t]*)[^; \t]+', '\g<1>' + sVal, l) )
-    # return [re.sub(r'^([ \t]*' + re.escape(key) + '[ \t]*\=[ \t]*)[^; \t]+', '\g<1>' + sVal, l) for l in lines]
-    return new_lines
-
 def copy_parse_topology(sLigNm,TopPath,job_dir,sPhase,args,log):
     ##
     ## Set System Topology
@@ -94,8 +91,17 @@ def copy_parse_topology(sLigNm,TopPath,job_dir,sPhase,args,log):
     TopTemplatePath =  os.path.abspath(utils.env.TopDir + '/' + phase_cfg.get('TopTemplate','')) 
     #TopTemplatePath =  os.path.abspath(utils.env.TopDir + '/' + args.gmxconfig.Phase[sPhase].get('TopTemplate','')) 
     log.info(f"Setting up the system topology from template {TopTemplatePath}")
-    top_template = read_file(TopTemplatePath) 
-    top          = resub({'{ligand}': sLigNm}, top_template)
+    if not os.path.isfile(TopTemplatePath):
+        log.error(f"Error: {TopTemplatePath} doesn't exist! Exit")
+        sys.exit()
+    # Placeholders: {ligand} and the optional "TopParams" table of the Phase (e.g. molecule counts, water model)
+    values = dict(phase_cfg.get('TopParams') or {})
+    values['ligand'] = sLigNm
+    top, unresolved = top_templates.get(TopTemplatePath).render(values)
+    if unresolved:
+        log.error(f"Error: placeholders {unresolved} of the topology template {TopTemplatePath} are not defined "
+                  f"(the Phase.{sPhase}.TopParams table of the config). Exit")
+        sys.exit()
     write_file(top, TopPath)
     # Copy all include files
     #print("Molecules:", args.gmxconfig.Phase.get(sPhase).get('Molecule'))
@@ -103,7 +109,7 @@ def copy_parse_topology(sLigNm,TopPath,job_dir,sPhase,args,log):
         #print(mol)
         #if len(mol.get('include_files')) < 1:
         lIncludeFiles = mol.get('include_files','')
-        print(f"Copying include files for molecule ", mol.get('name'),': ', lIncludeFiles)
+        log.info(f"Staging ({utils.env.sStage}) include files for molecule {mol.get('name')}: {lIncludeFiles}")
         if len(lIncludeFiles) > 0 and type(lIncludeFiles) is not list: lIncludeFiles = [lIncludeFiles]
         #print ("lIncludeFiles:",lIncludeFiles)
         for fnm in lIncludeFiles:
@@ -111,102 +117,37 @@ def copy_parse_topology(sLigNm,TopPath,job_dir,sPhase,args,log):
             #print ("fnm:",fnm)
             copy_file_loc_2dist(fnm, utils.env.TopDir, job_dir)
 
-def resub(subDict, lines):
-    for key, value in subDict.items():
-        sVal = str(value)
-        #print("Pattern:",re.escape(key))
-        new_lines =[]
-        for l in lines:
-            new_l = re.sub(r'' + re.escape(key), sVal, l)
-            new_lines.append(new_l)
-        lines = new_lines
-    return new_lines
-
-def parse_lig_coor(ligand_lines, fullsys_lines, re_pattrn:str):
-    #print('re_pattrn: ', re_pattrn)
-    new_lines =[]
-    after_lig =[]
-    bBeforeLig = True
-    # Collect lines from fullsys_lines before ligand resnm
-    for l in fullsys_lines:
-        if re.search(r'' + re_pattrn, l):
-            bBeforeLig = False
-            if len(after_lig) > 0:
-                logging.error("Found the second ligand entry in the template structure:\n%s\nThere should be only single ligand entry.",l)
-                sys.exit(0)
-        else:
-            if bBeforeLig: new_lines.append(l)
-            else:          after_lig.append(l)
-    if bBeforeLig:
-        logging.error("Found no ligand entry in the structure. There should be one ligand entry.")
+def resnm_after_lig(template, lignm:str):
+    """
+    Residues after the ligand entry of the structure
+
+    :param template: PdbTemplate or GroTemplate of the structure
+    :param    lignm: resnm of the ligand
+    :return: dict resnm:number of atoms
+    """
+    try:
+        return template.res_after_lig(lignm)
+    except ValueError as e:
+        logging.error(str(e))
         sys.exit(0)
 
-    # Insert ligand_lines
-    for l in ligand_lines:
-        if re.search(r'' + re_pattrn, l): new_lines.append(l)
-    # append after_lig lines
-    for l in after_lig:
-        new_lines.append(l)
-
-    return new_lines
-def resnm_after_lig(coor_all, lignm:str, re_pattrn:str):
-    #print('re_pattrn: ', re_pattrn)
-    resnames_after_lig =[]
-    bAfterLig = False
-    # Collect lines from fullsys_lines before ligand resnm
-    for l in coor_all:
-        (resnm, nsubs) = re.subn(r''+re_pattrn, '\g<1>', l)  # (?=ATOM|HETATM) - POSITIVE LOOKAHEAD Zero-Length Assertions https://www.regular-expressions.info/lookaround.html
-        if nsubs == 0: continue # skip the record in no substitutions
-        resnm = resnm.strip()
-        if resnm == lignm:
-            bAfterLig = True
-            #print('Resnm:', resnm, l)
-            if len(resnames_after_lig) > 0:
-                logging.error("Found the second ligand entry in the template structure:\n%s\nThere should be only single ligand entry.",l)
-                sys.exit(0)
-        elif bAfterLig:
-            resnames_after_lig.append(resnm)
-    #print (resnames_after_lig)
-    uniqres = list(set(resnames_after_lig)) # sort| unique - sorted(set(list)) https://stackoverflow.com/questions/2931672/what-is-the-cleanest-way-to-do-a-sort-plus-uniq-on-a-python-list
-    res_after_lig = {resnm:resnames_after_lig.count(resnm) for resnm in uniqres} # Form dictionary of resnm:nat
-    #print ('Unique resnames after lig:', res_after_lig)
-    return res_after_lig
-
-def subst_lig_coor(coor_all,re_pattrn:str,lignm:str, coor_lig,logging):
-    coor_new = []
-    coor_after_lig =[]
-    resnames_after_lig =[]
-    bAfterLig = False
-    resnm_prev = ''
-    # Collect lines from fullsys_lines before ligand resnm
-    for l in coor_all:
-        (resnm, nsubs) = re.subn(r''+re_pattrn, '\g<1>', l)  # (?=ATOM|HETATM) - POSITIVE LOOKAHEAD Zero-Length Assertions https://www.regular-expressions.info/lookaround.html
-        if nsubs == 0:
-            if resnm_prev == lignm: continue  # Skip ligand records
-            if bAfterLig: coor_after_lig.append(l)
-            else: coor_new.append(l)
-            continue # skip resnm analysis if no resnm substitution
-        resnm = resnm.strip()
-        if resnm == lignm:
-            bAfterLig = True
-            #print('Resnm:', resnm, l)
-            if len(resnames_after_lig) > 0:
-                logging.error("Found the second ligand entry in the template structure:\n%s\nThere should be only single ligand entry.",l)
-                sys.exit(0)
-        else:
-            if bAfterLig:
-                coor_after_lig.append(l)
-                resnames_after_lig.append(resnm)
-            else:
-                coor_new.append(l)
-        resnm_prev = resnm
+def check_lig_entry(template, lignm:str, logging):
+    """
+    Check the single ligand entry of the template structure and report residues after it
 
-    if not bAfterLig:
-        logging.error("Found no entry with the ligand resnm \"{lignm}\" in the template structure. There must be one ligand entry.")
+    :param template: PdbTemplate or GroTemplate of the whole system
+    :param    lignm: resnm of the ligand
+    :return:
+    """
+    try:
+        block = template.ligand_block(lignm)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(0)
+    if block is None:
+        logging.error(f"Found no entry with the ligand resnm \"{lignm}\" in the template structure. There must be one ligand entry.")
         sys.exit(0)
-    uniqres = list(set(resnames_after_lig)) # sort| unique - sorted(set(list)) https://stackoverflow.com/questions/2931672/what-is-the-cleanest-way-to-do-a-sort-plus-uniq-on-a-python-list
-    res_after_lig = {resnm:resnames_after_lig.count(resnm) for resnm in uniqres} # Form dictionary of resnm:nat
-    #print ('Unique resnames after lig:', res_after_lig)
+    res_after_lig = template.res_after_lig(lignm)   # dictionary of resnm:nat
     if len(res_after_lig) == 0:
         logging.warning('Found no resnm after the ligand in the structure. This structure sequence ordering is uncommon for the \"parse-template\" SetupType.')
         #sys.exit(0)
@@ -215,13 +156,54 @@ def subst_lig_coor(coor_all,re_pattrn:str,lignm:str, coor_lig,logging):
     if len(res_after_lig) > 0:
         logging.info('Residues found in the structure after the ligand: %s',res_after_lig)
 
-    # Insert ligand_lines
-    for l in coor_lig:
-        if re.search(r'' + re_pattrn, l): coor_new.append(l)
-    # append after_lig lines
-    for l in coor_after_lig:
-        coor_new.append(l)
-    return coor_new
+def subst_lig_coor(template, lignm:str, coor_lig, logging):
+    """
+    Substitute the ligand entry of the template structure by the ligand coordinates
+
+    :param template: PdbTemplate of the whole system
+    :param    lignm: resnm of the ligand
+    :param coor_lig: PDB lines of the ligand structure
+    :return: list of text buffers of the system structure
+    """
+    check_lig_entry(template, lignm, logging)
+    return template.splice(lignm, coor_lig)
+
+def _load_template(path):
+    if os.path.splitext(path)[1] == '.gro':
+        return GroTemplate.from_file(path)       # GRO templates are streamed, only the ligand entry summary is kept
+    return PdbTemplate(read_file(path), path)
+templates = TemplateStore(_load_template)   # shared by all records of the runFile
+top_templates = TemplateStore(TopTemplate.from_file)
+def load_template_coor(path):
+    try:
+        return templates.get(path)
+    except OSError:
+        logging.error(f"Error: {path} doesn't exist! Exit")
+        sys.exit()
+
+def preload_templates(sPhases):
+    """
+    Parse the structure and topology templates of the phases once, before the records are prepared
+    (worker processes of "--jobs N" inherit the parsed templates)
+
+    :param sPhases: names of the phases used by the runFile records
+    :return:
+    """
+    for sPhase in set(sPhases):
+        phase_cfg = utils.env.Phase.get(sPhase)
+        if not phase_cfg: continue
+        TopTemplatePath = os.path.abspath(utils.env.TopDir + '/' + phase_cfg.get('TopTemplate',''))
+        if os.path.isfile(TopTemplatePath): top_templates.get(TopTemplatePath)
+        if phase_cfg.get('SetupType') != 'parse-template': continue
+        for name in (phase_cfg.get('IniStructure'), phase_cfg.get('PosreStructure')):
+            if not name or os.path.splitext(name)[1] not in {'.pdb','.gro'}: continue
+            template = load_template_coor(os.path.abspath(utils.env.TopDir + '/' + name))
+            for lignm in GetMolNm('ligand', phase_cfg.get('Molecule','')):
+                try:
+                    if isinstance(template, PdbTemplate): template.segments(lignm)
+                    else:                                 template.ligand_block(lignm)
+                except (OSError, TypeError, ValueError):   # reported when the record is prepared
+                    pass
 
 def GetMolNm(MolType, Molecules, bChkUniq = False):
     molnm = []
@@ -245,107 +227,101 @@ def parse_template_coor(lignm, CoorLigandPath, CoorTemplatePath, outCoorPath,log
     log.info(f"Substituting ligand coordinates {ligFileNm} to the system structure template {CoorTemplatePath}")
 
     coor_ext = os.path.splitext(CoorTemplatePath)[1]   # Extract file extension: prefix, ext = os.path.splitext(path)
-    coor_template   = read_file(CoorTemplatePath)  # Read structure of the whole system as a template
-    coor_ligand     = read_file(CoorLigandPath)  # Read structure of the ligand to be parsed into template
+    lig_ext  = os.path.splitext(CoorLigandPath)[1]
     
     #print('Ligans resname: ', lignm)
-    if coor_ext == '.pdb':
-        coor = subst_lig_coor(coor_template,'^(?=ATOM|HETATM).{17}(.{3}).+\n$',lignm, coor_ligand,log)  # (?=ATOM|HETATM) - POSITIVE LOOKAHEAD Zero-Length Assertions https://www.regular-expressions.info/lookaround.html
-    if coor_ext == '.gro':   # TODO: correct regex pattern. What if ext for lig and sys is different?
-        coor = subst_lig_coor(coor_template,'^(?=ATOM|HETATM)To Be Done for GRO-format\n$',lignm, coor_ligand,log)  # (?=ATOM|HETATM) - POSITIVE LOOKAHEAD Zero-Length Assertions https://www.regular-expressions.info/lookaround.html
+    if coor_ext == '.pdb' and lig_ext == '.pdb':
+        coor_template = load_template_coor(CoorTemplatePath)  # Structure of the whole system parsed once per runFile
+        coor_ligand   = read_file(CoorLigandPath)  # Read structure of the ligand to be parsed into template
+        coor = subst_lig_coor(coor_template, lignm, coor_ligand,log)
+        write_file(coor, outCoorPath)
+    elif coor_ext == '.gro' and lig_ext in {'.pdb','.gro'}:
+        coor_template = load_template_coor(CoorTemplatePath)  # GRO template is streamed into the output
+        check_lig_entry(coor_template, lignm, log)
+        coor_template.write_spliced(lignm, read_ligand_atoms(CoorLigandPath), outCoorPath)
+    else:
+        log.error(f"Substituting a \"{lig_ext}\" ligand into a \"{coor_ext}\" structure template is not supported: {CoorTemplatePath}")
+        sys.exit(0)
     #OutCoorPath = outCoorPrefix + coor_ext
-    write_file(coor, outCoorPath)
     #return OutCoorPath
 
-def  check_gmx(bingmx:str, log): #  call gmx without args
+def  check_gmx(bingmx:str, log): #  probe "gmx -version"
     """
-    Call gmx without input and extract from output its version
-    
+    Probe the gmx version (once per binary path and mtime, see utils.gmxrun)
+
     :param         bingmx: gmx binary
     :param            log: log channel
     :return:       versio: gmx version as printed in its headers
     """
-    ## https://stackoverflow.com/questions/163542/how-do-i-pass-a-string-into-subprocess-popen-using-the-stdin-argument
-    ## On Python 3.5+ (3.6+ for encoding), you could use subprocess.run, to pass input as a string to an external command
-    ## and get its exit status, and its output as a string back in one call
-    p = subprocess.run(bingmx, shell=True, capture_output=True)
-
-    # Check if the structure file was generated
-    sOut = ''.join( re.findall(r'([\n]GROMACS[^\n]+)[\n]', p.stderr.decode('utf-8') ) )
-    version = ''.join( re.findall(r'[\n](GROMACS\:[ \t]+[^\n]+)[\n]', sOut ) )
-    if len(sOut) > 0 :
+    version, call = gmxrun.runner(bingmx).version()
+    if version:
         log.info(f'Found executable {version} called by command:\"{bingmx}\"')
+        return version
     else:
         log.error(f"PROBLEM CALLING GMX EXECUTABLE \"{bingmx}\":\n"    \
                    + "#"*80                   + '\n'               \
-                   + p.stdout.decode('utf-8') + '\n'               \
-                   + p.stderr.decode('utf-8') + '\n'               \
+                   + call.stdout              + '\n'               \
+                   + call.stderr              + '\n'               \
                    + "#"*80 )
         sys.exit(0)
 
-def make_ndx_fromTemplate(bingmx: str, template_ndx: str, structure: str, cmd_ndx:str):
+_re_ndx_group = re.compile(r'^[ \t]*[0-9]+[ \t]+[^ \t\:]+[ \t]*\:[ \t]*[0-9]+[ \t]+atoms.*$', re.MULTILINE)
+
+def make_ndx_fromTemplate(bingmx: str, template_ndx: str, structure: str, cmd_ndx:str, cwd:str = None):
     """
     Generate system NDX file from template
     
     :param   template_ndx: NDX template file full path
     :param      structure: The full system structure file
     :param        cmd_ndx: stdin command for "gmx make_ndx" routine; by defult cmd_ndx="r LIG\\nr SOL\\nq\\n"
+    :param            cwd: directory in which "index.ndx" is generated (default: current dir)
     :return:
     """
     # cmd_ndx = 'r LIG\nr SOL\nq\n'  # Default value is good for most cases
-    #print ('make_ndx_cmd:', cmd_ndx)
-    cmd = bingmx + ' make_ndx -f ' + structure + ' -o index.ndx -n ' + template_ndx
+    call = gmxrun.runner(bingmx).run(['make_ndx', '-f', structure, '-o', 'index.ndx', '-n', template_ndx],
+                                     input=cmd_ndx, cwd=cwd)
     logging.info(f"Generating the system NDX-file from Template")
-    logging.info(f"Executing command: {cmd}")
+    logging.info(f"Executed command: {call.cmd} ({call.wall:.1f} s)")
     logging.info(f"make_ndx stdin commands:\n{cmd_ndx}")
-    ## https://stackoverflow.com/questions/163542/how-do-i-pass-a-string-into-subprocess-popen-using-the-stdin-argument
-    ## On Python 3.5+ (3.6+ for encoding), you could use subprocess.run, to pass input as a string to an external command
-    ## and get its exit status, and its output as a string back in one call
-    p = subprocess.run(cmd, input=cmd_ndx.encode('ascii'), shell=True, capture_output=True)
 
     # Analize output of make_ndx - extract generated groups
-    ndx_groups = ''
-    for line in re.findall(r'[^\n][0-9]+[ \t]+[^ \t\:]+[ \t]*\:[ \t]*[0-9]+[ \t]+atoms[^\n]*\n', p.stdout.decode('utf-8')):
-        ndx_groups = ndx_groups + line
-    if os.path.isfile('./index.ndx') and len(ndx_groups) > 0:
-        ndx_groups = 'Generated NDX Groups:\n' + ndx_groups
-        logging.info(ndx_groups)
+    ndx_groups = _re_ndx_group.findall(call.stdout)
+    if call.ok and os.path.isfile(os.path.join(cwd or '.', 'index.ndx')) and len(ndx_groups) > 0:
+        logging.info('Generated NDX Groups:\n' + '\n'.join(ndx_groups))
     else:
-        logging.error(f"PROBLEM AT GENERATING INDEX FILE")
-        logging.error(p.stdout.decode('utf-8'))
-        logging.error(p.stderr.decode('utf-8'))
+        logging.error(f"PROBLEM AT GENERATING INDEX FILE (exit code {call.returncode})")
+        logging.error(call.stdout)
+        logging.error(call.stderr)
         sys.exit(0)
 
-def  center_box(bingmx:str, box, inStruc:str,  outStruc:str, log): #  generate shifted to center ligand stucture by "gmx editconf"
+def  center_box(bingmx:str, box, inStruc:str,  outStruc:str, log, cwd:str = None): #  generate shifted to center ligand stucture by "gmx editconf"
     """
     Generate box-centered structure
     
     :param            box: box size (str with 3 float dimensions)
     :param        inStruc: Input structure file
     :param       outStruc: Output structure file
+    :param            cwd: working directory of "gmx editconf" (default: current dir)
     :return:
     """
-    #print ('make_ndx_cmd:', cmd_ndx)
-    cmd = bingmx + ' editconf -princ -box ' + box + ' -f ' + inStruc + ' -o ' + outStruc
     log.info(f"Create the structure with the ligand at the ceneter of the box \"{box}\"")
-    log.info(f"Executing command: {cmd}")
-    ## https://stackoverflow.com/questions/163542/how-do-i-pass-a-string-into-subprocess-popen-using-the-stdin-argument
-    ## On Python 3.5+ (3.6+ for encoding), you could use subprocess.run, to pass input as a string to an external command
-    ## and get its exit status, and its output as a string back in one call
-    p = subprocess.run(cmd, input='0'.encode('ascii'), shell=True, capture_output=True)
+    # "0": the group of the principal axes (System)
+    call = gmxrun.runner(bingmx).run(['editconf', '-princ', '-box'] + str(box).split() + ['-f', inStruc, '-o', outStruc],
+                                     input='0', cwd=cwd)
+    log.info(f"Executed command: {call.cmd} ({call.wall:.1f} s)")
 
     # Check if the structure file was generated
-    lsOut = ''.join( re.findall(r'([^:\n]+[:][^:\n]+[\n])', p.stdout.decode('utf-8') ) )
-    if len(lsOut) > 10 and os.path.isfile(outStruc) and os.path.getsize(outStruc) > 0:
+    outPath = os.path.join(cwd or '.', outStruc)
+    if call.ok and os.path.isfile(outPath) and os.path.getsize(outPath) > 0:
         log.info(f'The centered structure \"{outStruc}\" was generated.')
-        log.debug('EDITCONF OUTPUT:\n%s', "#"*80 +'\n' + ''.join(lsOut) + "#"*80 +'\n')
+        log.debug('EDITCONF OUTPUT:\n%s', "#"*80 +'\n' + call.stdout + "#"*80 +'\n')
     else:
-        log.error(f"PROBLEM AT GENERATING CENTERED STRUCTURE FILE \"{outStruc}\":")
-        log.error(p.stdout.decode('utf-8'))
-        log.error(p.stderr.decode('utf-8'))
+        log.error(f"PROBLEM AT GENERATING CENTERED STRUCTURE FILE \"{outStruc}\" (exit code {call.returncode}):")
+        log.error(call.stdout)
+        log.error(call.stderr)
         sys.exit(0)
 
-def  solvate_box(bingmx:str, box, inStruc:str, outStruc:str, Top:str, log): #  generate shifted to center ligand stucture by "gmx editconf"
+def  solvate_box(bingmx:str, box, inStruc:str, outStruc:str, Top:str, log, cwd:str = None): #  generate shifted to center ligand stucture by "gmx editconf"
     # For Water solvent use solvate without "-cs" option (unless set gmxpth_solvate=gmx5.1) because "-cs" results in seg-fault crashes with gmx2016+ ver.
     # -cs option is probably required for non-water solvents only
     #echo -e "${gmxpth_solvate}/gmx_d solvate -scale 0.45 -cp $MolNmOut'_centered.pdb' -box $box $box $box -o $outnm'_0.pdb' -p $outnm'.top'\nrm '#'$outnm'.top'*" >> $sge_script0
@@ -357,26 +333,23 @@ def  solvate_box(bingmx:str, box, inStruc:str, outStruc:str, Top:str, log): #  g
     :param            Top: Input (also output) topology file
     :param        inStruc: Input structure file
     :param       outStruc: Output structure file
+    :param            cwd: working directory of "gmx solvate" (default: current dir)
     :return:
     """
-    #print ('make_ndx_cmd:', cmd_ndx)
-    cmd = bingmx + ' solvate -scale 0.45 -box ' + box + ' -cp ' + inStruc + ' -o ' + outStruc + ' -p ' + Top
     log.info(f"Solvate the structure with the ligand at the ceneter of the box \"{box}\"")
-    log.info(f"Executing command: {cmd}")
-    ## https://stackoverflow.com/questions/163542/how-do-i-pass-a-string-into-subprocess-popen-using-the-stdin-argument
-    ## On Python 3.5+ (3.6+ for encoding), you could use subprocess.run, to pass input as a string to an external command
-    ## and get its exit status, and its output as a string back in one call
-    p = subprocess.run(cmd, shell=True, capture_output=True)
+    call = gmxrun.runner(bingmx).run(['solvate', '-scale', '0.45', '-box'] + str(box).split()
+                                     + ['-cp', inStruc, '-o', outStruc, '-p', Top], cwd=cwd)
+    log.info(f"Executed command: {call.cmd} ({call.wall:.1f} s)")
 
     # Check if the structure file was generated
-    lsOut = ''.join( re.findall(r'([^:\n]+[:][^:\n]+[\n])', p.stderr.decode('utf-8') ) )
-    if len(lsOut) > 10 and os.path.isfile(outStruc) and os.path.getsize(outStruc) > 0:
-        log.info(f'The centered structure \"{outStruc}\" was generated.')
-        log.debug('EDITCONF OUTPUT:\n%s', "#"*80 +'\n' + ''.join(lsOut) + "#"*80 +'\n')
+    outPath = os.path.join(cwd or '.', outStruc)
+    if call.ok and os.path.isfile(outPath) and os.path.getsize(outPath) > 0:
+        log.info(f'The solvated structure \"{outStruc}\" was generated.')
+        log.debug('SOLVATE OUTPUT:\n%s', "#"*80 +'\n' + call.stderr + "#"*80 +'\n')
     else:
-        log.error(f"PROBLEM AT GENERATING CENTERED STRUCTURE FILE \"{outStruc}\":")
-        log.error(p.stdout.decode('utf-8'))
-        log.error(p.stderr.decode('utf-8'))
+        log.error(f"PROBLEM AT GENERATING SOLVATED STRUCTURE FILE \"{outStruc}\" (exit code {call.returncode}):")
+        log.error(call.stdout)
+        log.error(call.stderr)
         sys.exit(0)
 
 def addTask_to_workflow(workflow, Task:str, coorFileNm:str, MdpFile:str, JobArgs, args):
@@ -432,6 +405,13 @@ def addTask_to_workflow(workflow, Task:str, coorFileNm:str, MdpFile:str, JobArgs
     workflow.append(  '############## Task: ' + Task + ' #################')
     workflow.append(  '##########################################')
     workflow.append('cd ' + Task + '/${subdir}/')
+    # A finished Task is skipped when the job script is run again (e.g. gmxfe run_ti --resume)
+    TaskOutGro = outnm + '_' + Task.lower() + '.gro'
+    workflow.append('if [ ! -s \'' + TaskOutGro + '\' ]; then')
+    if utils.env.Type == 'run_ti' and utils.env.bSingleMdp:
+        # Single Task MDP: override the lambda state of the TI point at run time
+        workflow.append('{ grep -v \'^[[:space:]]*init[-_]lambda[-_]state\' ../' + MdpFile
+                        + '; echo "init-lambda-state = ${lambda}"; } > ' + MdpFile)
     # grompp commands
     #print(JobArgs)
     line = bingmx + ' grompp ' + JobArgs.get('grompp-flags')       \
@@ -446,23 +426,43 @@ def addTask_to_workflow(workflow, Task:str, coorFileNm:str, MdpFile:str, JobArgs
     #workflow.append('    check_file '+ outnm +'.tpr \'ERROR: ' + outnm +'.tpr was not created for Task: '+Task+', exit the job.\'')
     workflow.append('if [ ! -r \'' + outnm + '.tpr\' ]; then')
     workflow.append('    echo ERROR: \'' + outnm +'.tpr\' for Task: '+Task+' was not created, exit the job.')
-    workflow.append('    exit')
+    workflow.append('    exit 1')
     workflow.append('fi')
-    # mdrun command
+    # continue from the checkpoint of an interrupted run
+    workflow.append('cpi=\'\'; if [ -f \'' + outnm + '.cpt\' ]; then cpi=\'-cpi ' + outnm + '.cpt\'; fi')
+    # mdrun command: thread/GPU flags follow the build of the binary (see gmxrun.GmxRunner.probe)
+    res  = task_resources(Task, args)
     line = bingmx + ' mdrun ' +  JobArgs.get('mdrun-flags')         \
-           + ' -nt ' + str(args.ncpu)                               \
+           + gmxrun.runner(bingmx).mdrun_flags(res['ncpu'], res['gpu'], JobArgs.get('mdrun-flags')) \
            + ' -s ' + outnm + '.tpr'                                \
            + ' -dhdl dhdl.xvg'                                      \
-           + ' -c ' + outnm +'_' + Task.lower() + '.gro'            \
+           + ' -c ' + TaskOutGro                                    \
            + ' -deffnm ' + outnm                                    \
-           + ' -g ' + JobArgs.get('job_dir')+'/'+Task+'/${subdir}/'+outnm+'.log'
+           + ' -g ' + JobArgs.get('job_dir')+'/'+Task+'/${subdir}/'+outnm+'.log' \
+           + ' ${cpi}'                                              \
+           + ' ${GMXFE_MDRUN_LOCAL}'        # pinning/GPU of the local executor slot (empty under schedulers)
     workflow.append(line)
+    workflow.append('if [ ! -s \'' + TaskOutGro + '\' ]; then')
+    workflow.append('    echo ERROR: mdrun of Task: '+Task+' failed, exit the job.')
+    workflow.append('    exit 1')
+    workflow.append('fi')
+    workflow.append('fi')
     workflow.append('cd ${JobDir}')
     #workflow.append('    move_files_to_jobdir \''+ JobArgs.get('sJobDirFull')+'/'+Task+'/\'')
     return workflow
 
 
-def job_init(sJobNm, sLigNm, sPhase, args):
+def job_init(sJobNm, sLigNm, sPhase, args, job_id=None):
+    """
+    Check the record's input files and create the job directory
+
+    :param sJobNm: name of the job
+    :param sLigNm: ligand name
+    :param sPhase: phase in template (Gas, Water, Protein)
+    :param   args: arguments of gmxFE command
+    :param job_id: job ID preallocated by the caller (default: next ID of the OutDir counter)
+    :return: JobArgs dictionary of the job script parameters
+    """
     # Check that Phase and ligand files are defined
     phase_cfg = utils.env.Phase.get(sPhase)
     #phase_cfg = args.gmxconfig.Phase.get(sPhase)
@@ -509,14 +509,23 @@ def job_init(sJobNm, sLigNm, sPhase, args):
     sRunNm = sLigNm + "_" + FileLabel
     # JobArgs['sJobDirFull'] = job_dir
     # JobArgs['sRunNm'] = sRunNm
-    job_id = str(1 + scheduler.get_last_job_id(utils.env.queue))   # TODO rename vars at sge 
-    job_dir_name = job_id + '.' + DirPrefix + '_' + sJobNm
-    logging.debug(f"job dir name: {job_dir_name}")
-    # create job directory
-    job_dir = os.path.abspath(utils.env.OutDir + "/" + job_dir_name)
-    logging.info("path to job dir: %s", job_dir)
-    #  Create Working Folder
-    os.makedirs(job_dir)
+    resume_dir = find_resume_dir(getattr(args, 'resume', None), DirPrefix, sJobNm)
+    if resume_dir:
+        # Resume the job in its existing dir: the job ID is kept, finished windows are not submitted
+        job_id  = os.path.basename(resume_dir).split('.')[0]
+        job_dir = resume_dir
+        logging.info("resuming the job in: %s", job_dir)
+    else:
+        if job_id is None:
+            job_id = jobid.reserve(utils.env.OutDir)
+        job_id = str(job_id)
+        job_dir_name = job_id + '.' + DirPrefix + '_' + sJobNm
+        logging.debug(f"job dir name: {job_dir_name}")
+        # create job directory
+        job_dir = os.path.abspath(utils.env.OutDir + "/" + job_dir_name)
+        logging.info("path to job dir: %s", job_dir)
+        #  Create Working Folder
+        os.makedirs(job_dir)
     if utils.env.Type == 'run_ti':
         logging.info(f"Starting TI simulation of {sJobNm} in {sPhase}")
     elif utils.env.Type == 'run_md':
@@ -533,50 +542,184 @@ def job_init(sJobNm, sLigNm, sPhase, args):
                'sPhase'          : sPhase,
                'sJobNm'          : sJobNm,
                'sRunNm'          : sRunNm,
+               'coor'            : sRunNm + '.pdb',       # system structure file, set by top_coor
                'job_dir'         : job_dir,
                'jobid'           : job_id,
                'grompp-flags'    : phase_cfg.get('grompp_flags',''),    # ' -maxwarn 2000' - in Protein to suppress an error due to multiple warrnings
                'mdrun-flags'     : phase_cfg.get('mdrun_flags',''),     # ' -ntmpi' - To limit number of MPI-threads per mdrun
                'ndx-option'      : '',
                'posre-option'    : '',
-               'workflow'        : []
+               'mdp-slots'       : {},
+               'workflow'        : [],
+               'resume'          : bool(resume_dir)
                }
     return JobArgs
 
-def top_coor(sLigNm, sPhase, JobArgs, args):
+def find_resume_dir(resume_dirs, DirPrefix, sJobNm):
     """
-    MAIN ROUTINE to setup MD input Topology and Coordinate files
-    :param sJobNm: name of the job
-    :param sLigNm: ligand name
-    :param sPhase: phase in template (Gas, Water, Protein)
-    :param args: arguments of gmxFE command
+    Find the job dir "<ID>.<DirPrefix>_<jobnm>" of the record among the --resume dirs
+
+    :param resume_dirs: job dirs given by --resume (None if not resuming)
+    :return: absolute path of the job dir or None
+    """
+    if not resume_dirs: return None
+    suffix = '.' + DirPrefix + '_' + sJobNm
+    matches = [os.path.abspath(d) for d in resume_dirs if os.path.basename(os.path.abspath(d)).endswith(suffix)]
+    if len(matches) > 1:
+        logging.error(f'Several --resume dirs match the job {sJobNm}: {matches}')
+        sys.exit(0)
+    if matches and not os.path.isdir(matches[0]):
+        logging.error(f'The --resume dir {matches[0]} does not exist')
+        sys.exit(0)
+    return matches[0] if matches else None
+
+def keep_on_resume(JobArgs, *paths):
+    """
+    Files of a resumed job are kept if they exist: running and finished TI windows depend on them
+
+    :param JobArgs: dictionary of the job script parameters
+    :param   paths: file paths
+    :return: True if the job is resumed and all files exist and are not empty
+    """
+    return bool(JobArgs.get('resume')) and all(os.path.isfile(p) and os.path.getsize(p) > 0 for p in paths)
+
+def md_log_complete(path):
+    """
+    :param path: mdrun log
+    :return: True if mdrun has finished writing the log ("Finished mdrun on rank 0" at its end)
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(path) - 4096))
+            return b'Finished mdrun' in f.read()
+    except OSError:
+        return False
+
+def window_done(JobArgs, lam):
+    """
+    :param JobArgs: dictionary of the job script parameters
+    :param     lam: lambda point number
+    :return: True if the last Task of the lambda window has its final structure, dhdl.xvg and complete log
+    """
+    Task = JobArgs['workflow'][-1]
+    subdir = os.path.join(JobArgs['job_dir'], Task, utils.env.sTIdir + str(lam))
+    gro = os.path.join(subdir, JobArgs['outnm'] + '_' + Task.lower() + '.gro')
+    return os.path.isfile(gro) and os.path.getsize(gro) > 0 and os.path.isfile(os.path.join(subdir, 'dhdl.xvg')) \
+        and md_log_complete(os.path.join(subdir, JobArgs['outnm'] + '.log'))
+
+def window_records(JobArgs):
+    """
+    Records of the TI windows of the job in the ResFile ledger, matched by the output dir
+    or by the job ID, job name and lambda point (the job dir may be reached by another path)
+
+    :param JobArgs: dictionary of the job script parameters
+    :return: dict lambda point number -> the last record of the window
+    """
+    base = os.path.realpath(os.path.join(JobArgs['job_dir'], JobArgs['workflow'][-1]))
+    re_subdir = re.compile(re.escape(utils.env.sTIdir) + r'([0-9]+)$')
+    records = {}
+    for rec in ledger.read_ledger(utils.env.ResFile):
+        outdir = rec.get('outdir', '')
+        same_job = str(rec.get('jobid')) == str(JobArgs['jobid']) and rec.get('job') == JobArgs['sJobNm']
+        if not same_job and os.path.realpath(os.path.dirname(outdir)) != base: continue
+        lam = rec.get('lambda')
+        if lam is None:           # former record format: the lambda point is only in the output dir
+            m = re_subdir.match(os.path.basename(outdir))
+            if not m: continue
+            lam = m.group(1)
+        records[int(lam)] = rec
+    return records
+
+def resume_windows(JobArgs, Lambdas, submitted):
+    """
+    Select the TI windows of a resumed job to submit. A window of the former submission without
+    a ledger record may still be queued or running: it is not submitted a second time into the same subdir.
+
+    :param   JobArgs: dictionary of the job script parameters
+    :param   Lambdas: lambda point numbers of the job
+    :param submitted: lambda point numbers whose job scripts existed before the resume
+    :return: lambda point numbers to submit
+    """
+    records = window_records(JobArgs)
+    done, pending, submit = [], [], []
+    for iL in Lambdas:
+        rec = records.get(iL)
+        if window_done(JobArgs, iL) and (rec is None or rec.get('status') == 'done'):
+            done.append(iL)
+        elif rec is None and iL in submitted:
+            pending.append(iL)
+        else:
+            submit.append(iL)        # failed, finished with incomplete output or never submitted
+    logging.info("Finished TI points are skipped: %s", done)
+    if pending:
+        logging.warning(f"TI points {pending} of {JobArgs['job_dir']} have no record in the ResFile {utils.env.ResFile}: "
+                        f"they may be queued or running and are not submitted again. Resume after they finish, "
+                        f"or remove their job scripts to resubmit them")
+    return submit
+
+def box_cache_lookup(sLigNm, phase_cfg, SetupType):
+    """
+    Box cache and the key of the box setup of the ligand in the phase
+
+    :param    sLigNm: ligand name
+    :param phase_cfg: config of the phase
+    :param SetupType: SetupType of the phase
+    :return: (BoxCache, key) or (None, None) if the cache is disabled or not useful for the SetupType
+    """
+    if not utils.env.BoxCacheDir or SetupType == 'none':
+        return None, None
+    def top_path(name):
+        return os.path.abspath(utils.env.TopDir + '/' + name) if name else ''
+    inputs = {'ligand'       : sLigNm,
+              'ligand.pdb'   : boxcache.file_digest(top_path(sLigNm + '.pdb')),
+              'boxsize'      : phase_cfg.get('boxsize',''),
+              'SetupType'    : SetupType,
+              'FileLabel'    : phase_cfg.get('FileLabel',''),
+              'Molecule'     : GetMolNm('ligand', phase_cfg.get('Molecule','')),
+              'TopTemplate'  : boxcache.file_digest(top_path(phase_cfg.get('TopTemplate',''))),
+              'TopParams'    : sorted((str(k), str(v)) for k, v in (phase_cfg.get('TopParams') or {}).items()),
+              'IniStructure' : boxcache.file_digest(top_path(phase_cfg.get('IniStructure',''))),
+              'PosreStructure': boxcache.file_digest(top_path(phase_cfg.get('PosreStructure',''))),
+              'UseNdx'       : bool(phase_cfg.get('UseNdx')),
+              'NdxTemplate'  : boxcache.file_digest(top_path(phase_cfg.get('NdxTemplate',''))) if phase_cfg.get('UseNdx') else '',
+              'Make_ndx_CMD' : phase_cfg.get('Make_ndx_CMD',''),
+              'gmx'          : utils.env.sGmxVersion,
+              }
+    try:
+        return boxcache.BoxCache(utils.env.BoxCacheDir, utils.env.BoxCacheSize), boxcache.box_key(inputs)
+    except OSError as e:
+        logging.warning(f'The box cache {utils.env.BoxCacheDir} is not usable: {e}')
+        return None, None
+
+def box_coor_files(sRunNm, phase_cfg):
+    """
+    Names of the system structure and the POSRE reference files: GRO templates give GRO structures
+
+    :param    sRunNm: run name of the job
+    :param phase_cfg: config of the phase
+    :return: (structure file name, POSRE reference file name)
+    """
+    def ext(name):
+        return '.gro' if name and os.path.splitext(name)[1] == '.gro' else '.pdb'
+    coor_ext = ext(phase_cfg.get('IniStructure')) if phase_cfg.get('SetupType') == 'parse-template' else '.pdb'
+    return sRunNm + coor_ext, sRunNm + '_Xray' + ext(phase_cfg.get('PosreStructure'))
+
+def setup_box(sLigNm, sPhase, phase_cfg, SetupType, JobArgs):
+    """
+    Generate the system structure (and the index/POSRE reference files) for the SetupType
+
+    :param    sLigNm: ligand name
+    :param    sPhase: phase in template (Gas, Water, Protein)
+    :param phase_cfg: config of the phase
+    :param SetupType: SetupType of the phase
+    :param   JobArgs: dictionary of the job script parameters
     :return:
     """
-    ##
-    ## SETUP SIMULATION BOX
-    ##
-    ##
-    ## 1. SETUP config parameters
-    ## Define GMX binary paths
     sRunNm = JobArgs['sRunNm']
     job_dir = JobArgs['job_dir']
     bingmx = JobArgs['gmx']
-    TopPath = sRunNm + '.top'
-    CoorPath = sRunNm + '.pdb'
-    #phase_cfg = args.gmxconfig.Phase.get(sPhase)
-    phase_cfg = utils.env.Phase.get(sPhase)
-    ##
-    ## Set System Topology
-    ##
-    copy_parse_topology(sLigNm,TopPath,job_dir,sPhase,args,logging)
-    ##
-    ## Set System Structure
-    ##
-    SetupType = phase_cfg.get('SetupType')
-    if SetupType: logging.info(f"Do \"{SetupType}\" for setting up the \"{sPhase}\" phase system BOX.")
-    else:
-        logging.error(f'SetupType for phase {sPhase} was not found in the config.')
-        sys.exit(0)
+    TopPath = os.path.join(job_dir, sRunNm + '.top')
+    CoorPath = os.path.join(job_dir, JobArgs['coor'])
     if SetupType == 'parse-template':
         lignm = GetMolNm('ligand', phase_cfg.get('Molecule'), True)[0]
         CoorTemplatePath = os.path.abspath(utils.env.TopDir + '/' + phase_cfg.get('IniStructure'))
@@ -589,15 +732,12 @@ def top_coor(sLigNm, sPhase, JobArgs, args):
               # outndx=$(echo -e "r LIG\nr SOL\nq\n"| $gmxpth/gmx_d make_ndx -n index -f $outnm'_ini.pdb' 2>/dev/null| sed -n '/LIG\|SOL/p')
               # echo -e "Make index file for a given mutation of ligands:\n$outndx"
         if phase_cfg.get('UseNdx'):
-            JobArgs['ndx-option'] = ' -n ${JobDir}/index.ndx'
             NdxTemplatePath =  os.path.abspath(utils.env.TopDir + '/' + phase_cfg.get('NdxTemplate'))
             logging.info(f"Generating the system NDX-file from Template: {NdxTemplatePath}")
             make_ndx_cmd = phase_cfg.get('Make_ndx_CMD', 'r LIG\\nr SOL\\nq\\n') # Read User defined or set default make_ndx_cmd = 'r LIG\nr SOL\nq\n', NOTE '\\n' because https://stackoverflow.com/questions/38401450/n-in-strings-not-working
             #make_ndx_cmd = make_ndx_cmd if len(make_ndx_cmd) else 'r LIG\nr SOL\nq\n' # set default make_ndx_cmd = 'r LIG\nr SOL\nq\n'
-            # All resnm after ligand entry to be generated by make_ndx
-            coor   = read_file(CoorPath)
-            lignm = GetMolNm('ligand', phase_cfg.get('Molecule'), True)[0]
-            res_after_lig = resnm_after_lig(coor, lignm, '^(?=ATOM|HETATM).{17}(.{3}).+\n$')  # PDB: resnm position 18-20  # (?=ATOM|HETATM) - POSITIVE LOOKAHEAD Zero-Length Assertions https://www.regular-expressions.info/lookaround.html
+            # All resnm after ligand entry to be generated by make_ndx (the same in the template and in the spliced structure)
+            res_after_lig = resnm_after_lig(load_template_coor(CoorTemplatePath), lignm)
             if len(res_after_lig) > 0:
                 logging.info('Merging the make_ndx command \'%s\' with residues found in the structure after the ligand: %s',make_ndx_cmd,list(res_after_lig.keys()))
                 for resnm in res_after_lig.keys():
@@ -606,25 +746,26 @@ def top_coor(sLigNm, sPhase, JobArgs, args):
             logging.info('The command passed to the make_ndx routine: \'%s\'',make_ndx_cmd)
             # NOTE, before this line all '\n' chars in make_ndx_cmd should be actually 2-char strings '\\n'. Bellow we convert to '\n' new line symb.
             make_ndx_cmd = re.sub(r'\\n','\n',make_ndx_cmd) # Subs '\\n' by the new line symbol '\n':
-            make_ndx_fromTemplate(bingmx, NdxTemplatePath, CoorPath, make_ndx_cmd) #  generate index goups for "LIG" and "SOL" by "gmx make_ndx"
+            make_ndx_fromTemplate(bingmx, NdxTemplatePath, CoorPath, make_ndx_cmd, job_dir) #  generate index goups for "LIG" and "SOL" by "gmx make_ndx"
         #sys.exit(0)
     elif SetupType == 'box-center+solvate':
         logging.info(f"Place the ligand \"{sLigNm}\" at the center of the simulaion box and solvate")
         CoorLigandPath  =  os.path.abspath(utils.env.TopDir + '/' + sLigNm + '.pdb')
         box = phase_cfg.get('boxsize')
-        center_box(bingmx, box, CoorLigandPath,  sRunNm + '_centered.pdb', logging) #  generate shifted to center ligand stucture by "gmx editconf"
-        solvate_box(bingmx, box, sRunNm + '_centered.pdb',  sRunNm + '.pdb', sRunNm + '.top', logging) #  solvate the ligand stucture by "gmx solvate" and add solvent to topology
+        CenteredPath    =  os.path.join(job_dir, sRunNm + '_centered.pdb')
+        center_box(bingmx, box, CoorLigandPath,  CenteredPath, logging, job_dir) #  generate shifted to center ligand stucture by "gmx editconf"
+        solvate_box(bingmx, box, CenteredPath,  CoorPath, TopPath, logging, job_dir) #  solvate the ligand stucture by "gmx solvate" and add solvent to topology
         #sys.exit(0)
     elif SetupType == 'box-center':
         logging.info(f"Place the ligand \"{sLigNm}\" at the center of the simulaion box.")
         CoorLigandPath  =  os.path.abspath(utils.env.TopDir + '/' + sLigNm + '.pdb')
         box = phase_cfg.get('boxsize')
-        center_box(bingmx, box, CoorLigandPath,  sRunNm + '.pdb', logging) #  generate shifted to center ligand stucture by "gmx editconf"
+        center_box(bingmx, box, CoorLigandPath,  CoorPath, logging, job_dir) #  generate shifted to center ligand stucture by "gmx editconf"
         #sys.exit(0)
     elif SetupType == 'none':
         #CoorLigandPath  =  os.path.abspath(utils.env.TopDir + '/' + sLigNm + '.pdb')
         logging.info(f"Use the ligand initial structure \"{sLigNm}\"")
-        copy_file_loc_2dist(sLigNm + '.pdb', utils.env.TopDir, job_dir + '/' + sRunNm + '.pdb')
+        copy_file_loc_2dist(sLigNm + '.pdb', utils.env.TopDir, CoorPath)
     else:
         logging.error(f"The \"{SetupType}\" SetupType is not supported yet.")
         sys.exit(0)
@@ -634,24 +775,97 @@ def top_coor(sLigNm, sPhase, JobArgs, args):
     if PosreTemplate:
         logging.info(f"Use the user defined structure for the POSRE reference coordinates: {PosreTemplate}")
         PosreTemplate = os.path.abspath(utils.env.TopDir + '/' + PosreTemplate)
-        PosrePath = sRunNm + '_Xray.pdb'
+        PosrePath = os.path.join(job_dir, box_coor_files(sRunNm, phase_cfg)[1])
         parse_template_coor(lignm, CoorLigandPath, PosreTemplate, PosrePath,logging)
-        JobArgs['posre-option'] = ' -r ${JobDir}/' + PosrePath
+
+def top_coor(sLigNm, sPhase, JobArgs, args):
+    """
+    MAIN ROUTINE to setup MD input Topology and Coordinate files
+    :param sJobNm: name of the job
+    :param sLigNm: ligand name
+    :param sPhase: phase in template (Gas, Water, Protein)
+    :param args: arguments of gmxFE command
+    :return:
+    """
+    ##
+    ## SETUP SIMULATION BOX
+    ##
+    ##
+    ## 1. SETUP config parameters
+    ## Define GMX binary paths
+    sRunNm = JobArgs['sRunNm']
+    job_dir = JobArgs['job_dir']
+    bingmx = JobArgs['gmx']
+    #phase_cfg = args.gmxconfig.Phase.get(sPhase)
+    phase_cfg = utils.env.Phase.get(sPhase)
+    CoorFile, PosreFile = box_coor_files(sRunNm, phase_cfg)
+    JobArgs['coor'] = CoorFile
+    TopPath = os.path.join(job_dir, sRunNm + '.top')
+    CoorPath = os.path.join(job_dir, CoorFile)
+    SetupType = phase_cfg.get('SetupType')
+    if SetupType: logging.info(f"Do \"{SetupType}\" for setting up the \"{sPhase}\" phase system BOX.")
+    else:
+        logging.error(f'SetupType for phase {sPhase} was not found in the config.')
+        sys.exit(0)
+    PosreTemplate = phase_cfg.get('PosreStructure')
+    PosrePath = os.path.join(job_dir, PosreFile)
+    BoxFiles = [TopPath, CoorPath]
+    if SetupType == 'parse-template' and phase_cfg.get('UseNdx'): BoxFiles.append(os.path.join(job_dir, 'index.ndx'))
+    if PosreTemplate:                                             BoxFiles.append(PosrePath)
+    BoxFiles = [os.path.basename(f) for f in BoxFiles]
+    if keep_on_resume(JobArgs, *(os.path.join(job_dir, f) for f in BoxFiles)):
+        logging.info(f"The topology and structure files of the resumed job are kept: {BoxFiles}")
+    else:
+        if JobArgs.get('resume'):
+            # Incomplete setup of the resumed job: the files are written anew, not through old links
+            for f in BoxFiles:
+                if os.path.lexists(os.path.join(job_dir, f)): os.remove(os.path.join(job_dir, f))
+        ##
+        ## Set System Topology
+        ##
+        copy_parse_topology(sLigNm,TopPath,job_dir,sPhase,args,logging)
+        ##
+        ## Set System Structure: reuse the box prepared from the same inputs by a previous job
+        ##
+        box_cache, box_id = box_cache_lookup(sLigNm, phase_cfg, SetupType)
+        if box_cache and box_cache.fetch(box_id, BoxFiles, job_dir):
+            logging.info(f"The system box for the ligand \"{sLigNm}\" in the \"{sPhase}\" phase is taken from the box cache {box_cache.root} ({box_id[:12]})")
+        else:
+            setup_box(sLigNm, sPhase, phase_cfg, SetupType, JobArgs)
+            if box_cache: box_cache.store(box_id, BoxFiles, job_dir)
+
+    if SetupType == 'parse-template' and phase_cfg.get('UseNdx'):
+        JobArgs['ndx-option'] = ' -n ${JobDir}/index.ndx'
+    # Set position restrain reference file for ALL phases. But the use of POSRE is controlled by keywords defined in MDP
+    if PosreTemplate:
+        JobArgs['posre-option'] = ' -r ${JobDir}/' + os.path.basename(PosrePath)
     else:
        logging.info(f"Use the initial system structure for the POSRE reference coordinates")
-       JobArgs['posre-option'] = ' -r ${JobDir}/' + CoorPath
+       JobArgs['posre-option'] = ' -r ${JobDir}/' + os.path.basename(CoorPath)
     logging.info(f"Topology and Structure files for the ligand \"{sLigNm}\" in the \"{sPhase}\" phase are successfully generated.")
     #sys.exit(0)
     return JobArgs
 
 
 
-def mdp_Tasks(sLigNm, sPhase, job_dir, JobArgs, args):
-    ##
-    ## Set MDP config files
-    ##
+##
+## Rendered MDPs of the (Phase, Task) pairs: the config layers depend only on the Phase and the Task,
+## so they are merged and rendered once per campaign and every ligand writes the same bytes
+##
+_phase_mdps = {}       # (Phase, simulation type) -> list of (Task, MdpFile, MDP bytes, MdpSlot or None)
+_mdp_store  = {}       # MDP bytes -> path in <OutDir>/.mdp (--mdp-links)
+
+def phase_mdps(sPhase, args):
+    """
+    Render the MDPs of the Phase workflow once (cached for the following records)
+
+    :param sPhase: phase in template (Gas, Water, Protein)
+    :param   args: arguments of gmxFE command
+    :return: list of (Task, MDP file name, MDP bytes, MdpSlot of "init-lambda-state" for TI or None) in the workflow order
+    """
+    key = (sPhase, utils.env.Type)
+    if key in _phase_mdps: return _phase_mdps[key]
     # Pick correct config template
-    logging.info(f"\nSetting up the MD Parameter (MDP) files for all Tasks")
     phase_cfg = utils.env.Phase.get(sPhase)
     if utils.env.Type == 'run_ti':
         MdpTemplateName = phase_cfg.get('MdpTemplate')
@@ -678,47 +892,100 @@ def mdp_Tasks(sLigNm, sPhase, job_dir, JobArgs, args):
           MdpTemplatePath = custom_template
        else:
           logging.warning('User defined mdp-template %s not found. Using template from config', custom_template)
-    logging.info("Making mdp files from Template: %s", MdpTemplatePath)
-    mdp_template = read_file(MdpTemplatePath)  # Read mdp template
+    logging.info("Making mdp files of the Phase %s from Template: %s", sPhase, MdpTemplatePath)
+    mdp_template = MdpTemplate(read_file(MdpTemplatePath), MdpTemplatePath)  # Read and index mdp template once
+
+    # Config mdp parameters of the Phase Tasks: common, Phase, Task and Phase+Task layers merged in configure.ProcessConfig
+    phase_layers = utils.env.MdpLayers.get(sPhase, {})
+    prefix = phase_cfg.get('FileLabel')
+    mdps = []
+    for Task in phase_cfg.get('workflow',''):
+        mdp_layers = (phase_layers.get(Task, ''),)
+        mdp_template.report_missing(*mdp_layers, context=f' of the Task {Task} in the Phase {sPhase}')
+        mdp_slot = None
+        if utils.env.Type == 'run_ti':
+            # TI points differ only by "init-lambda-state": keep the rendered MDP with the slot for its value
+            mdp_slot = mdp_template.slotted('init-lambda-state', *mdp_layers)
+        MdpFile = prefix + "_" + Task.lower() + ".mdp"
+        mdps.append((Task, MdpFile, mdp_template.render(*mdp_layers).encode('utf-8'), mdp_slot))
+    _phase_mdps[key] = mdps
+    return mdps
+
+def preload_mdps(sPhases, args):
+    """
+    Render the MDPs of the phases once, before the records are prepared
+    (worker processes of "--jobs N" inherit the rendered MDPs)
+
+    :param sPhases: names of the phases used by the runFile records
+    """
+    for sPhase in set(sPhases):
+        if utils.env.Phase.get(sPhase): phase_mdps(sPhase, args)   # unknown phases are reported per record
+
+def write_mdp(data: bytes, path):
+    """
+    Write the MDP. With --mdp-links identical MDPs of all jobs are hard links
+    to one file <OutDir>/.mdp/<sha256>.mdp (written in place if linking fails)
+
+    :param data: MDP content
+    :param path: MDP path in the job dir
+    """
+    if utils.env.bMdpLinks:
+        try:
+            store = _mdp_store.get(data)
+            if store is None:
+                store = os.path.join(utils.env.OutDir, '.mdp', hashlib.sha256(data).hexdigest() + '.mdp')
+                if not os.path.isfile(store):
+                    os.makedirs(os.path.dirname(store), exist_ok=True)
+                    tmp = f'{store}.{os.getpid()}.tmp'
+                    with open(tmp, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp, store)
+                _mdp_store[data] = store
+            if os.path.lexists(path): os.remove(path)
+            os.link(store, path)
+            return
+        except OSError as e:
+            logging.debug(f'MDP {path} is not linked: {e}')
+    write_files([(data, path)])
+
+def write_mdps(batch):
+    """
+    Write a batch of MDPs, e.g. the TI point MDPs of all Tasks of a job rendered before any file is written.
+    Without --mdp-links the batch is written in one pass by write_files
+
+    :param batch: list of (MDP content, MDP path in the job dir)
+    """
+    if utils.env.bMdpLinks:
+        for data, path in batch: write_mdp(data, path)
+    else:
+        write_files(batch)
+
+def mdp_Tasks(sLigNm, sPhase, job_dir, JobArgs, args):
+    ##
+    ## Set MDP config files
+    ##
+    logging.info(f"\nSetting up the MD Parameter (MDP) files for all Tasks")
 
     ##
     ##   SETUP WORKFLOW
     ##
     ## 1. Create separate folder and MDP file for each of the workflow Task: "MIN", "NVT", "NPT", "PROD"
     ## 2. Add execution commands to the JOB script for each of the workflow Task
-    #print(args.gmxconfig)
-    Task_cfg = utils.env.Task if hasattr(utils.env, 'Task') else ''
-    mdp_template = setMdpParams( Task_cfg.get('DEFAULT','').get('mdp','') , mdp_template)   # Set config mdp parameters common for all
-    mdp_template = setMdpParams(phase_cfg.get('mdp','')     , mdp_template)   # Set config mdp parameters specific for a given Phase
-    prefix = phase_cfg.get('FileLabel')
-    CoorPath = JobArgs['sRunNm'] + '.pdb'
+    CoorPath = JobArgs['coor']
     TaskIniCoor =  '${JobDir}/' +  CoorPath
-    for Task in phase_cfg.get('workflow',''):
-    #for Task in args.gmxconfig.Phase[sPhase].get('workflow',''):
-        #print('Task:', Task)
-        #print('Phase.mdp:', Task, args.gmxconfig.mdp.get(Task))
-        mdp_lines = setMdpParams(Task_cfg.get(Task,'').get('mdp',''), mdp_template)   # Set config mdp parameters specific for a given Stage
-        #mdp_lines = setMdpParams(args.gmxconfig.mdp.get(Task,''), mdp_template)   # Set config mdp parameters specific for a given Stage
-        #print(f'args.gmxconfig.[\'Phase\'][{sPhase}][\'mdp\'].get(\'{Task}\',\'\')]: ', args.gmxconfig['Phase'][sPhase]['mdp'].get(Task,''))
-        mdp_lines = setMdpParams(phase_cfg.get('mdp','').get(Task,''), mdp_lines)   # Set config mdp parameters specific for a given Phase and Task
-        #mdp_lines = setMdpParams(args.gmxconfig['Phase'][sPhase]['mdp'].get(Task,''), mdp_lines)   # Set config mdp parameters specific for a given Phase and Task
-        os.makedirs(Task)
-        #utils.makedir(job_dir + '/' + Task)
+    for Task, MdpFile, mdp_data, mdp_slot in phase_mdps(sPhase, args):
+        if mdp_slot is not None:
+            JobArgs['mdp-slots'][Task] = mdp_slot
+        os.makedirs(os.path.join(job_dir, Task), exist_ok=True)
         # Save MDP for a given Task
-        MdpFile = prefix + "_" + Task.lower() + ".mdp"
-        write_file(mdp_lines, Task + "/" + MdpFile)
+        if not keep_on_resume(JobArgs, os.path.join(job_dir, Task, MdpFile)):
+            write_mdp(mdp_data, os.path.join(job_dir, Task, MdpFile))
 
         JobArgs['workflow'].append(Task)
         JobArgs[Task] = [MdpFile, TaskIniCoor]
-        #workflow_lines = addTask_To_Workflow(workflow_lines, Task, TaskIniCoor, MdpFile, JobArgs, args)
 
         TaskIniCoor = '${JobDir}/' + Task + '/${subdir}/' + utils.env.sOutnm + '_' + Task.lower() + '.gro'
         #TaskIniCoor = '${JobDir}/' + Task + '/${subdir}/' + args.gmxconfig.paths.get('outnm') + '_' + Task.lower() + '.gro'
-    #for l in mdp_lines:
-    #    print (l)
-    #for l in workflow_lines:
-    #    print (l)
-    #sys.exit(0)
     return JobArgs
 
 def Tasks_to_workflow_script(JobArgs, args):
@@ -727,13 +994,16 @@ def Tasks_to_workflow_script(JobArgs, args):
     ## JOB Workflow script file
     ##
     logging.info(f"Generating the JOB Workflow script")
-    CoorPath = JobArgs['sRunNm'] + '.pdb'
+    CoorPath = JobArgs['coor']
     TaskIniCoor =  '${JobDir}/' +  CoorPath
     workflow = []
+    JobArgs['task-lines'] = {}           # Task -> (first, last+1) workflow lines, used by --dag
     for Task in JobArgs['workflow']:
         MdpFile     = JobArgs[Task][0]   # JobArgs[Task] = [MdpFile, TaskIniCoor] should be set in "Set_MDP_Tasks"
         TaskIniCoor = JobArgs[Task][1]    
+        first = len(workflow)
         workflow = addTask_to_workflow(workflow, Task, TaskIniCoor, MdpFile, JobArgs, args)
+        JobArgs['task-lines'][Task] = (first, len(workflow))
 
         #TaskIniCoor = '${JobDir}/' + Task + '/${subdir}/' + args.gmxconfig.paths.get('outnm') + '_' + Task.lower() + '.gro'
     #for l in workflow_lines:
@@ -784,18 +1054,22 @@ def get_lambda_list(args):
 
 def TI_grid(JobArgs, args):
     # Create subdir and replicate MDP-file for each TI point and each Task.
+    # With "--single-mdp" only subdirs are created: the job script derives the TI point MDP from the Task MDP
     Lambdas = get_lambda_list(args)
     JobArgs['RunLambdas'] = Lambdas
     lam_prefix = utils.env.sTIdir
+    job_dir = JobArgs['job_dir']
     #lam_prefix = args.gmxconfig.paths.get('TIdir','')
+    batch = []
     for Task in JobArgs['workflow']:
-        MdpFile = JobArgs[Task][0]
-        mdp_template = read_file(Task + '/' + JobArgs[Task][0])  # Read mdp template for a given Task
+        MdpFile  = JobArgs[Task][0]
+        mdp_slot = JobArgs['mdp-slots'][Task]   # Task MDP rendered once with the slot for "init-lambda-state"
         for iL in Lambdas:
-            subdir = Task + '/' + lam_prefix + str(iL)
-            os.makedirs(subdir)
-            mdp_lines = setMdpParams({'init-lambda-state':iL}, mdp_template)   # Set config mdp parameters common for all
-            write_file(mdp_lines, Task + '/' + lam_prefix + str(iL) + "/" + MdpFile)
+            subdir = os.path.join(job_dir, Task, lam_prefix + str(iL))
+            os.makedirs(subdir, exist_ok=True)
+            if not utils.env.bSingleMdp and not keep_on_resume(JobArgs, os.path.join(subdir, MdpFile)):
+                batch.append((mdp_slot.fill(iL).encode('utf-8'), os.path.join(subdir, MdpFile)))
+    write_mdps(batch)
     return JobArgs
 
 def gen_md_submit_script(job_id, args):
@@ -835,6 +1109,118 @@ def gen_md_submit_script(job_id, args):
     os.chmod(run_script, stat.S_IRWXU)
     return run_script
 
+def script_directives(name):
+    return f'#!/bin/sh\n' \
+           f'# PBS DIRECTIVES\n' \
+           f'#PBS -N {name}\n' \
+           f'#PBS -j oe\n' \
+           f'# SGE DIRECTIVES\n' \
+           f'#$ -N {name}\n' \
+           f'#$ -S /bin/sh\n' \
+           f'#$ -cwd\n' \
+           f'#$ -j y\n' \
+           f'#$ -V\n' \
+           f'# SLURM DIRECTIVES\n' \
+           f'#SBATCH -J {name}\n' \
+           f'#SBATCH -o {name}.o%j\n\n'
+
+def gen_pack_scripts(scripts, lam_ids_list, JobArgs, args):
+    """
+    Pack the TI point scripts by K into job scripts which run them as K concurrent mdruns.
+    Under the local executor (GMXFE_PINOFFSET is set) the mdruns are pinned to disjoint cores of
+    the slot, under schedulers the placement is left to the allocated cpuset.
+    Each TI point keeps its own Task sequence, resume guards and ledger record.
+
+    :param      scripts: TI point script names
+    :param lam_ids_list: lambda numbers of the scripts
+    :param      JobArgs: dictionary of the job script parameters
+    :param         args: arguments of gmxfe command, args.pack = K
+    :return: list of the pack script names
+    """
+    import stat
+    job_dir = JobArgs['job_dir']
+    pack_scripts = []
+    for first in range(0, len(scripts), args.pack):
+        group = list(zip(scripts[first:first + args.pack], lam_ids_list[first:first + args.pack]))
+        pack_script = 'packjob' + str(group[0][1]) + '.qsh'
+        lines = [script_directives(f'{args.jobname}p{group[0][1]}') +
+                 '# TI points: ' + ' '.join(str(lam) for _, lam in group)]
+        for j, (script, lam) in enumerate(group):
+            # mdrun flags of the TI point: cores [offset + j*ncpu, offset + (j+1)*ncpu) of the local slot
+            lines.append(f'GMXFE_MDRUN_LOCAL="${{GMXFE_PINOFFSET:+-pin on -pinoffset $(( GMXFE_PINOFFSET + {j * args.ncpu} )) -pinstride 1}}'
+                         '${GMXFE_GPU_ID:+ -gpu_id ${GMXFE_GPU_ID}}" '
+                         f'sh ./{script} > {script}.log 2>&1 &')
+            lines.append(f'pid{j}=$!')
+        lines.append('rc=0')
+        lines.append('for pid in ' + ' '.join(f'${{pid{j}}}' for j in range(len(group))) + '; do')
+        lines.append('    wait ${pid} || rc=1')
+        lines.append('done')
+        lines.append('exit ${rc}')
+        # The TI points of a pack change on --resume: a running pack script keeps its old file
+        tmp = os.path.join(job_dir, f'.{pack_script}.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(tmp, stat.S_IRWXU)
+        os.replace(tmp, os.path.join(job_dir, pack_script))
+        pack_scripts.append(pack_script)
+    logging.info(f'{len(scripts)} TI points are packed by {args.pack} into {len(pack_scripts)} jobs')
+    return pack_scripts
+
+def task_resources(Task, args):
+    """
+    Resources of the Task jobs with --dag: the optional "Task.<name>.resources" table of the config
+    (ncpu, gpu, qargs) overrides the --ncpu/--gpu options, e.g. MIN on CPU nodes and PROD on GPU nodes.
+    The local executor (--queue none) runs all Tasks in slots of --ncpu cores.
+
+    :return: dict with "ncpu", "gpu" and "qargs" (appended to --qaargs)
+    """
+    res = {'ncpu': args.ncpu, 'gpu': args.gpu, 'qargs': ''}
+    if not getattr(args, 'dag', False): return res
+    cfg = utils.env.Task[Task].get('resources') or {}
+    if utils.env.queue != 'none':
+        res['ncpu'] = int(cfg.get('ncpu', res['ncpu']))
+        res['gpu']  = bool(cfg.get('gpu', res['gpu']))
+    res['qargs'] = cfg.get('qargs', '')
+    return res
+
+def gen_dag_scripts(wf_lines, JobArgs, lam_ids_list, args):
+    """
+    Split the workflow of the TI points into one script per Task and TI point.
+    The Task scripts of all TI points are submitted as one array job depending on the array of the previous Task.
+
+    :param     wf_lines: workflow lines of the TI point scripts
+    :param      JobArgs: dictionary of the job script parameters, JobArgs['task-lines'] from Tasks_to_workflow_script
+    :param lam_ids_list: list of lambda numbers
+    :param         args: arguments of gmxfe command
+    :return: dict Task -> list of the script names in the order of lam_ids_list
+    """
+    import stat
+    dir_prefix  = utils.env.sTIdir
+    job_dir     = JobArgs['job_dir']
+    LastTaskDir = JobArgs['workflow'][-1]
+    dag = {}
+    for Task in JobArgs['workflow']:
+        first, last = JobArgs['task-lines'][Task]
+        # Only the last Task records "done", a failed Task records "failed"
+        line_record = ledger.shell_record(utils.env.ResFile, LastTaskDir, JobArgs, final=(Task == LastTaskDir))
+        dag[Task] = []
+        for idTIp in lam_ids_list:
+            job_script = 'dag_' + Task + '_' + str(idTIp) + '.qsh'
+            dag[Task].append(job_script)
+            if keep_on_resume(JobArgs, os.path.join(job_dir, job_script)): continue
+            with open(os.path.join(job_dir, job_script), 'w') as f:
+                f.write(script_directives(f'{args.jobname}{str(idTIp)}{Task}'))
+                f.write('subdir=' + dir_prefix + str(idTIp) + '\n')
+                f.write('lambda=' + str(idTIp) + '\n')
+                f.write(line_record)
+                f.write('\n'.join(wf_lines[first:last]) + '\n')
+            os.chmod(os.path.join(job_dir, job_script), stat.S_IRWXU)
+    return dag
+
+def ti_script_name(idTIp, args):
+    rerun = True if hasattr(args, 'rerun') and args.rerun else False
+    return ('rerunjob' if rerun else 'runjob') + str(idTIp) + '.qsh'
+
 def gen_ti_submit_script(wf_lines, JobArgs, lam_ids_list, args):
     """
     Generate submit scripts for TI points
@@ -847,46 +1233,25 @@ def gen_ti_submit_script(wf_lines, JobArgs, lam_ids_list, args):
     import stat
     submit_scripts = []
     dir_prefix = utils.env.sTIdir
+    job_dir    = JobArgs['job_dir']
     mpi       = True if (hasattr(args, 'mpi') and args.mpi)  or (hasattr(args, 'replex') and args.replex) else False
     run_local = True if hasattr(args, 'queue') and args.queue == 'none' else False
-    rerun     = True if hasattr(args, 'rerun') and args.rerun else False
     for idTIp in lam_ids_list:
-        job_script = 'runjob' + str(idTIp) + '.qsh'
-        if rerun: job_script = 'rerunjob' + str(idTIp) + '.qsh'
-        # TODO PBS DIRECTIVES
-        line_opt = f'#!/bin/sh\n' \
-                f'# SGE DIRECTIVES\n' \
-                f'#$ -N {args.jobname}{str(idTIp)}\n' \
-                f'#$ -S /bin/sh\n' \
-                f'#$ -cwd\n' \
-                f'#$ -j y\n' \
-                f'#$ -V\n' \
-                f'# SLURM DIRECTIVES\n' \
-                f'#SBATCH -J {args.jobname}{str(idTIp)}\n' \
-                f'#SBATCH -o {args.jobname}{str(idTIp)}.o%j\n\n'
-
-        jobnm        = JobArgs['sJobNm']
+        job_script = ti_script_name(idTIp, args)
+        submit_scripts.append(job_script)
+        if keep_on_resume(JobArgs, os.path.join(job_dir, job_script)): continue   # may be running
+        line_opt = script_directives(f'{args.jobname}{str(idTIp)}')
+
         LastTaskDir  = JobArgs['workflow'][-1]
-        ResFile = utils.env.ResFile
-        ## NOTE: OSX 'sed -i' requires extra param to rename old file, see https://stackoverflow.com/questions/5694228/sed-in-place-flag-that-works-both-on-mac-bsd-and-linux
-        ## NOTE: sh shall is OLD and limited compare to bash and has different quotation rules
-        line_record = '############# WRITE JOB RECORD #############\n'\
-                      '####### removing duplicating records #######\n'\
-                      '############################################\n'\
-                      f'ResFile=\'{ResFile}\'\n' \
-                      f'outdir=$(pwd)/{LastTaskDir}\n' \
-                      f'outdir_esc=$(echo \"${{outdir}}\" | sed \'s/\([^a-zA-Z0-9]\)/\\\\\\1/g\')\n' \
-                      f'sed -i.bak \'/\'\"${{outdir_esc}}\"\'/d\' ${{ResFile}}\n' \
-                      f'rm ${{ResFile}}.bak\n' \
-                      f'printf \"{jobnm}\\t$(date +%d.%m.%y-%T )\\t${{outdir}}\\n\" >> ${{ResFile}}\n'
-        with open(job_script, 'w') as f:
+        line_record  = ledger.shell_record(utils.env.ResFile, LastTaskDir, JobArgs)
+        with open(os.path.join(job_dir, job_script), 'w') as f:
             f.write(line_opt)
-            f.write('subdir=' + dir_prefix + str(idTIp))
-            f.write('\n'.join(wf_lines) + '\n')
+            f.write('subdir=' + dir_prefix + str(idTIp) + '\n')
+            f.write('lambda=' + str(idTIp) + '\n')
             f.write(line_record)
+            f.write('\n'.join(wf_lines) + '\n')
             #f.write(line_cmd)
-        os.chmod(job_script, stat.S_IRWXU)
-        submit_scripts.append(job_script)
+        os.chmod(os.path.join(job_dir, job_script), stat.S_IRWXU)
     return submit_scripts
 
 def submit_scripts(workflow, JobArgs, args):
@@ -908,7 +1273,19 @@ def submit_scripts(workflow, JobArgs, args):
             return script
         else:
             # Generate run script for each TI point
+            submitted = [iL for iL in Lambdas if keep_on_resume(JobArgs, os.path.join(JobArgs['job_dir'], ti_script_name(iL, args)))]
             scripts = gen_ti_submit_script(workflow, JobArgs, Lambdas, args)
+            if JobArgs.get('resume'):
+                # Submit only the failed and never submitted TI points
+                resubmit = resume_windows(JobArgs, Lambdas, submitted)
+                scripts = [s for s, iL in zip(scripts, Lambdas) if iL in resubmit]
+                Lambdas = resubmit
+            JobArgs['SubmitLambdas'] = Lambdas
+            if getattr(args, 'pack', 1) > 1 and scripts:
+                scripts = gen_pack_scripts(scripts, Lambdas, JobArgs, args)
+            elif getattr(args, 'dag', False) and scripts:
+                # runjob*.qsh stay as the complete TI point scripts (analysis, refine, manual reruns)
+                JobArgs['dag-scripts'] = gen_dag_scripts(workflow, JobArgs, Lambdas, args)
             return scripts
     elif utils.env.Type == 'run_md':
         # Specify the structure of lambda foders for TI simulations: JobDir = '../..'
@@ -923,6 +1300,18 @@ def submit_scripts(workflow, JobArgs, args):
         sys.exit(0)
 
 def schedule_job(jobscript, JobArgs, args):
+    """
+    Describe the job scripts of the record as submissions to the scheduler.
+    The caller submits the submissions of all records through one scheduler.SubmitQueue.
+
+    :param jobscript: job script name or list of TI point script names
+    :param   JobArgs: dictionary of the job script parameters
+    :param      args: arguments of gmxFE command
+    :return: list of scheduler.Submission
+    """
+    job_dir = JobArgs['job_dir']
+    qargs   = getattr(args, 'qaargs', '') or ''
+    jobname = f"{args.jobname}.{JobArgs['jobid']}"
     if utils.env.Type == 'run_ti':  # If TI
         Lambdas = JobArgs['RunLambdas']
         nThreads = len(Lambdas)
@@ -943,30 +1332,29 @@ def schedule_job(jobscript, JobArgs, args):
             else:
                 logging.info("Starting lambda replica exchange simulation with %d parallel MPI threads and %d lambda points "
                              "per thread. Works only in Open MPI environment.",nThreads,nTIpPerThread)
-            scheduler.submit_job(script, args.jobname,
-                                 args.partition, args.queue,
-                                 args.ncpu, args.gpu, mpiCores)
+            return [scheduler.Submission(job_dir, [script], jobname, args.ncpu, args.gpu, mpiCores, qargs)]
         else:
-            # Submit separate job for each TI point
-            for idTIp, script in zip(Lambdas, jobscript):
-                logging.info("Starting simulation for TI point: %i",idTIp)
-                if args.jobname == 'gmxTIp':
-                    jobname = 'gmxTIp' + str(idTIp)
-                else:
-                    jobname = args.jobname
-                scheduler.submit_job(script, jobname,
-                                 args.partition, args.queue,
-                                 args.ncpu, args.gpu)
-                #sys.exit(0)
-                time.sleep(0)
+            Lambdas = JobArgs.get('SubmitLambdas', Lambdas)
+            if not jobscript:
+                logging.info("All TI points of %s are finished", job_dir)
+                return []
+            logging.info("Starting simulation for TI points: %s", Lambdas)
+            if 'dag-scripts' in JobArgs:
+                # One array job per Task, each array task waits for the same TI point of the previous Task
+                subs, after = [], None
+                for Task in JobArgs['workflow']:
+                    res = task_resources(Task, args)
+                    after = scheduler.Submission(job_dir, JobArgs['dag-scripts'][Task], f'{jobname}.{Task}',
+                                                 res['ncpu'], res['gpu'], 0, (qargs + ' ' + res['qargs']).strip(), after)
+                    subs.append(after)
+                return subs
+            # One array job with a task for each TI point (or each pack of TI points)
+            ncpu = args.ncpu * min(getattr(args, 'pack', 1), len(Lambdas))
+            return [scheduler.Submission(job_dir, jobscript, jobname, ncpu, args.gpu, 0, qargs)]
     elif utils.env.Type == 'run_md':  # If MD
     # Plain MD single thread job
-        script = jobscript
         logging.info("Starting plain MD simulation job")
-        jobname = args.jobname
-        scheduler.submit_job(script, jobname,
-                         args.partition, args.queue,
-                         args.ncpu, args.gpu)
+        return [scheduler.Submission(job_dir, [jobscript], jobname, args.ncpu, args.gpu, 0, qargs)]
     else:
         logging.error(f'The simulation type \"{utils.env.Type}" is not implemented')
         sys.exit(0)
@@ -0,0 +1,172 @@
+# Created 2024
+"""
+Online convergence monitor of running TI windows: dhdl.xvg of each window is tailed
+through the binary cache of utils.analysis (only rows written since the last poll are read)
+and running batch-means statistics of <dH/dl> give the current TI estimate with its error.
+"""
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+from utils import analysis
+
+
+class BlockStats:
+    """
+    Running mean and batch-means error of a multi-column time series with a fixed block length
+    """
+
+    def __init__(self, ncols, block=50):
+        self.block = block
+        self.n = 0
+        self.total = np.zeros(ncols)
+        self.partial = np.zeros(ncols)       # sum of the incomplete block
+        self.npartial = 0
+        self.nblocks = 0
+        self.bsum = np.zeros(ncols)          # sums of the complete block means and their squares
+        self.bsum2 = np.zeros(ncols)
+
+    def add(self, rows):
+        if not len(rows): return
+        self.n += len(rows)
+        self.total += rows.sum(axis=0)
+        i = 0
+        if self.npartial:                    # complete the pending block first
+            i = min(self.block - self.npartial, len(rows))
+            self.partial += rows[:i].sum(axis=0)
+            self.npartial += i
+            if self.npartial < self.block: return
+            self._add_means(self.partial[None, :] / self.block)
+            self.partial[:], self.npartial = 0, 0
+        nfull = (len(rows) - i) // self.block
+        if nfull:
+            full = rows[i:i + nfull * self.block]
+            self._add_means(full.reshape(nfull, self.block, -1).mean(axis=1))
+        rest = rows[i + nfull * self.block:]
+        self.partial += rest.sum(axis=0)
+        self.npartial += len(rest)
+
+    def _add_means(self, means):
+        self.nblocks += len(means)
+        self.bsum += means.sum(axis=0)
+        self.bsum2 += (means ** 2).sum(axis=0)
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else np.full(len(self.total), np.nan)
+
+    @property
+    def sem(self):
+        if self.nblocks < 2: return np.full(len(self.total), np.nan)
+        m = self.bsum / self.nblocks
+        var = np.maximum(self.bsum2 / self.nblocks - m ** 2, 0) * self.nblocks / (self.nblocks - 1)
+        return np.sqrt(var / self.nblocks)
+
+
+class WindowMonitor:
+    """
+    Incremental reader of one lambda window
+    """
+
+    def __init__(self, lam, path, begin=0.0, block=50):
+        self.lam, self.path = lam, path
+        self.begin, self.block = begin, block
+        self.rows = 0        # rows of the cache already accumulated
+        self.time = 0.0
+        self.meta = None
+        self.stats = None
+
+    def poll(self):
+        """
+        Accumulate rows written since the last poll
+
+        :return: number of new rows
+        """
+        if not os.path.isfile(self.path): return 0
+        cmeta = analysis.update_cache(self.path)
+        if cmeta['nrows'] <= self.rows: return 0
+        if self.stats is None:
+            self.meta = cmeta['header']
+            self.stats = BlockStats(len(self.meta['dhdl_cols']), self.block)
+        data = np.memmap(analysis.cache_paths(self.path)[0], dtype='<f8', mode='r',
+                         shape=(cmeta['nrows'], cmeta['ncols']))[self.rows:]
+        new = len(data)
+        self.rows = cmeta['nrows']
+        self.time = float(data[-1, 0])
+        data = data[data[:, 0] >= self.begin] if self.begin else data
+        self.stats.add(np.asarray(data[:, self.meta['dhdl_cols']]))
+        return new
+
+
+class JobMonitor:
+    """
+    Monitor of the lambda windows of a job dir
+    """
+
+    def __init__(self, job_dir, task=None, begin=0.0, block=50):
+        self.job_dir = job_dir
+        self.windows = [WindowMonitor(lam, path, begin, block) for lam, path in analysis.find_windows(job_dir, task)]
+
+    def poll(self):
+        return sum(w.poll() for w in self.windows)
+
+    def estimate(self):
+        """
+        :return: (dG, error) in kJ/mol by TI (trapezoid) over the windows with samples, None if there are less than 2
+        """
+        active = [w for w in self.windows if w.stats is not None and w.stats.n]
+        if len(active) < 2 or len(active) < len(self.windows): return None
+        return analysis.ti_integrate([w.meta['dhdl_lambdas'] for w in active],
+                                     [w.stats.mean for w in active],
+                                     [np.nan_to_num(w.stats.sem, nan=np.inf) for w in active])
+
+    def report(self, tol):
+        """
+        :param tol: error of <dH/dl> (kJ/mol) below which a window is converged
+        :return: (report text, True if all windows are converged)
+        """
+        lines = [f'{self.job_dir}',
+                 f'  {"LAMBDA":>6s} {"SAMPLES":>9s} {"TIME,ps":>10s} {"<dH/dl>":>12s} {"ERROR":>9s}  STATUS']
+        converged = bool(self.windows)
+        for w in self.windows:
+            if w.stats is None or not w.stats.n:
+                lines.append(f'  {w.lam:>6d} {0:>9d} {"-":>10s} {"-":>12s} {"-":>9s}  waiting')
+                converged = False
+                continue
+            mean, sem = w.stats.mean.sum(), math.sqrt(np.sum(w.stats.sem ** 2))
+            ok = sem < tol
+            converged = converged and ok
+            lines.append(f'  {w.lam:>6d} {w.stats.n:>9d} {w.time:>10.1f} {mean:>12.3f} {sem:>9.3f}  '
+                         + ('converged' if ok else 'noisy' if not math.isnan(sem) else 'too few blocks'))
+        est = self.estimate()
+        lines.append(f'  dG(TI) = {est[0]:.3f} +- {est[1]:.3f} kJ/mol' if est else '  dG(TI) = n/a')
+        return '\n'.join(lines), converged
+
+
+def monitor(job_dirs, task=None, begin=0.0, block=50, tol=0.5, interval=60.0, once=False):
+    """
+    Poll the windows of the job dirs and print their convergence until all windows converge
+
+    :param job_dirs: job directories
+    :param     task: Task dir to monitor (default: the last Task of the workflow)
+    :param    begin: equilibration cutoff, ps
+    :param    block: block length in samples of the batch-means error
+    :param      tol: error of <dH/dl> (kJ/mol) below which a window is converged
+    :param interval: seconds between polls
+    :param     once: poll once and return
+    :return: True if all windows are converged
+    """
+    jobs = [JobMonitor(d, task, begin, block) for d in job_dirs]
+    while True:
+        start = time.monotonic()
+        new = sum(job.poll() for job in jobs)
+        reports = [job.report(tol) for job in jobs]
+        print(f'### {time.strftime("%Y-%m-%d %H:%M:%S")}: {new} new samples ###')
+        print('\n'.join(text for text, _ in reports), flush=True)
+        done = all(ok for _, ok in reports)
+        if once or done: return done
+        logging.debug(f'Poll took {time.monotonic() - start:.2f} s')
+        time.sleep(interval)
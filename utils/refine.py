@@ -0,0 +1,196 @@
+# Created 2024
+"""
+Adaptive refinement of the lambda grid of a TI job after a pilot run: intervals between
+analyzed windows are scored by the statistical error and the curvature (trapezoid
+discretization error from the cubic spline) of <dH/dl>, new lambda states are inserted
+at the midpoints of the worst intervals and only the new windows are set up and submitted
+in the same job dir layout.
+"""
+import logging
+import os
+import re
+import stat
+
+import numpy as np
+
+from utils import analysis
+from utils.mdp import MdpTemplate
+
+_re_single_mdp = re.compile(r"^\{ grep -v '\^\[\[:space:\]\]\*init\[-_\]lambda\[-_\]state'.*$\n?", re.MULTILINE)
+
+
+def window_mdp(job_dir, Task, info, MdpFile):
+    # Per window MDP, or the Task MDP of the --single-mdp mode
+    path = os.path.join(job_dir, Task, info['subdir'], MdpFile)
+    return path if os.path.isfile(path) else os.path.join(job_dir, Task, MdpFile)
+
+
+def lambda_grid(template: MdpTemplate):
+    """
+    :return: dict normalized "*-lambdas" key -> list of lambda values of the grid
+    """
+    grid = {}
+    for key in template.keys():
+        if key.endswith('-lambdas'):
+            values = (template.get(key) or '').split()
+            if values: grid[key] = [float(v) for v in values]
+    nstates = {len(v) for v in grid.values()}
+    if len(nstates) > 1:
+        raise ValueError(f'Lambda arrays of {template.path} have different lengths')
+    return grid
+
+
+def nstates(grid):
+    return len(next(iter(grid.values())))
+
+
+def grid_vector(grid, k):
+    return tuple(round(grid[key][k], 6) for key in sorted(grid))
+
+
+def format_grid(grid):
+    return {key: ' '.join(f'{v:.6g}' for v in values) for key, values in grid.items()}
+
+
+def interval_scores(windows, nblocks=5):
+    """
+    Score the intervals between adjacent windows by the error of their TI contribution
+
+    :param windows: analysis.Window ordered along the path
+    :return: (statistical errors, curvature errors) of the intervals, kJ/mol
+    """
+    lams  = np.array([w.meta['dhdl_lambdas'] for w in windows])
+    means = np.array([w.dhdl.mean(axis=0) for w in windows])
+    sems  = np.nan_to_num(np.array([analysis.block_sem(w.dhdl, nblocks) for w in windows]))
+    h = np.diff(lams, axis=0)
+    stat_err = np.sqrt(np.sum((h / 2) ** 2 * (sems[:-1] ** 2 + sems[1:] ** 2), axis=1))
+    curv_err = np.zeros(len(windows) - 1)
+    for c in range(lams.shape[1]):
+        x = lams[:, c]
+        changes = np.nonzero(np.diff(x))[0]
+        if not len(changes): continue
+        a, b = changes[0], changes[-1] + 2
+        if b - a < 3 or np.any(np.diff(x[a:b]) == 0): continue
+        M = analysis.spline_second_derivatives(x[a:b]) @ means[a:b, c]
+        hc = np.diff(x[a:b])
+        curv_err[a:b - 1] += np.abs(hc ** 3 / 24 * (M[:-1] + M[1:]))
+    return stat_err, curv_err
+
+
+def refine_job(job_dir, nnew=4, min_width=0.02, task=None, begin=0.0, nblocks=5):
+    """
+    Insert new lambda states into the grid of the job and set up their windows
+
+    :param   job_dir: job directory after the pilot run
+    :param      nnew: max number of new windows
+    :param min_width: intervals narrower than this (sum of the lambda steps) are not split
+    :param      task: Task whose dhdl.xvg files are analyzed (default: the last Task of the workflow)
+    :param     begin: equilibration cutoff, ps
+    :param   nblocks: number of blocks for the errors of <dH/dl>
+    :return: list of the new job script names
+    """
+    scripts = analysis.job_scripts(job_dir)
+    if not scripts:
+        raise ValueError(f'No TI point scripts (runjob*.qsh) are found in {job_dir}')
+    tasks = scripts[-1]['tasks']
+    AnaTask, MdpFile = next(((T, m) for T, m in tasks if T == task), tasks[-1]) if task else tasks[-1]
+    ##
+    ## Lambda vector of each window from its MDP, the latest (finest) grid is the reference
+    ##
+    if MdpFile is None:
+        raise ValueError(f'MDP file of the Task {AnaTask} is not found in the job scripts of {job_dir}')
+    states, ref, grid = {}, None, {}
+    for info in scripts:
+        path = window_mdp(job_dir, AnaTask, info, MdpFile)
+        template = MdpTemplate.from_file(path)
+        g = lambda_grid(template)
+        if not g: raise ValueError(f'No lambda arrays are found in {path}')
+        if os.path.dirname(path) == os.path.join(job_dir, AnaTask):
+            k = info['lambda']      # --single-mdp: the script sets init-lambda-state to the window number
+        else:
+            k = int(template.get('init-lambda-state', info['lambda']))
+        states[info['lambda']] = (g, k)
+        if ref is None or nstates(g) > nstates(grid):
+            ref, grid = info, g
+    index = {grid_vector(grid, k): k for k in range(nstates(grid))}
+    ##
+    ## Analyzed windows in the order of the reference grid
+    ##
+    windows = []
+    for info in scripts:
+        g, k = states[info['lambda']]
+        kref = index.get(grid_vector(g, k))
+        if kref is None:
+            logging.warning(f'Lambda state of the window {info["lambda"]} is not in the grid of {ref["script"]}, skipped')
+            continue
+        path = os.path.join(job_dir, task or info['tasks'][-1][0], info['subdir'], 'dhdl.xvg')
+        if not os.path.isfile(path): continue
+        meta, data = analysis.read_dhdl(path, begin)
+        if len(data) < 2: continue
+        windows.append((kref, analysis.Window(meta, data, path, info['lambda'])))
+    windows.sort(key=lambda kw: kw[0])
+    if len(windows) < 2:
+        raise ValueError(f'Less than 2 lambda windows of {job_dir} have dhdl.xvg data')
+    stat_err, curv_err = interval_scores([w for _, w in windows], nblocks)
+    ##
+    ## Split the worst intervals between neighbouring states of the grid
+    ##
+    candidates = []
+    for i in range(len(windows) - 1):
+        k1, k2 = windows[i][0], windows[i + 1][0]
+        width = sum(abs(grid[key][k2] - grid[key][k1]) for key in grid)
+        logging.info(f'Interval {k1}-{k2}: statistical error {stat_err[i]:.4f}, curvature error {curv_err[i]:.4f} kJ/mol')
+        if k2 == k1 + 1 and width >= 2 * min_width:
+            candidates.append((stat_err[i] + curv_err[i], k1))
+    split = sorted(k for _, k in sorted(candidates, reverse=True)[:nnew])
+    if not split:
+        logging.warning(f'No lambda interval of {job_dir} can be refined')
+        return []
+    new_grid = {key: [] for key in grid}
+    new_states = []
+    for k in range(nstates(grid)):
+        for key in grid: new_grid[key].append(grid[key][k])
+        if k in split:
+            for key in grid: new_grid[key].append((grid[key][k] + grid[key][k + 1]) / 2)
+            new_states.append(nstates(new_grid) - 1)
+    logging.info('New lambda states: ' + ', '.join(str(grid_vector(new_grid, k)) for k in new_states))
+    return setup_windows(job_dir, ref, tasks, new_grid, new_states, scripts)
+
+
+def setup_windows(job_dir, ref, tasks, grid, new_states, scripts):
+    """
+    Create the Task subdirs, MDPs and job scripts of the new lambda states
+
+    :param        ref: job script info of the window with the reference grid
+    :param      tasks: list of (Task, MDP file name)
+    :param       grid: refined lambda grid
+    :param new_states: indices of the new states in the refined grid
+    :param    scripts: job script infos of the existing windows
+    :return: list of the new job script names
+    """
+    prefix = re.match(r'^(.*?)[0-9]*$', ref['subdir']).group(1)
+    with open(os.path.join(job_dir, ref['script']), 'r') as f:
+        script_text = _re_single_mdp.sub('', f.read())
+    arrays = format_grid(grid)
+    slots = {}
+    for Task, MdpFile in tasks:
+        template = MdpTemplate.from_file(window_mdp(job_dir, Task, ref, MdpFile))
+        slots[Task] = template.slotted('init-lambda-state', arrays)
+    last = max(i['lambda'] for i in scripts)
+    new_scripts = []
+    for n, k in enumerate(new_states, 1):
+        lam = last + n
+        subdir = prefix + str(lam)
+        for Task, MdpFile in tasks:
+            os.makedirs(os.path.join(job_dir, Task, subdir), exist_ok=True)   # left by an interrupted refine
+            with open(os.path.join(job_dir, Task, subdir, MdpFile), 'w') as f:
+                f.write(slots[Task].fill(k))
+        name = f'runjob{lam}.qsh'
+        text = re.sub(r'^subdir=.*$', f'subdir={subdir}', script_text, count=1, flags=re.MULTILINE)
+        text = re.sub(r'^lambda=.*$', f'lambda={lam}', text, count=1, flags=re.MULTILINE)
+        with open(os.path.join(job_dir, name), 'w') as f:
+            f.write(text)
+        os.chmod(os.path.join(job_dir, name), stat.S_IRWXU)
+        new_scripts.append(name)
+        logging.info(f'Window {lam} ({subdir}): lambda state {k} of the refined grid')
+    return new_scripts
@@ -0,0 +1,244 @@
+# Created 2024
+"""
+Job submission backends:
+
+- none  : run the job scripts concurrently on the local node (utils.localrun)
+- slurm : SLURM (sbatch), job arrays
+- pbs   : PBS Pro (qsub -J), job arrays
+- sge   : SGE (qsub -t), job arrays
+- fake  : local stand-in queue which records submissions in a spool file without running them
+
+A submission may depend on an earlier one (Submission.after): arrays of the same length
+are chained task by task (SLURM aftercorr, SGE -hold_jid_ad, local executor), otherwise
+the whole dependency must finish successfully first (PBS Pro supports only this mode).
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import shlex
+import stat
+import subprocess
+import time
+
+QUEUES = ('none', 'slurm', 'pbs', 'sge', 'fake')
+
+# Environment variable with the array task index set by each scheduler
+ARRAY_INDEX_VAR = {'slurm': 'SLURM_ARRAY_TASK_ID',
+                   'pbs'  : 'PBS_ARRAY_INDEX',
+                   'sge'  : 'SGE_TASK_ID',
+                   'fake' : 'FAKE_ARRAY_TASK_ID'}
+
+
+class Submission:
+    """
+    Job scripts of one job dir (e.g. all TI points of a ligand) submitted as one array job
+    """
+
+    def __init__(self, workdir, scripts, jobname, ncpu=1, gpu=False, mpiCores=0, qargs='', after=None):
+        """
+        :param  workdir: job directory, the scripts run in it
+        :param  scripts: script names relative to workdir
+        :param  jobname: job name in the queue
+        :param     ncpu: number of cores per script
+        :param      gpu: request a GPU per script
+        :param mpiCores: number of MPI slots per script (0 - no MPI)
+        :param    qargs: extra arguments of the submission command
+        :param    after: Submission which must finish successfully before this one starts
+        """
+        self.workdir  = workdir
+        self.scripts  = list(scripts)
+        self.jobname  = jobname
+        self.ncpu     = ncpu
+        self.gpu      = gpu
+        self.mpiCores = mpiCores
+        self.qargs    = qargs or ''
+        self.after    = after
+        self.job_id   = None
+        self.futures  = None     # local executor futures of the scripts
+
+    def task_wise(self):
+        # Dependency is resolved per array task: script i waits only for script i of self.after
+        return self.after is not None and len(self.after.scripts) == len(self.scripts)
+
+    def __repr__(self):
+        return f'Submission({self.jobname}: {len(self.scripts)} scripts in {self.workdir})'
+
+
+def write_array_script(sub: Submission, queue: str):
+    """
+    Write the wrapper script which changes to sub.workdir and runs the script of the
+    array task index (1-based), or the only script of a single-script submission
+
+    :return: wrapper script name relative to sub.workdir
+    """
+    name = f'array_{sub.jobname}.qsh'
+    index = ARRAY_INDEX_VAR[queue]
+    lines = ['#!/bin/sh',
+             f'cd {shlex.quote(sub.workdir)}']
+    if len(sub.scripts) == 1:
+        lines += [f'exec sh ./{sub.scripts[0]}', '']
+    else:
+        lines.append(f'case "${{{index}}}" in')
+        for i, script in enumerate(sub.scripts, 1):
+            lines.append(f'    {i}) exec sh ./{script} ;;')
+        lines += ['    *) echo "Unknown array index ${' + index + '}" >&2; exit 1 ;;', 'esac', '']
+    path = os.path.join(sub.workdir, name)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+    os.chmod(path, stat.S_IRWXU)
+    return name
+
+
+def _run_submit(cmd, workdir):
+    logging.info(f'Submitting: {" ".join(cmd)}')
+    p = subprocess.run(cmd, cwd=workdir, capture_output=True, text=True)
+    if p.returncode != 0:
+        raise RuntimeError(f'"{" ".join(cmd)}" failed with exit code {p.returncode}: {p.stderr.strip()}')
+    m = re.search(r'([0-9]+)', p.stdout)
+    return m.group(1) if m else p.stdout.strip()
+
+
+def submit_slurm(sub: Submission):
+    cmd = ['sbatch', '--parsable', '-J', sub.jobname, '--chdir', sub.workdir, '-o', f'{sub.jobname}.o%A_%a']
+    if sub.mpiCores: cmd += ['-n', str(sub.mpiCores)]
+    else:            cmd += ['-c', str(sub.ncpu)]
+    if sub.gpu: cmd += ['--gres=gpu:1']
+    if sub.after:
+        dep = 'aftercorr' if sub.task_wise() and len(sub.scripts) > 1 else 'afterok'
+        cmd += [f'--dependency={dep}:{sub.after.job_id}', '--kill-on-invalid-dep=yes']
+    cmd += shlex.split(sub.qargs)
+    if len(sub.scripts) > 1:
+        cmd += [f'--array=1-{len(sub.scripts)}', write_array_script(sub, 'slurm')]
+    else:
+        cmd += [sub.scripts[0]]
+    return _run_submit(cmd, sub.workdir)
+
+
+def submit_pbs(sub: Submission):
+    resources = f'select=1:ncpus={sub.mpiCores or sub.ncpu}' + (':ngpus=1' if sub.gpu else '')
+    cmd = ['qsub', '-N', sub.jobname, '-l', resources, '-j', 'oe']
+    if sub.after:
+        after = sub.after.job_id + ('[]' if len(sub.after.scripts) > 1 else '')
+        cmd += ['-W', f'depend=afterok:{after}']
+    cmd += shlex.split(sub.qargs)
+    # PBS starts the jobs in $HOME: the scripts always run through the wrapper which changes to the job dir
+    if len(sub.scripts) > 1:    # PBS Pro arrays need at least 2 subjobs
+        cmd += ['-J', f'1-{len(sub.scripts)}']
+    cmd += [write_array_script(sub, 'pbs')]
+    return _run_submit(cmd, sub.workdir)
+
+
+def submit_sge(sub: Submission):
+    cmd = ['qsub', '-N', sub.jobname, '-cwd', '-j', 'y', '-V']
+    if sub.after:
+        cmd += ['-hold_jid_ad' if sub.task_wise() and len(sub.scripts) > 1 else '-hold_jid', sub.after.job_id]
+    cmd += shlex.split(sub.qargs)
+    if len(sub.scripts) > 1:
+        cmd += ['-t', f'1-{len(sub.scripts)}', write_array_script(sub, 'sge')]
+    else:
+        cmd += [sub.scripts[0]]
+    return _run_submit(cmd, sub.workdir)
+
+
+class FakeQueue:
+    """
+    Stand-in queue: each submission is appended to <spool>/queue.jsonl with a new job ID
+    and the generated array wrapper, so the whole submission path runs without a cluster
+    """
+
+    def __init__(self, spool):
+        self.spool = spool
+        os.makedirs(spool, exist_ok=True)
+        self.path = os.path.join(spool, 'queue.jsonl')
+
+    def submit(self, sub: Submission):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            last = [json.loads(l) for l in f if l.strip()]
+            job_id = str(1 + max((int(r['job_id']) for r in last), default=0))
+            record = {'job_id': job_id, 'jobname': sub.jobname, 'workdir': sub.workdir,
+                      'scripts': sub.scripts, 'ncpu': sub.ncpu, 'gpu': sub.gpu, 'mpiCores': sub.mpiCores,
+                      'qargs': sub.qargs, 'state': 'queued', 'time': time.time()}
+            if sub.after:
+                record['after'] = sub.after.job_id
+                record['task_wise'] = sub.task_wise()
+            if len(sub.scripts) > 1: record['array'] = write_array_script(sub, 'fake')
+            f.write(json.dumps(record) + '\n')
+        return job_id
+
+    def jobs(self):
+        if not os.path.isfile(self.path): return []
+        with open(self.path) as f:
+            return [json.loads(l) for l in f if l.strip()]
+
+
+class SubmitQueue:
+    """
+    Submits the job arrays of all records through one backend with a submission rate limit
+    """
+
+    def __init__(self, queue='none', rate=0.0, spool=None, ncpu=1, gpu=False):
+        """
+        :param queue: backend name, one of QUEUES
+        :param  rate: max number of submission commands per second (0 - unlimited)
+        :param spool: spool directory of the "fake" backend
+        :param  ncpu: cores per script of the "none" backend
+        :param   gpu: assign GPUs to the scripts of the "none" backend
+        """
+        if queue not in QUEUES:
+            raise ValueError(f'Unknown queue "{queue}", supported: {QUEUES}')
+        self.queue = queue
+        self.min_interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._last = 0.0
+        self.fake = FakeQueue(spool) if queue == 'fake' else None
+        self.ncpu = ncpu
+        self.gpu  = gpu
+        self.local = None
+        self.submitted = []
+
+    def submit(self, submissions):
+        """
+        Submit the submissions in order
+
+        :param submissions: list of Submission
+        :return: list of job IDs
+        """
+        ids = []
+        for sub in submissions:
+            wait = self._last + self.min_interval - time.monotonic()
+            if wait > 0: time.sleep(wait)
+            if   self.queue == 'slurm': sub.job_id = submit_slurm(sub)
+            elif self.queue == 'pbs':   sub.job_id = submit_pbs(sub)
+            elif self.queue == 'sge':   sub.job_id = submit_sge(sub)
+            elif self.queue == 'fake':  sub.job_id = self.fake.submit(sub)
+            else:                       sub.job_id = self.submit_local(sub)
+            self._last = time.monotonic()
+            logging.info(f'Submitted {sub} as job {sub.job_id}')
+            self.submitted.append(sub)
+            ids.append(sub.job_id)
+        return ids
+
+    def submit_local(self, sub: Submission):
+        if self.local is None:
+            from utils.localrun import LocalExecutor
+            self.local = LocalExecutor(self.ncpu, self.gpu)
+        after = None
+        if sub.after:
+            after = sub.after.futures if sub.task_wise() else [self.local.all_of(sub.after.futures)] * len(sub.scripts)
+        sub.futures = self.local.submit(sub.workdir, sub.scripts, after)
+        return 'local'
+
+    def wait(self):
+        """
+        Wait for the scripts run on the local node ("none" backend)
+
+        :return: list of (Submission, script, exit code) of the failed scripts
+        """
+        if self.local is None: return []
+        failed = self.local.wait()
+        subs = {sub.workdir: sub for sub in self.submitted}
+        return [(subs.get(workdir), script, rc) for workdir, script, rc in failed]
+
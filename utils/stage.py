@@ -0,0 +1,152 @@
+# Created 2024
+"""
+Staging of immutable inputs (force-field includes, structures from TopDir, box cache entries)
+into job dirs without copying them every time:
+
+- copy    : copy the file (shutil.copy2)
+- link    : hard link, copy if linking fails (e.g. across file systems)
+- reflink : copy-on-write clone (FICLONE: btrfs, XFS, ...), copy if not supported
+- symlink : symbolic link to the absolute source path
+- auto    : hard link; across file systems the file is copied once per campaign
+            into the stage store (<OutDir>/.stage) and hard-linked from there,
+            then reflink, then copy
+
+Linked inputs are shared with the source: they must not be edited in place.
+"""
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+
+MODES = ('copy', 'link', 'reflink', 'symlink', 'auto')
+
+FICLONE = 0x40049409     # ioctl of Linux: clone the extents of a file
+
+
+def reflink(src, dst):
+    """
+    Copy-on-write clone of src to dst, raises OSError if the file system does not support it
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def _copy(src, dst):
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        return _copy(src, dst)
+
+
+def _reflink(src, dst):
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except OSError:
+        return _copy(src, dst)
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+    return 'symlink'
+
+
+def stage_file(src, dst, mode='auto'):
+    """
+    Put src at dst (an existing dst file is replaced)
+
+    :param  src: source file
+    :param  dst: destination file path
+    :param mode: one of MODES ("auto" here: hard link, reflink, copy)
+    :return: the method used: copy, link, reflink or symlink
+    """
+    if os.path.lexists(dst): os.remove(dst)
+    if mode == 'copy':    return _copy(src, dst)
+    if mode == 'link':    return _link(src, dst)
+    if mode == 'reflink': return _reflink(src, dst)
+    if mode == 'symlink': return _symlink(src, dst)
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        return _reflink(src, dst)
+
+
+class Stager:
+    """
+    Stages the inputs of all jobs of a campaign
+    """
+
+    def __init__(self, mode='auto', store=None, log=logging):
+        """
+        :param  mode: one of MODES
+        :param store: directory of the once-per-campaign copies of the "auto" mode (None - no store)
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown staging mode "{mode}", supported: {MODES}')
+        self.mode  = mode
+        self.store = store
+        self.log   = log
+        self._stored = {}        # (source path, size, mtime) -> path in the store
+        self.counts  = dict.fromkeys(('copy', 'link', 'reflink', 'symlink'), 0)
+
+    def _store_copy(self, src, st):
+        # Copy of src in the store (on the file system of the job dirs), made once per campaign
+        key = (os.path.realpath(src), st.st_size, st.st_mtime_ns)
+        path = self._stored.get(key)
+        if path and os.path.isfile(path): return path
+        digest = hashlib.sha256('\0'.join(map(str, key)).encode('utf-8')).hexdigest()[:24]
+        path = os.path.join(self.store, digest, os.path.basename(src))
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            stage_file(src, tmp, 'reflink')
+            try:
+                os.link(tmp, path)            # publish once, concurrent workers keep the first copy
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp)
+        self._stored[key] = path
+        return path
+
+    def stage(self, src, dst):
+        """
+        :param src: source file
+        :param dst: destination file path or directory
+        :return: destination file path
+        """
+        if os.path.isdir(dst): dst = os.path.join(dst, os.path.basename(src))
+        st = os.stat(src)
+        if self.mode == 'auto' and self.store:
+            if os.path.lexists(dst): os.remove(dst)
+            try:
+                os.link(src, dst)
+                method = 'link'
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                try:
+                    os.link(self._store_copy(src, st), dst)
+                    method = 'link'
+                except OSError:
+                    method = stage_file(src, dst, 'auto')
+        else:
+            method = stage_file(src, dst, self.mode)
+        self.counts[method] += 1
+        self.log.debug(f'Staged ({method}) {src} -> {dst}')
+        return dst
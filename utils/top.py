@@ -0,0 +1,46 @@
+# Created 2024
+"""
+Topology template with "{name}" placeholders (e.g. {ligand}, molecule counts, water model),
+split once into literal and placeholder tokens and rendered in a single pass for each ligand.
+"""
+import re
+
+# Placeholder: identifier in braces, other braces of the text are kept as they are
+_re_placeholder = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+
+class TopTemplate:
+    """
+    Topology template parsed into tokens: literal text at even and placeholder names at odd positions
+    """
+
+    def __init__(self, text, path=''):
+        """
+        :param text: template text
+        :param path: template path used in diagnostics
+        """
+        self.path   = path
+        self.tokens = _re_placeholder.split(text)
+        self.placeholders = set(self.tokens[1::2])
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as f:
+            return cls(f.read(), path)
+
+    def render(self, values):
+        """
+        :param values: dict placeholder name -> value
+        :return: (topology text, sorted names of the unresolved placeholders, kept as "{name}" in the text)
+                 the caller decides how to report the unresolved placeholders
+        """
+        out = list(self.tokens)
+        unresolved = set()
+        for i in range(1, len(out), 2):
+            name = out[i]
+            if name in values:
+                out[i] = str(values[name])
+            else:
+                unresolved.add(name)
+                out[i] = '{' + name + '}'
+        return ''.join(out), sorted(unresolved)